@@ -0,0 +1,46 @@
+# Recall and time per query of approximate search (ANNIndex) against the exact corpus scores
+from pybraincompare.compare.corpus import ImageCorpus
+from pybraincompare.compare.ann import ANNIndex, benchmark_ann
+from pybraincompare.compare.mrutils import Mask, resample_images_ref
+from pybraincompare.mr.datasets import get_pair_images, get_standard_mask
+from scipy.ndimage import gaussian_filter
+import numpy
+
+numpy.random.seed(9191986)
+mask = Mask(get_standard_mask(voxdim=2))
+
+# Synthetic maps: noisy copies (either sign) of 50 smooth patterns
+number_images = 1000
+patterns = [mask.take(gaussian_filter(numpy.random.normal(size=mask.shape),3))
+            for x in range(50)]
+patterns = numpy.array([p / p.std() for p in patterns],dtype=numpy.float32)
+labels = numpy.random.randint(0,len(patterns),size=number_images)
+weights = numpy.random.uniform(0.5,2,size=number_images) * numpy.random.choice([-1,1],size=number_images)
+synthetic = patterns[labels] * weights[:,numpy.newaxis]
+for x in range(number_images):
+    synthetic[x] += numpy.random.normal(size=len(mask)).astype(numpy.float32)
+
+# Bundled maps: mixtures of the two bundled 2mm zstat maps, with smooth noise
+zstats = resample_images_ref(get_pair_images(voxdims=["2","2"]),
+                             get_standard_mask(voxdim=2),
+                             interpolation="continuous")[0]
+zstats = mask.mask(zstats)
+mixtures = numpy.random.uniform(-1,1,size=(400,2))
+bundled = mixtures.dot(zstats).astype(numpy.float32)
+for x in range(len(bundled)):
+    bundled[x] += 2 * mask.take(gaussian_filter(numpy.random.normal(size=mask.shape),2))
+
+for name,vectors in [("synthetic",synthetic),("bundled",bundled)]:
+    corpus = ImageCorpus(vectors,mask=get_standard_mask(voxdim=2))
+    queries = [vectors[x] for x in numpy.random.choice(len(vectors),20,replace=False)]
+    for reduction in ["projection","pca"]:
+        index = ANNIndex(corpus,reduction=reduction)
+        results = benchmark_ann(index,queries,max_results=10,
+                                nprobes=(1,2,4,8,16),n_candidates=[64,256])
+        print("%s maps, %s:" %(name,reduction))
+        print(results)
+
+# Indexes are saved to one file, and loaded again for the same corpus
+index.save("/tmp/ann_index.npz")
+index = ANNIndex.load("/tmp/ann_index.npz",corpus)
+positions,scores = index.search(queries[0],max_results=10,nprobe=4)
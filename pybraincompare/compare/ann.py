@@ -0,0 +1,379 @@
+'''
+ann.py: part of pybraincompare package
+Approximate nearest neighbour search of a corpus of images
+
+Scoring a query against every image of an ImageCorpus is a product with
+the whole images x voxels matrix. An ANNIndex finds a small set of likely
+neighbours first, and only those are scored exactly:
+
+  - the standardized images are reduced to a few dimensions (a sparse
+    random projection, or PCA of a sample of the images) and normalized,
+    so the dot product of two reduced images approximates their correlation
+  - the reduced images are clustered (spherical k-means) into inverted
+    lists, each with a centroid
+  - a query is reduced the same way, the nprobe lists with centroids most
+    (or, for absolute values, most anti-) correlated with it are searched,
+    the n_candidates images with the best approximate scores are kept, and
+    these are re-ranked with the exact pairwise deletion pearson of
+    ImageCorpus.score
+
+nprobe and n_candidates trade recall for time, see benchmark_ann. An index
+is saved to (and loaded from) one .npz file, next to the corpus it is for.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import str
+from builtins import range
+from builtins import object
+from .search import rank_top_scores
+from scipy import sparse
+import numpy as np
+import pandas
+import json
+import time
+import os
+
+
+reductions = ["projection","pca"]
+
+
+class ANNIndex(object):
+    '''
+    Inverted file index of the reduced images of an ImageCorpus
+
+    corpus: ImageCorpus to index (and to score candidates with)
+    n_components: dimensions of the reduced images [default 64]
+    n_lists: number of inverted lists [default, square root of the number
+        of images]
+    reduction: projection (sparse random projection) or pca [default
+        projection]
+    nprobe: lists searched for each query [default 8]
+    n_candidates: images scored exactly for each query [default 256]
+    seed: random seed of the projection, sample and clustering [default 0]
+    n_iter: iterations of k-means [default 10]
+    sample_size: number of images the pca is fit on [default 1024]
+    build: build the index now [default True]. load builds it from a file.
+    '''
+
+    def __init__(self, corpus,
+                       n_components=64,
+                       n_lists=None,
+                       reduction="projection",
+                       nprobe=8,
+                       n_candidates=256,
+                       seed=0,
+                       n_iter=10,
+                       sample_size=1024,
+                       build=True):
+
+        if reduction not in reductions:
+            raise ValueError("reduction must be one of %s" %(",".join(reductions)))
+        self.corpus = corpus
+        self.number_voxels = corpus.data.shape[1]
+        self.n_components = int(max(1,min(n_components,self.number_voxels)))
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(corpus)))
+        self.n_lists = int(max(1,min(n_lists,len(corpus))))
+        self.reduction = reduction
+        self.nprobe = nprobe
+        self.n_candidates = n_candidates
+        self.seed = seed
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.components = None
+        if build:
+            self.build()
+
+    def __len__(self):
+        return len(self.reduced)
+
+    def build(self):
+        '''Reduce the corpus images, and cluster them into the lists'''
+        random = np.random.RandomState(self.seed)
+        if self.reduction == "pca":
+            self.components = self.fit_pca(random)
+        else:
+            self.components = get_projection(self.number_voxels,
+                                             self.n_components,
+                                             self.seed)
+        self.reduced = np.empty((len(self.corpus),self.n_components),dtype=np.float32)
+        for start in range(0,len(self.corpus),self.corpus.block_size):
+            block = self.corpus.data[start:start + self.corpus.block_size]
+            self.reduced[start:start + len(block)] = self.reduce(block)
+        self.centroids,assignments = spherical_kmeans(self.reduced,
+                                                      self.n_lists,
+                                                      n_iter=self.n_iter,
+                                                      random=random)
+        self.set_lists(assignments)
+        return self
+
+    def fit_pca(self,random):
+        '''fit_pca
+        Leading right singular vectors of a sample of the (standardized)
+        corpus images, by a randomized range finder with two power
+        iterations. Not centered, so dot products are kept in the subspace.
+        '''
+        number = min(self.sample_size,len(self.corpus))
+        rows = np.sort(random.choice(len(self.corpus),number,replace=False))
+        sample = self.corpus.data[rows]
+        width = min(self.n_components + 10,number)
+        basis = sample.dot(random.normal(size=(self.number_voxels,width)).astype(np.float32))
+        for _ in range(2):
+            basis = np.linalg.qr(basis)[0]
+            basis = sample.dot(sample.T.dot(basis))
+        basis = np.linalg.qr(basis)[0]
+        components = np.linalg.svd(basis.T.dot(sample),full_matrices=False)[2]
+        components = components[0:self.n_components].astype(np.float32)
+        if len(components) < self.n_components:
+            padding = np.zeros((self.n_components - len(components),self.number_voxels),
+                               dtype=np.float32)
+            components = np.vstack([components,padding])
+        return components
+
+    def reduce(self,data):
+        '''Reduced, unit length rows of standardized data (images x voxels)'''
+        data = np.array(data,dtype=np.float32,copy=False,ndmin=2)
+        if self.reduction == "pca":
+            reduced = data.dot(self.components.T)
+        else:
+            reduced = np.asarray(self.components.T.dot(data.T).T,dtype=np.float32)
+        norms = np.sqrt((reduced*reduced).sum(axis=1))
+        norms[norms == 0] = 1
+        return reduced / norms[:,np.newaxis]
+
+    def set_lists(self,assignments):
+        '''Members of each list, as one array of positions and offsets'''
+        self.members = np.argsort(assignments,kind="stable").astype(np.int64)
+        self.offsets = np.zeros(self.n_lists + 1,dtype=np.int64)
+        np.cumsum(np.bincount(assignments,minlength=self.n_lists),out=self.offsets[1:])
+
+    def check_corpus(self):
+        '''The index positions are corpus positions, so a corpus that has
+        grown (or shrunk) since the index was built needs a new build'''
+        if len(self.reduced) != len(self.corpus):
+            raise ValueError("Index has %s images and the corpus %s, build the index again"
+                             %(len(self.reduced),len(self.corpus)))
+
+    def get_candidates(self,query,nprobe=None,n_candidates=None,absolute_value=True):
+        '''get_candidates
+        Positions (in the corpus) of the images to score exactly for a
+        standardized query vector: the n_candidates best approximate scores
+        among the members of the nprobe (at least one) best lists
+        '''
+        self.check_corpus()
+        nprobe = max(1,self.nprobe if nprobe is None else nprobe)
+        n_candidates = self.n_candidates if n_candidates is None else n_candidates
+        reduced = self.reduce(query)[0]
+        lists = rank_top_scores(self.centroids.dot(reduced),
+                                max_results=nprobe,
+                                absolute_value=absolute_value)
+        members = np.concatenate([self.members[self.offsets[x]:self.offsets[x + 1]]
+                                  for x in lists])
+        top = rank_top_scores(self.reduced[members].dot(reduced),
+                              max_results=n_candidates,
+                              absolute_value=absolute_value)
+        return np.sort(members[top])
+
+    def search(self,query,max_results=10,nprobe=None,n_candidates=None,
+               absolute_value=True,exclude=None):
+        '''search
+        Images most similar to a query, best first
+
+        query: an image file, nibabel image, or vector already masked
+        max_results: number of images to return
+        nprobe, n_candidates: override the index settings for this query
+        absolute_value: rank by the absolute value of the correlation
+        exclude: corpus positions to leave out (eg the query)
+
+        Returns the corpus positions (for image_ids) of the results and
+        their exact (pairwise deletion pearson) scores
+        '''
+        query,query_valid = self.corpus.prepare_query(query)
+        candidates = self.get_candidates(query,nprobe,n_candidates,absolute_value)
+        scores = self.corpus.score_rows(candidates,query,query_valid)[0]
+        excluded = np.flatnonzero(np.in1d(candidates,[] if exclude is None else exclude))
+        top = rank_top_scores(scores,max_results=max_results,
+                              absolute_value=absolute_value,exclude=excluded)
+        return candidates[top],scores[top]
+
+    def score(self,query,nprobe=None,n_candidates=None,absolute_value=True):
+        '''Exact scores of the candidates for a query, in the order of the
+        corpus image_ids, nan for images that were not candidates'''
+        query,query_valid = self.corpus.prepare_query(query)
+        candidates = self.get_candidates(query,nprobe,n_candidates,absolute_value)
+        scores = np.full(len(self.corpus),np.nan)
+        scores[candidates] = self.corpus.score_rows(candidates,query,query_valid)[0]
+        return scores
+
+    def similarity_search(self,query,query_id,nprobe=None,n_candidates=None,**kwargs):
+        '''similarity_search
+        ImageCorpus.similarity_search with scores from the index. At least
+        max_results + 1 candidates are scored, so the results are filled.
+        '''
+        n_candidates = self.n_candidates if n_candidates is None else n_candidates
+        n_candidates = max(n_candidates,kwargs.get("max_results",100) + 1)
+        scores = self.score(query,nprobe=nprobe,n_candidates=n_candidates,
+                            absolute_value=kwargs.get("absolute_value",True))
+        return self.corpus.similarity_search(query,query_id,scores=scores,**kwargs)
+
+    def get_settings(self):
+        return {"mask_key":self.corpus.mask_key,
+                "image_ids":list(self.corpus.image_ids),
+                "number_voxels":self.number_voxels,
+                "n_components":self.n_components,
+                "n_lists":self.n_lists,
+                "reduction":self.reduction,
+                "nprobe":self.nprobe,
+                "n_candidates":self.n_candidates,
+                "seed":self.seed,
+                "n_iter":self.n_iter,
+                "sample_size":self.sample_size}
+
+    def save(self,filename):
+        '''save
+        Save the index to one .npz file (written to a temporary file first).
+        The corpus itself is not saved, and random projections are made
+        again from the seed.
+        '''
+        arrays = {"settings":np.array(json.dumps(self.get_settings())),
+                  "reduced":self.reduced,
+                  "centroids":self.centroids,
+                  "members":self.members,
+                  "offsets":self.offsets}
+        if self.reduction == "pca":
+            arrays["components"] = self.components
+        with open(filename + ".tmp","wb") as filey:
+            np.savez(filey,**arrays)
+        os.replace(filename + ".tmp",filename)
+        return filename
+
+    @classmethod
+    def load(cls,filename,corpus):
+        '''Load an index saved for a corpus (same mask and image_ids)'''
+        with np.load(filename,allow_pickle=False) as saved:
+            settings = json.loads(str(saved["settings"]))
+            if settings["mask_key"] != corpus.mask_key or \
+               settings["image_ids"] != json.loads(json.dumps(list(corpus.image_ids))):
+                raise ValueError("Index at %s was not built for this corpus" %(filename))
+            index = cls(corpus,
+                        n_components=settings["n_components"],
+                        n_lists=settings["n_lists"],
+                        reduction=settings["reduction"],
+                        nprobe=settings["nprobe"],
+                        n_candidates=settings["n_candidates"],
+                        seed=settings["seed"],
+                        n_iter=settings["n_iter"],
+                        sample_size=settings["sample_size"],
+                        build=False)
+            index.reduced = saved["reduced"]
+            index.centroids = saved["centroids"]
+            index.members = saved["members"]
+            index.offsets = saved["offsets"]
+            if index.reduction == "pca":
+                index.components = saved["components"]
+            else:
+                index.components = get_projection(index.number_voxels,
+                                                  index.n_components,
+                                                  index.seed)
+        return index
+
+
+def get_projection(number_voxels,n_components,seed=0,density=None):
+    '''get_projection
+    Very sparse random projection (voxels x components) of +1 and -1
+    entries, each voxel kept with probability density [default, one over
+    the square root of the number of voxels]. The same seed gives the same
+    projection.
+    '''
+    if density is None:
+        density = 1.0 / np.sqrt(number_voxels)
+    random = np.random.RandomState(seed)
+    number = max(1,int(round(density * number_voxels)))
+    rows = random.randint(0,number_voxels,size=number * n_components)
+    columns = np.repeat(np.arange(n_components),number)
+    signs = (random.randint(0,2,size=len(rows)) * 2 - 1).astype(np.float32)
+    return sparse.csr_matrix((signs,(rows,columns)),shape=(number_voxels,n_components))
+
+
+def spherical_kmeans(vectors,n_clusters,n_iter=10,random=None,block_size=8192):
+    '''spherical_kmeans
+    Cluster unit length vectors (rows) by cosine similarity. Clusters left
+    empty are seeded again with the vectors furthest from their centroid.
+    Returns the unit length centroids and the cluster of each vector.
+    '''
+    if random is None:
+        random = np.random.RandomState(0)
+    seeds = np.sort(random.choice(len(vectors),n_clusters,replace=False))
+    centroids = np.array(vectors[seeds],dtype=np.float32)
+    assignments = np.zeros(len(vectors),dtype=np.int64)
+    similarity = np.zeros(len(vectors),dtype=np.float32)
+    for _ in range(max(n_iter,1)):
+        for start in range(0,len(vectors),block_size):
+            scores = vectors[start:start + block_size].dot(centroids.T)
+            assignments[start:start + len(scores)] = scores.argmax(axis=1)
+            similarity[start:start + len(scores)] = scores.max(axis=1)
+        onehot = sparse.csr_matrix((np.ones(len(vectors),dtype=np.float32),
+                                    (assignments,np.arange(len(vectors)))),
+                                   shape=(n_clusters,len(vectors)))
+        centroids = np.asarray(onehot.dot(vectors),dtype=np.float32)
+        empty = np.flatnonzero(np.bincount(assignments,minlength=n_clusters) == 0)
+        if len(empty) > 0:
+            furthest = np.argsort(similarity,kind="stable")[0:len(empty)]
+            centroids[empty] = vectors[furthest]
+            assignments[furthest] = empty
+            similarity[furthest] = 1
+        norms = np.sqrt((centroids*centroids).sum(axis=1))
+        norms[norms == 0] = 1
+        centroids /= norms[:,np.newaxis]
+    return centroids,assignments
+
+
+def benchmark_ann(index,queries,max_results=10,nprobes=(1,2,4,8,16),
+                  n_candidates=None,absolute_value=True):
+    '''benchmark_ann
+    Recall and time per query of an ANNIndex, against the exact scores of
+    its corpus (ImageCorpus.score)
+
+    index: ANNIndex
+    queries: list of queries (image files, nibabel images or vectors)
+    max_results: recall is of the exact top max_results
+    nprobes: values of nprobe to time
+    n_candidates: values of n_candidates to time [default, the index setting]
+
+    Returns a data frame with a row for the exact scorer and for each
+    setting: method, nprobe, n_candidates, recall, milliseconds per query
+    and speedup over the exact scorer
+    '''
+    if n_candidates is None:
+        n_candidates = [index.n_candidates]
+    if not isinstance(n_candidates,(list,tuple)):
+        n_candidates = [n_candidates]
+
+    expected = []
+    started = time.time()
+    for query in queries:
+        scores = index.corpus.score(query)
+        expected.append(rank_top_scores(scores,max_results=max_results,
+                                        absolute_value=absolute_value))
+    exact_time = 1000 * (time.time() - started) / max(len(queries),1)
+    results = [{"method":"exact","nprobe":index.n_lists,"n_candidates":len(index.corpus),
+                "recall":1.0,"ms_per_query":exact_time,"speedup":1.0}]
+
+    for candidates in n_candidates:
+        for nprobe in nprobes:
+            found = []
+            started = time.time()
+            for query in queries:
+                found.append(index.search(query,max_results=max_results,
+                                          nprobe=nprobe,n_candidates=candidates,
+                                          absolute_value=absolute_value)[0])
+            ann_time = 1000 * (time.time() - started) / max(len(queries),1)
+            hits = [len(np.intersect1d(a,b)) / max(len(b),1) for a,b in zip(found,expected)]
+            results.append({"method":"ann","nprobe":nprobe,"n_candidates":candidates,
+                            "recall":np.mean(hits),"ms_per_query":ann_time,
+                            "speedup":exact_time / max(ann_time,1e-9)})
+    return pandas.DataFrame(results,columns=["method","nprobe","n_candidates",
+                                             "recall","ms_per_query","speedup"])
@@ -0,0 +1,217 @@
+'''
+cache.py: part of pybraincompare package
+On disk cache of resampled images
+
+Resampled data is saved as .npy files (opened again as copy on write memory
+maps), with a small json file for the output affine and header. Entries
+are keyed by a content fingerprint of the source image (data, shape, dtype
+and affine) and the target affine, target shape and interpolation, so the
+same image resampled to the same grid is only resampled once, in any
+process. The total size of the cache is bounded, the least recently used
+entries are removed first.
+
+The cache is off unless a cache is given to resample_images_ref (or
+cached_resample_img), set with set_resample_cache, or a directory is named
+in the PYBRAINCOMPARE_RESAMPLE_CACHE environment variable.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import str
+from builtins import object
+from nilearn.image import resample_img
+import tempfile
+import hashlib
+import base64
+import nibabel
+import numpy
+import json
+import os
+
+
+class ResampleCache(object):
+    '''
+    Least recently used cache of resampled images in a directory
+
+    cache_dir: directory for the cache files [default, a folder in tmp]
+    max_bytes: maximum total size of the cached data [default 2GB]
+    '''
+
+    def __init__(self, cache_dir=None, max_bytes=2*1024**3):
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(),"pybraincompare_resample")
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprints = dict()
+
+    def get_key(self,image,target_affine,target_shape,interpolation):
+        '''Key from the image fingerprint and the target grid'''
+        key = hashlib.sha1(self.get_fingerprint(image).encode("utf-8"))
+        key.update(numpy.asarray(target_affine,dtype=numpy.float64).tobytes())
+        key.update(str(None if target_shape is None
+                       else tuple(int(x) for x in target_shape)).encode("utf-8"))
+        key.update(str(interpolation).encode("utf-8"))
+        return key.hexdigest()
+
+    def get_fingerprint(self,image):
+        '''get_fingerprint
+        sha1 of the data, shape, dtype and affine of an image. For images
+        loaded from a file, fingerprints are remembered for the file path,
+        size and modification time, so the data is only read once.
+        '''
+        file_key = None
+        filename = image.get_filename()
+        if filename is not None and os.path.exists(filename) and \
+           isinstance(image.dataobj,nibabel.arrayproxy.ArrayProxy):
+            stat = os.stat(filename)
+            file_key = (os.path.abspath(filename),stat.st_size,stat.st_mtime)
+            if file_key in self.fingerprints:
+                return self.fingerprints[file_key]
+
+        fingerprint = get_image_fingerprint(image)
+        if file_key is not None:
+            self.fingerprints[file_key] = fingerprint
+        return fingerprint
+
+    def get_paths(self,key):
+        return (os.path.join(self.cache_dir,"%s.npy" %(key)),
+                os.path.join(self.cache_dir,"%s.json" %(key)))
+
+    def get(self,key):
+        '''Return the cached image for a key (data memory mapped, with the
+        header of the image that was put), or None'''
+        data_file,meta_file = self.get_paths(key)
+        try:
+            with open(meta_file,"r") as filey:
+                meta = json.load(filey)
+            data = numpy.load(data_file,mmap_mode="c")
+        except (IOError,OSError,ValueError):
+            return None
+        os.utime(data_file,None)
+        header = None
+        if meta.get("header") is not None:
+            header = nibabel.Nifti1Header(base64.b64decode(meta["header"]))
+        return nibabel.Nifti1Image(data,affine=numpy.array(meta["affine"]),header=header)
+
+    def put(self,key,image):
+        '''Save the data and affine of a resampled image, then evict'''
+        data_file,meta_file = self.get_paths(key)
+        data = numpy.asanyarray(image.dataobj)
+
+        # Write to temporary names first, other processes never see part files
+        suffix = ".%s.tmp" %(os.getpid())
+        with open(data_file + suffix,"wb") as filey:
+            numpy.save(filey,data)
+        header = None
+        if isinstance(image.header,nibabel.Nifti1Header):
+            header = base64.b64encode(image.header.binaryblock).decode("ascii")
+        with open(meta_file + suffix,"w") as filey:
+            json.dump({"affine":image.affine.tolist(),"header":header},filey)
+        os.replace(meta_file + suffix,meta_file)
+        os.replace(data_file + suffix,data_file)
+        self.evict()
+
+    def entries(self):
+        '''Cached data files with their size and last use, oldest first'''
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".npy"):
+                path = os.path.join(self.cache_dir,filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime,stat.st_size,path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self,max_bytes=None):
+        '''Remove least recently used entries until under max_bytes'''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for mtime,size,path in entries:
+            if total <= max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self,data_file):
+        for path in [data_file,data_file.replace(".npy",".json")]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self):
+        '''Remove every entry in the cache'''
+        self.evict(max_bytes=0)
+        self.fingerprints = dict()
+
+    def resample(self,image,target_affine,target_shape=None,
+                 interpolation="continuous"):
+        '''resample_img for one nibabel image, through the cache'''
+        key = self.get_key(image,target_affine,target_shape,interpolation)
+        resampled = self.get(key)
+        if resampled is None:
+            resampled = resample_img(image,
+                                     target_affine=target_affine,
+                                     target_shape=target_shape,
+                                     interpolation=interpolation)
+            self.put(key,resampled)
+        return resampled
+
+
+def get_image_fingerprint(image):
+    '''sha1 of the data, shape, dtype and affine of a nibabel image'''
+    data = numpy.ascontiguousarray(numpy.asanyarray(image.dataobj))
+    fingerprint = hashlib.sha1(data.tobytes())
+    fingerprint.update(str((data.shape,data.dtype.str)).encode("utf-8"))
+    fingerprint.update(numpy.asarray(image.affine,dtype=numpy.float64).tobytes())
+    return fingerprint.hexdigest()
+
+
+# The cache used when none is given
+resample_cache = None
+
+def set_resample_cache(cache=None,max_bytes=2*1024**3):
+    '''set_resample_cache
+    Set the default cache for resampling: a ResampleCache, a directory for
+    one, or None to turn caching off
+    '''
+    global resample_cache
+    if cache is not None and not isinstance(cache,ResampleCache):
+        cache = ResampleCache(cache_dir=cache,max_bytes=max_bytes)
+    resample_cache = cache
+    return resample_cache
+
+def get_resample_cache(cache=None):
+    '''Return the cache to use: the one given (a ResampleCache or directory),
+    else the default, else one named in PYBRAINCOMPARE_RESAMPLE_CACHE'''
+    if cache is not None:
+        if not isinstance(cache,ResampleCache):
+            cache = ResampleCache(cache_dir=cache)
+        return cache
+    if resample_cache is None and "PYBRAINCOMPARE_RESAMPLE_CACHE" in os.environ:
+        set_resample_cache(os.environ["PYBRAINCOMPARE_RESAMPLE_CACHE"])
+    return resample_cache
+
+def cached_resample_img(image,target_affine,target_shape=None,
+                        interpolation="continuous",cache=None):
+    '''cached_resample_img
+    nilearn resample_img, with results kept in the resample cache when one
+    is set (see get_resample_cache). Without a cache, the same as
+    resample_img.
+    '''
+    cache = get_resample_cache(cache)
+    if cache is None:
+        return resample_img(image,
+                            target_affine=target_affine,
+                            target_shape=target_shape,
+                            interpolation=interpolation)
+    return cache.resample(image,target_affine,target_shape,interpolation)
@@ -0,0 +1,332 @@
+'''
+corpus.py: part of pybraincompare package
+Score a query image against a corpus of images
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import range
+from builtins import object
+from .mrutils import get_nii_obj, squeeze_fourth_dimension, get_image_data
+from .maths import (
+    _pairwise_deletion_correlation,
+    calculate_ranked_spearman,
+    standardize_vectors,
+    rank_vector
+)
+from scipy.stats import rankdata
+from .search import similarity_search, SearchColumns
+from .overlap import PackedValidity
+from .store import VoxelStore
+import numpy as np
+import contextlib
+import hashlib
+import nibabel
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+class ImageCorpus(object):
+    '''
+    Corpus of images held as a pre-masked, pre-standardized float32 matrix
+    (images in rows, voxels in columns) to score queries against.
+
+    Values that are zero or nan are treated as missing (the same pairwise
+    deletion as make_binary_deletion_vector): the corpus keeps the validity
+    of each image, bit-packed (see PackedValidity), next to the values, and
+    every query/image pair is correlated using only the voxels that are
+    valid in both. Standardizing each image
+    does not change a pearson correlation over any subset of its voxels, it
+    just keeps float32 sums well conditioned. Images appended later go into
+    spare rows of a buffer (data is a view of its first rows).
+    '''
+
+    def __init__(self, images,
+                       mask,
+                       image_ids=None,
+                       block_size=2048,
+                       n_threads=None):
+        '''
+        images: list of image files or nibabel images (registered to mask),
+                a 2D array of already masked vectors (images x voxels), or
+                a VoxelStore in the same mask
+        mask: nibabel.Nifti1Image or file, the mask the images are in
+        image_ids: ids for the images, in the same order [default index]
+        block_size: number of corpus rows scored per matrix product
+        n_threads: maximum number of BLAS threads used when scoring
+        '''
+        self.mask = get_nii_obj(mask)[0]
+        self.mask_bin = np.squeeze(self.mask.get_data()) != 0
+        self.mask_key = hashlib.sha1(np.packbits(self.mask_bin).tobytes()).hexdigest()
+        self.block_size = block_size
+        self.n_threads = n_threads
+        self.rank_data = None
+        self.search_columns = None
+
+        self.data, valid = self.load_vectors(images)
+        self.validity = PackedValidity.from_valid(valid)
+        self.buffer,self.validity_buffer = self.data,self.validity.bits
+        del valid
+        if image_ids is None and isinstance(images,VoxelStore):
+            image_ids = list(images.ids)
+        if image_ids is None:
+            image_ids = list(range(self.data.shape[0]))
+        if len(image_ids) != self.data.shape[0]:
+            raise ValueError("Number of image_ids must equal number of images")
+        self.image_ids = list(image_ids)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def append(self,images,image_ids=None):
+        '''append
+        Add images (anything the corpus is made from) after the images
+        already in the corpus. Only the new images are masked and
+        standardized, the rows of the corpus images do not change.
+        '''
+        data, valid = self.load_vectors(images)
+        if image_ids is None:
+            image_ids = list(range(len(self),len(self) + data.shape[0]))
+        if len(image_ids) != data.shape[0]:
+            raise ValueError("Number of image_ids must equal number of images")
+
+        # Rows are written after the corpus rows, in buffers that double in
+        # size when full, so appending one image at a time is not quadratic
+        start,end = len(self),len(self) + data.shape[0]
+        if end > self.buffer.shape[0]:
+            capacity = max(end,2 * self.buffer.shape[0])
+            grown = np.empty((capacity,self.data.shape[1]),dtype=np.float32)
+            grown[0:start] = self.data
+            grown_validity = np.empty((capacity,self.validity.bits.shape[1]),dtype=np.uint8)
+            grown_validity[0:start] = self.validity.bits
+            self.buffer,self.validity_buffer = grown,grown_validity
+        self.buffer[start:end] = data
+        self.validity_buffer[start:end] = np.packbits(valid,axis=1)
+        self.validity = PackedValidity(self.validity_buffer[0:end],self.validity.number_voxels)
+        self.data = self.buffer[0:end]
+        self.image_ids = self.image_ids + list(image_ids)
+        self.rank_data = None
+        self.search_columns = None
+        return self
+
+    def load_vectors(self,images):
+        '''Mask and standardize images into a float32 matrix, one row each'''
+        if isinstance(images,np.ndarray) and images.ndim == 2:
+            data = np.array(images,dtype=np.float32)
+        elif isinstance(images,VoxelStore):
+            if images.mask_key != self.mask_key:
+                raise ValueError("Store mask does not match the corpus mask")
+            data = np.empty((len(images),images.number_voxels),dtype=np.float32)
+            for start in range(0,len(images),images.chunk_size):
+                rows = images.get_rows(slice(start,start + images.chunk_size))
+                data[start:start + len(rows)] = rows
+        else:
+            if isinstance(images,(str,nibabel.nifti1.Nifti1Image)):
+                images = [images]
+            data = np.empty((len(images),int(self.mask_bin.sum())),
+                            dtype=np.float32)
+            for i in range(len(images)):
+                data[i] = self.mask_vector(images[i])
+        valid = standardize_vectors(data)
+        return data, valid
+
+    def mask_vector(self,image):
+        '''Return the in-mask values of one image (or a masked vector)'''
+        if isinstance(image,np.ndarray) and image.ndim == 1:
+            return image
+        image = squeeze_fourth_dimension(get_nii_obj(image))[0]
+        return np.squeeze(get_image_data(image,"native"))[self.mask_bin]
+
+    def prepare_query(self,query):
+        '''Standardize a query image or vector the same way as the corpus'''
+        query = np.array(self.mask_vector(query),dtype=np.float32,ndmin=2)
+        valid = standardize_vectors(query)
+        return query, valid
+
+    def score(self,query,corr_type="pearson",query_id=None,
+              return_counts=False):
+        '''score
+        Correlation of a query with every image in the corpus
+
+        query: an image file, nibabel image, or vector already masked
+        corr_type: pearson or spearman [default pearson]
+        query_id: id of the query [optional, not used]
+        return_counts: also return the number of overlapping voxels
+
+        Scores are in the order of image_ids, nan where a pair has fewer
+        than two overlapping voxels (or no variance in the overlap).
+        '''
+        if corr_type == "spearman":
+            return self.score_spearman(query,query_id,return_counts)
+        elif corr_type != "pearson":
+            raise ValueError("corr_type must be pearson or spearman")
+
+        query, query_valid = self.prepare_query(query)
+        scores, counts = self.score_matrix(self.data,query,query_valid)
+        if return_counts:
+            return scores, counts
+        return scores
+
+    def score_matrix(self,data,query,query_valid):
+        '''Blocked pairwise deletion pearson of query against rows of data'''
+        scores = np.empty(len(self))
+        counts = np.empty(len(self),dtype=np.int64)
+        with blas_threads(self.n_threads):
+            for start in range(0,len(self),self.block_size):
+                end = min(start + self.block_size, len(self))
+                corrs,overlap = _pairwise_deletion_correlation(
+                                    data[start:end],
+                                    self.validity.unpack(start,end,np.float32),
+                                    query,
+                                    query_valid.astype(np.float32))
+                scores[start:end] = corrs[:,0]
+                counts[start:end] = overlap[:,0]
+        return scores, counts
+
+    def score_rows(self,rows,query,query_valid,block_size=64):
+        '''score_rows
+        Pairwise deletion pearson of a prepared query (see prepare_query)
+        against the corpus images at rows only, block_size rows gathered at
+        a time. Returns scores and overlap counts in the order of rows.
+        '''
+        rows = np.asarray(rows,dtype=np.int64)
+        scores = np.empty(len(rows))
+        counts = np.empty(len(rows),dtype=np.int64)
+        with blas_threads(self.n_threads):
+            for start in range(0,len(rows),block_size):
+                block = rows[start:start + block_size]
+                corrs,overlap = _pairwise_deletion_correlation(
+                                    self.data[block],
+                                    self.validity.unpack_rows(block,np.float32),
+                                    query,
+                                    query_valid.astype(np.float32))
+                scores[start:start + len(block)] = corrs[:,0]
+                counts[start:start + len(block)] = overlap[:,0]
+        return scores, counts
+
+    def get_rank_data(self):
+        '''get_rank_data
+        Standardized ranks of each image over its valid voxels, computed
+        once for the corpus. The mean and standard deviation of the ranks of
+        each image are kept with them, to get the ranks back (get_ranks).
+        '''
+        if self.rank_data is None:
+            rank_data = np.zeros(self.data.shape,dtype=np.float32)
+            self.rank_moments = np.ones((len(self),2))
+            for i in range(len(self)):
+                valid = self.validity.get_valid(i)
+                if valid.any():
+                    ranks = rankdata(self.data[i][valid])
+                    mean,std = ranks.mean(),ranks.std()
+                    std = std if std > 0 else 1
+                    self.rank_moments[i] = mean,std
+                    rank_data[i][valid] = (ranks - mean) / std
+            self.rank_data = rank_data
+        return self.rank_data
+
+    def get_ranks(self,i):
+        '''Ranks of corpus image i over its valid voxels (0 elsewhere), and
+        the boolean vector of its valid voxels'''
+        rank_data = self.get_rank_data()
+        valid = self.validity.get_valid(i)
+        mean,std = self.rank_moments[i]
+        ranks = np.zeros(self.data.shape[1])
+        # Average ranks are multiples of 0.5, rounding undoes float32 error
+        ranks[valid] = np.round(2*(rank_data[i][valid]*std + mean)) / 2
+        return ranks, valid
+
+    def score_spearman(self,query,query_id=None,return_counts=False):
+        '''score_spearman
+        Spearman correlation of a query with every image in the corpus.
+        Pairs where neither image loses voxels to pairwise deletion are a 
+        blocked pearson over pre-computed ranks. Only pairs that do lose
+        voxels are corrected, exactly, by calculate_ranked_spearman (the
+        ranks of corpus images are those of get_rank_data, validity is the
+        corpus validity). query_id is not used.
+        '''
+        query = np.array(self.mask_vector(query),dtype=np.float64)
+        query_valid = (query != 0) & ~np.isnan(query)
+        ranks = rank_vector(query,query_valid)
+        query_ranks = np.array(ranks,dtype=np.float32,ndmin=2)
+        standardize_vectors(query_ranks,query_valid[np.newaxis,:])
+
+        scores, counts = self.score_matrix(self.get_rank_data(),
+                                           query_ranks,
+                                           query_valid[np.newaxis,:])
+
+        # Pairs where deletion removed voxels from either image
+        deleted = (counts != query_valid.sum()) | \
+                  (counts != self.validity.counts())
+        for i in np.where(deleted & (counts >= 2))[0]:
+            image_ranks,image_valid = self.get_ranks(i)
+            scores[i] = calculate_ranked_spearman(image_ranks,self.data[i],image_valid,
+                                                  ranks,query,query_valid)
+
+        if return_counts:
+            return scores, counts
+        return scores
+
+    def overlap_counts(self,query=None):
+        '''overlap_counts
+        Number of voxels valid (nonzero, not nan) in both images, for every
+        pair of corpus images (a matrix), or for a query against every
+        corpus image (a vector), from the bit-packed validity.
+        '''
+        if query is None:
+            return self.validity.overlap_counts()
+        query = self.mask_vector(query)
+        query = PackedValidity.from_vectors(query)
+        return self.validity.overlap_counts(query)[:,0]
+
+    def similarity_search(self,query,query_id,corr_type="pearson",scores=None,**kwargs):
+        '''similarity_search
+        Score a query against the corpus, and render the results with
+        pybraincompare.compare.search.similarity_search. The query must be
+        in the corpus (query_id in image_ids), all other arguments (tags,
+        png_paths, query_png, button_url, image_url...) are passed on. With
+        set_search_columns, tags and png_paths are not needed. Scores of
+        the query already computed (eg by an ANNIndex) can be given.
+        '''
+        if scores is None:
+            scores = self.score(query,corr_type=corr_type,query_id=query_id)
+        if self.search_columns is not None and "png_paths" not in kwargs:
+            return similarity_search(image_scores=scores,
+                                     query_id=query_id,
+                                     image_ids=None,
+                                     tags=None,
+                                     png_paths=None,
+                                     columns=self.search_columns,
+                                     **kwargs)
+        return similarity_search(image_scores=scores,
+                                 query_id=query_id,
+                                 image_ids=self.image_ids,
+                                 **kwargs)
+
+    def set_search_columns(self,png_paths,tags,top_text=None,bottom_text=None):
+        '''Keep the result fields of the corpus images (in the order of
+        image_ids) for similarity_search, so they are gathered by position
+        for each query instead of passed and rebuilt'''
+        self.search_columns = SearchColumns(png_paths=png_paths,
+                                            tags=tags,
+                                            image_ids=self.image_ids,
+                                            top_text=top_text,
+                                            bottom_text=bottom_text)
+        return self.search_columns
+
+
+@contextlib.contextmanager
+def blas_threads(n_threads):
+    '''Limit the number of BLAS threads (requires threadpoolctl)'''
+    if n_threads is None:
+        yield
+    elif threadpool_limits is None:
+        print("threadpoolctl is not installed, cannot limit BLAS threads.")
+        yield
+    else:
+        with threadpool_limits(limits=n_threads, user_api="blas"):
+            yield
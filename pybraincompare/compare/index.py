@@ -0,0 +1,448 @@
+'''
+index.py: part of pybraincompare package
+Persistent similarity index of a changing collection of images
+
+A CorpusIndex is a directory with the mask, a current.json naming the
+current generation, and one folder per generation holding:
+
+  - a VoxelStore of masked images, rows only ever appended
+  - log.jsonl, the append log of changes, one json object per line:
+      {"op":"add","id":...,"row":...,"fingerprint":...,"file":...}
+      {"op":"remove","id":...}
+      {"op":"touch","id":...,"file":...}
+
+Adding an image appends a row and an "add" line. Updating an image is an
+"add" for an id already in the index, the new row replaces the old one.
+Removing an image is a "remove" line (a tombstone). Rows that were
+replaced or removed stay in the store until compaction copies the live
+rows to a new generation, with a new log of one "add" per image, and
+switches current.json to it.
+
+Each image keeps a fingerprint of its content (see get_image_fingerprint)
+and, for files, their path, size and modification time, so re-indexing a
+directory only reads the files that changed, and only masks images whose
+content changed.
+
+Queries go through a snapshot: the live rows at one moment, scored with
+the in-memory ImageCorpus of the generation. Rows are never changed once
+written, and a snapshot keeps the corpus it was taken from, so a query
+gives the same answer while images are added, removed or compacted. One
+process writes to an index at a time, others can read it, and see its
+changes with refresh. In the writing process, images are masked and
+written to the store before the lock queries take is held, only to write
+the log and apply it, so queries do not wait for images to be read.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import str
+from builtins import range
+from builtins import object
+from .cache import get_image_fingerprint
+from .corpus import ImageCorpus
+from .mrutils import Mask, get_nii_obj
+from .search import rank_top_scores, similarity_search
+from .store import VoxelStore
+from glob import glob
+import numpy as np
+import threading
+import hashlib
+import nibabel
+import shutil
+import json
+import os
+
+
+class CorpusIndex(object):
+    '''
+    Similarity index of images that can be added, removed and updated
+
+    index_dir: directory of the index (created if it does not exist)
+    mask: mask the images are in (nibabel image, file or Mask). Required to
+        create an index, and checked against the index mask if given
+    chunk_size: number of images per store chunk [default 256]
+    compact_ratio: compact when more than this fraction of the rows are
+        replaced or removed [default 0.5, None to only compact when asked]
+    n_threads: maximum number of BLAS threads used when scoring
+    '''
+
+    def __init__(self, index_dir, mask=None, chunk_size=256, compact_ratio=0.5,
+                       n_threads=None):
+        self.index_dir = index_dir
+        self.mask_file = os.path.join(index_dir,"mask.nii.gz")
+        self.current_file = os.path.join(index_dir,"current.json")
+        self.compact_ratio = compact_ratio
+        self.n_threads = n_threads
+        self.lock = threading.RLock()
+        self.write_lock = threading.RLock()
+        if mask is not None and not isinstance(mask,Mask):
+            mask = Mask(mask)
+
+        if os.path.exists(self.current_file):
+            stored_mask = Mask(self.mask_file)
+            if mask is not None and mask.key != stored_mask.key:
+                raise ValueError("Mask does not match the mask of the index at %s" %(index_dir))
+            self.mask = stored_mask
+        else:
+            if mask is None:
+                raise ValueError("A mask is required to create an index")
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            nibabel.save(mask.to_nifti(),self.mask_file)
+            self.mask = mask
+            VoxelStore(self.get_generation_dir(0),mask=mask,chunk_size=chunk_size)
+            self.save_current(0)
+        self.open_generation()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self,image_id):
+        return str(image_id) in self.records
+
+    @property
+    def ids(self):
+        '''Ids of the images in the index, in the order of their rows'''
+        with self.lock:
+            return sorted(self.records,key=lambda x: self.records[x]["row"])
+
+    @property
+    def number_rows(self):
+        return len(self.store)
+
+    @property
+    def dead_rows(self):
+        '''Rows of images replaced or removed, until compaction'''
+        return len(self.store) - len(self.records)
+
+    def get_generation_dir(self,generation):
+        return os.path.join(self.index_dir,"generation_%05d" %(generation))
+
+    def save_current(self,generation):
+        with open(self.current_file + ".tmp","w") as filey:
+            json.dump({"generation":generation},filey)
+        os.replace(self.current_file + ".tmp",self.current_file)
+
+    def get_current(self):
+        with open(self.current_file,"r") as filey:
+            return json.load(filey)["generation"]
+
+    def open_generation(self):
+        '''Open the current generation, and replay its log'''
+        with self.lock:
+            self.generation = self.get_current()
+            generation_dir = self.get_generation_dir(self.generation)
+            self.log_file = os.path.join(generation_dir,"log.jsonl")
+            self.log_offset = 0
+            self.logged_rows = 0
+            self.records = dict()
+            self.corpus = None
+            self.read_log()
+            self.store = VoxelStore(generation_dir,mask=self.mask)
+
+    def read_log(self):
+        '''Apply the lines of the log written since it was last read. A
+        last line without its newline is being written, and is left.'''
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file,"rb") as filey:
+            filey.seek(self.log_offset)
+            lines = filey.read()
+        end = lines.rfind(b"\n") + 1
+        self.log_offset += end
+        for line in lines[0:end].decode("utf-8").splitlines():
+            if line.strip():
+                self.apply(json.loads(line))
+
+    def apply(self,entry):
+        '''Apply one log entry to the records of the images'''
+        if entry["op"] == "add":
+            self.records[entry["id"]] = {"row":entry["row"],
+                                         "fingerprint":entry["fingerprint"],
+                                         "file":entry.get("file")}
+            self.logged_rows = max(self.logged_rows,entry["row"] + 1)
+        elif entry["op"] == "remove":
+            self.records.pop(entry["id"],None)
+        elif entry["op"] == "touch":
+            self.records[entry["id"]]["file"] = entry["file"]
+
+    def write_log(self,entries):
+        '''Append entries to the log (flushed to disk), and apply them'''
+        with open(self.log_file,"ab") as filey:
+            for entry in entries:
+                filey.write((json.dumps(entry) + "\n").encode("utf-8"))
+            filey.flush()
+            os.fsync(filey.fileno())
+            self.log_offset = filey.tell()
+        for entry in entries:
+            self.apply(entry)
+
+    def refresh(self):
+        '''Pick up changes written by another process'''
+        with self.write_lock, self.lock:
+            if self.get_current() != self.generation:
+                self.open_generation()
+            else:
+                self.read_log()
+                self.store = VoxelStore(self.store.store_dir,mask=self.mask)
+
+    def add(self,images,image_ids=None,replace=True):
+        '''add
+        Add images, or replace the images of ids already in the index
+
+        images: image files, nibabel images (in the index mask), or masked
+            vectors (a 2D array, images in rows)
+        image_ids: ids for the images [default, the file names for files]
+        replace: replace images already in the index [default True], else
+            an id already in the index is an error
+
+        Images with the same content as the image already under their id
+        are left. Returns the ids of the images added or replaced.
+        '''
+        if isinstance(images,(str,nibabel.nifti1.Nifti1Image)) or \
+           (isinstance(images,np.ndarray) and images.ndim == 1):
+            images = [images]
+        if image_ids is None:
+            if not all(isinstance(image,str) for image in images):
+                raise ValueError("image_ids are required for images that are not files")
+            image_ids = list(images)
+        image_ids = [str(image_id) for image_id in image_ids]
+        if len(image_ids) != len(images):
+            raise ValueError("Number of image_ids must equal number of images")
+        if len(set(image_ids)) != len(image_ids):
+            raise ValueError("Image ids must be unique")
+
+        # Records only change in writers (holding write_lock), so they are
+        # read here without the lock queries take
+        with self.write_lock:
+            changed = []
+            entries = []
+            for image,image_id in zip(images,image_ids):
+                if image_id in self.records and not replace:
+                    raise ValueError("Image %s is already in the index" %(image_id))
+                fingerprint,file_key = get_fingerprint(image)
+                record = self.records.get(image_id)
+                if record is not None and record["fingerprint"] == fingerprint:
+                    if file_key is not None and record["file"] != file_key:
+                        entries.append({"op":"touch","id":image_id,"file":file_key})
+                    continue
+                changed.append((image,image_id,fingerprint,file_key))
+
+            # Rows past the log are not read by queries until it names them
+            start = len(self.store)
+            if len(changed) > 0:
+                self.store.append([x[0] for x in changed],
+                                  image_ids=[str(row) for row in range(start,start + len(changed))])
+            entries += [{"op":"add","id":image_id,"row":start + i,
+                         "fingerprint":fingerprint,"file":file_key}
+                        for i,(image,image_id,fingerprint,file_key) in enumerate(changed)]
+            if len(entries) > 0:
+                with self.lock:
+                    self.write_log(entries)
+            self.check_compact()
+            return [x[1] for x in changed]
+
+    def update(self,images,image_ids=None):
+        '''Replace images already in the index (or add them)'''
+        return self.add(images,image_ids=image_ids,replace=True)
+
+    def remove(self,image_ids):
+        '''Remove images from the index (tombstones until compaction)'''
+        if isinstance(image_ids,str):
+            image_ids = [image_ids]
+        with self.write_lock:
+            image_ids = [str(x) for x in image_ids if str(x) in self.records]
+            if len(image_ids) > 0:
+                with self.lock:
+                    self.write_log([{"op":"remove","id":image_id} for image_id in image_ids])
+                self.check_compact()
+            return image_ids
+
+    def index_directory(self,directory,pattern="*.nii*",remove_missing=True):
+        '''index_directory
+        Bring the index up to date with the image files in a directory. Ids
+        are the file paths relative to the directory. Files with the same
+        size and modification time as when they were indexed are not read,
+        and files with the same content are not masked again.
+
+        pattern: glob pattern of the image files [default *.nii*]
+        remove_missing: remove images of files from the directory that no
+            longer exist [default True]
+
+        Returns the ids added, updated, removed and unchanged
+        '''
+        files = sorted(glob(os.path.join(directory,pattern)))
+        image_ids = [os.path.relpath(x,directory) for x in files]
+        summary = {"added":[],"updated":[],"removed":[],"unchanged":[]}
+        with self.write_lock:
+            to_check = []
+            for filename,image_id in zip(files,image_ids):
+                record = self.records.get(image_id)
+                if record is not None and record["file"] == get_file_key(filename):
+                    summary["unchanged"].append(image_id)
+                else:
+                    to_check.append((filename,image_id))
+
+            existed = set(x[1] for x in to_check if x[1] in self.records)
+            changed = set(self.add([x[0] for x in to_check],[x[1] for x in to_check]))
+            for filename,image_id in to_check:
+                if image_id not in changed:
+                    summary["unchanged"].append(image_id)
+                elif image_id in existed:
+                    summary["updated"].append(image_id)
+                else:
+                    summary["added"].append(image_id)
+
+            if remove_missing:
+                prefix = os.path.abspath(directory) + os.sep
+                current = set(image_ids)
+                missing = [x for x,record in self.records.items()
+                           if x not in current and record["file"] is not None and
+                           record["file"][0].startswith(prefix)]
+                summary["removed"] = self.remove(missing)
+        return summary
+
+    def check_compact(self):
+        if self.compact_ratio is not None and \
+           self.dead_rows > self.compact_ratio * max(len(self.store),1):
+            self.compact()
+
+    def compact(self):
+        '''compact
+        Copy the rows of the images in the index to a new generation, with a
+        new log, and make it current. The generation before the previous one
+        is deleted, the previous one is kept for snapshots still reading it.
+        '''
+        with self.write_lock, self.lock:
+            self.refresh()
+            ids = self.ids
+            generation = self.generation + 1
+            generation_dir = self.get_generation_dir(generation)
+            if os.path.exists(generation_dir):
+                shutil.rmtree(generation_dir)
+            store = VoxelStore(generation_dir,mask=self.mask,chunk_size=self.store.chunk_size)
+            for start in range(0,len(ids),store.chunk_size):
+                block = ids[start:start + store.chunk_size]
+                rows = [self.records[x]["row"] for x in block]
+                store.append(self.store.get_rows(rows),
+                             image_ids=[str(row) for row in range(start,start + len(block))])
+
+            entries = [{"op":"add","id":image_id,"row":row,
+                        "fingerprint":self.records[image_id]["fingerprint"],
+                        "file":self.records[image_id]["file"]}
+                       for row,image_id in enumerate(ids)]
+            with open(os.path.join(generation_dir,"log.jsonl"),"wb") as filey:
+                for entry in entries:
+                    filey.write((json.dumps(entry) + "\n").encode("utf-8"))
+                filey.flush()
+                os.fsync(filey.fileno())
+            self.save_current(generation)
+            self.open_generation()
+
+            for old in range(generation - 1):
+                if os.path.exists(self.get_generation_dir(old)):
+                    shutil.rmtree(self.get_generation_dir(old))
+
+    def get_corpus(self):
+        '''The ImageCorpus of the rows of the current generation named in
+        the log, made once and extended (a store chunk at a time) with rows
+        logged since'''
+        with self.lock:
+            number = self.logged_rows
+            chunk_size = self.store.chunk_size
+            if self.corpus is None:
+                end = min(chunk_size,number)
+                self.corpus = ImageCorpus(self.store.get_rows(slice(0,end)),
+                                          mask=self.mask_file,
+                                          image_ids=[str(x) for x in range(end)],
+                                          n_threads=self.n_threads)
+            for start in range(len(self.corpus),number,chunk_size):
+                end = min(start + chunk_size,number)
+                self.corpus.append(self.store.get_rows(slice(start,end)),
+                                   image_ids=[str(x) for x in range(start,end)])
+            return self.corpus
+
+    def snapshot(self):
+        '''An IndexSnapshot of the images in the index now'''
+        with self.lock:
+            ids = self.ids
+            rows = np.array([self.records[x]["row"] for x in ids],dtype=np.int64)
+            return IndexSnapshot(self.get_corpus(),ids,rows,self.generation)
+
+    def score(self,query):
+        '''Ids of the images in the index, and their scores for a query'''
+        snapshot = self.snapshot()
+        return snapshot.image_ids,snapshot.score(query)
+
+    def search(self,query,max_results=10,absolute_value=True,exclude=None):
+        '''Ids and scores of the images most similar to a query'''
+        return self.snapshot().search(query,max_results=max_results,
+                                      absolute_value=absolute_value,
+                                      exclude=exclude)
+
+
+class IndexSnapshot(object):
+    '''
+    The images of a CorpusIndex at one moment, to score queries against
+
+    corpus: ImageCorpus holding (at least) the rows
+    image_ids: ids of the images
+    rows: rows of the images in the corpus
+    generation: generation of the index the rows are of
+    '''
+
+    def __init__(self, corpus, image_ids, rows, generation):
+        self.corpus = corpus
+        self.image_ids = list(image_ids)
+        self.rows = rows
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def score(self,query):
+        '''Pairwise deletion pearson of a query with each image, in the
+        order of image_ids (as ImageCorpus.score)'''
+        query,query_valid = self.corpus.prepare_query(query)
+        return self.corpus.score_rows(self.rows,query,query_valid)[0]
+
+    def search(self,query,max_results=10,absolute_value=True,exclude=None):
+        '''Ids and scores of the max_results images most similar to a query,
+        best first, leaving out the ids in exclude'''
+        scores = self.score(query)
+        exclude = [] if exclude is None else [str(x) for x in exclude]
+        positions = [i for i,x in enumerate(self.image_ids) if x in exclude]
+        top = rank_top_scores(scores,max_results=max_results,
+                              absolute_value=absolute_value,exclude=positions)
+        return [self.image_ids[i] for i in top],scores[top]
+
+    def similarity_search(self,query,query_id,tags,png_paths,**kwargs):
+        '''similarity_search
+        Render the scores of a query with search.similarity_search. tags
+        and png_paths are dictionaries by image id, query_id must be in the
+        snapshot, other arguments are passed on.
+        '''
+        return similarity_search(image_scores=self.score(query),
+                                 tags=[tags[x] for x in self.image_ids],
+                                 png_paths=[png_paths[x] for x in self.image_ids],
+                                 query_id=str(query_id),
+                                 image_ids=self.image_ids,
+                                 **kwargs)
+
+
+def get_file_key(filename):
+    '''Absolute path, size and modification time of a file'''
+    stat = os.stat(filename)
+    return [os.path.abspath(filename),stat.st_size,stat.st_mtime]
+
+
+def get_fingerprint(image):
+    '''Content fingerprint of an image (file, nibabel image or masked
+    vector), and the file key (see get_file_key) for files'''
+    if isinstance(image,np.ndarray):
+        vector = np.ascontiguousarray(image,dtype=np.float32)
+        return hashlib.sha1(vector.tobytes()).hexdigest(),None
+    file_key = get_file_key(image) if isinstance(image,str) else None
+    return get_image_fingerprint(get_nii_obj(image)[0]),file_key
@@ -14,16 +14,29 @@ from .mrutils import (
     apply_threshold,
     do_mask,
     generate_thresholds,
+    get_atlas_vector,
+    get_image_data,
     resample_images_ref
 )
-from scipy.stats import pearsonr, spearmanr, norm, t
+from pybraincompare.template.futils import get_name
+from scipy.stats import pearsonr, spearmanr, rankdata, norm, t
+from scipy.special import gammaln, log_ndtr
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from . import maths
+import collections
+import argparse
+import hashlib
 import pandas
 import nibabel
 import sys
 import os
 
+try:
+    from scipy.special import ndtri_exp
+except ImportError:
+    ndtri_exp = None
+
 
 def percent_to_float(x):
     return old_div(float(x.strip('%')),100)
@@ -62,8 +75,8 @@ def calculate_correlation(images,
 
     # No mask means we include all voxels, including outside brain
     else:
-        masked =  np.vstack((np.array(images[0].get_data().flatten()),
-                             np.array(images[1].get_data().flatten())))
+        masked =  np.vstack((get_image_data(images[0]).ravel(),
+                             get_image_data(images[1]).ravel()))
 
     # A return value of "nan" indicates that there was not overlap
     if np.isnan(masked).all():
@@ -77,18 +90,18 @@ def calculate_correlation(images,
                                                   corr_type=corr_type)
 
         else:  
-            atlas_nii = nibabel.load(atlas.file)
-
-            if not (atlas_nii.get_affine() == images[0].get_affine()).all():  
-                atlas_nii, _ = resample_images_ref(images=atlas.file,
-                                                   reference=images[0],
-                                                   interpolation="nearest")
-
-            atlas_vector = do_mask(atlas_nii,mask=mask)[0]
-            atlas_labels =  ['"%s"' %(atlas.labels[str(int(x))].label) 
-                             for x in atlas_vector]
-            atlas_colors = ['"%s"' %(atlas.color_lookup[x.replace('"',"")]) 
-                             for x in atlas_labels]
+            # Cached per atlas, image grid and mask (see get_atlas_vector)
+            atlas_vector = get_atlas_vector(atlas.file,
+                                            reference=images[0],
+                                            mask=mask)
+
+            # One label and color per region, not per voxel
+            atlas_labels = dict()
+            atlas_colors = dict()
+            for x in np.unique(atlas_vector[~np.isnan(atlas_vector)]):
+                label = atlas.labels[str(int(x))].label
+                atlas_labels[int(x)] = '"%s"' %(label)
+                atlas_colors[int(x)] = '"%s"' %(atlas.color_lookup[label])
 
             # Need to check here if we have overlap!
 
@@ -108,7 +121,10 @@ def calculate_correlation(images,
 def calculate_pairwise_correlation(image_vector1,
                                    image_vector2,
                                    corr_type="pearson",
-                                   atlas_vector=None):   
+                                   atlas_vector=None,
+                                   image_ids=None,
+                                   mask_key=None,
+                                   rank_cache=None):   
 
     '''calculate_pairwise_correlation
     Calculate a correlation value for two vectors
@@ -116,11 +132,21 @@ def calculate_pairwise_correlation(image_vector1,
     image_vector1,image_vector2: vectors of equal length with image values
     
     corr_type: 
-        correlation type [default pearson]
+        correlation type [default pearson], or the name of another metric
+        in pybraincompare.compare.metrics (whole brain only)
     
     atlas_vector: 
         single vector of region labels strings [optional]
 
+    image_ids:
+        ids of the two images [optional]. For a whole brain spearman, the 
+        ranks of each image are then reused from a RankCache (see
+        calculate_cached_spearman). The correlation is the same as without
+        ids, over all values (no deletion of zeros, nan if there are nans)
+
+    mask_key, rank_cache:
+        passed on to calculate_cached_spearman when image_ids are given
+
     If an atlas_vector is supplied, returns dictionary with atlas labels
     If not, returns single correlation value
     '''
@@ -129,26 +155,290 @@ def calculate_pairwise_correlation(image_vector1,
 
     # If we have atlas labels, return vector with labels
     if atlas_vector is not None:
-        labs = np.unique(atlas_vector)
-        for l in labs:
-            if corr_type == "spearman": 
-                corr,pval = spearmanr(image_vector1[np.where(atlas_vector == l)[0]],
-                              image_vector2[np.where(atlas_vector == l)[0]])
-                correlations[str(int(l))] = corr
-            elif corr_type == "pearson": 
-                corr,pval = pearsonr(image_vector1[np.where(atlas_vector == l)[0]],
-                              image_vector2[np.where(atlas_vector == l)[0]])        
-                correlations[str(int(l))] = corr
+        labels,corrs = calculate_regional_correlation(image_vector1,
+                                                      image_vector2,
+                                                      atlas_vector,
+                                                      corr_type=corr_type)
+        for l,corr in zip(labels,corrs):
+            correlations[str(int(l))] = corr
 
     else:
         if corr_type == "pearson": 
             corr,pval = pearsonr(image_vector1, image_vector2)
             correlations = corr
+        elif corr_type == "spearman" and image_ids is not None:
+            correlations = calculate_cached_spearman(image_vector1,
+                                                     image_vector2,
+                                                     image_ids=image_ids,
+                                                     mask_key=mask_key,
+                                                     rank_cache=rank_cache,
+                                                     pairwise_deletion=False)
         elif corr_type == "spearman": 
             corr,pval = spearmanr(image_vector1, image_vector2)
             correlations = corr 
+
+        # Any other metric registered in pybraincompare.compare.metrics
+        else:
+            from .metrics import calculate_metrics
+            correlations = calculate_metrics(image_vector1,
+                                             image_vector2,
+                                             metrics=[corr_type])[corr_type]
     return correlations
 
+
+class RankCache(object):
+    '''
+    Bounded cache of ranked image vectors, keyed by image id, a key for the
+    mask the vector was taken from, the deletion rule and a hash of the
+    values (so an id given new values is ranked again). Ranks are computed
+    once over the valid values of an image, so comparing one image to many
+    others does not rank it again.
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_ranks(self,image_id,vector,mask_key=None,pairwise_deletion=True):
+        '''get_ranks
+        Return ranks of the valid (nonzero, non-nan) values of a vector (0
+        elsewhere) and the boolean vector of valid values. If
+        pairwise_deletion is False, every value is valid. If image_id is
+        None, the ranks are computed and not cached.
+        '''
+        vector = np.asarray(vector)
+        if pairwise_deletion:
+            valid = (vector != 0) & ~np.isnan(vector)
+        else:
+            valid = np.ones(len(vector),dtype=bool)
+        if image_id is None:
+            return rank_vector(vector,valid), valid
+
+        content = hashlib.sha1(np.ascontiguousarray(vector).tobytes()).hexdigest()
+        key = (image_id,mask_key,pairwise_deletion,str(vector.dtype),content)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        ranks = rank_vector(vector,valid)
+        self.entries[key] = (ranks,valid)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return ranks, valid
+
+    def clear(self):
+        self.entries.clear()
+
+
+# Default cache used when a rank_cache is not given
+rank_cache = RankCache()
+
+
+def rank_vector(vector,valid):
+    '''Average ranks of the valid values of a vector, 0 elsewhere'''
+    ranks = np.zeros(len(vector))
+    ranks[valid] = rankdata(vector[valid])
+    return ranks
+
+
+def deletion_adjusted_ranks(ranks,vector,keep,removed):
+    '''deletion_adjusted_ranks
+    Ranks of vector[keep] among themselves, given ranks over keep + removed.
+    Only the removed values are sorted: each kept rank is lowered by the 
+    number of removed values below it (and half of those tied with it),
+    which gives the same average ranks as re-ranking vector[keep].
+    '''
+    kept_ranks = ranks[keep]
+    if not removed.any():
+        return kept_ranks
+    removed_values = np.sort(vector[removed])
+    kept_values = vector[keep]
+    less = np.searchsorted(removed_values,kept_values,side="left")
+    less_equal = np.searchsorted(removed_values,kept_values,side="right")
+    return kept_ranks - less - 0.5*(less_equal - less)
+
+
+def calculate_cached_spearman(image_vector1,
+                              image_vector2,
+                              image_ids,
+                              mask_key=None,
+                              rank_cache=None,
+                              pairwise_deletion=True):
+
+    '''calculate_cached_spearman
+    Spearman correlation of two image vectors with pairwise deletion of 
+    zeros and nans, as a pearson correlation over cached ranks. If
+    pairwise_deletion is False, all values are ranked (as spearmanr), and
+    vectors with nans give nan.
+
+    image_vector1,image_vector2: vectors of equal length with image values
+
+    image_ids: list
+        ids of the two images, used (with mask_key) to look up ranks
+
+    mask_key: 
+        any hashable naming the mask the vectors come from [optional]
+
+    rank_cache: RankCache
+        cache to use [default is the module rank_cache]
+    '''
+    if rank_cache is None:
+        rank_cache = maths.rank_cache
+
+    image_vector1 = np.asarray(image_vector1)
+    image_vector2 = np.asarray(image_vector2)
+    if not pairwise_deletion and \
+       (np.isnan(image_vector1).any() or np.isnan(image_vector2).any()):
+        return np.nan
+    ranks1,valid1 = rank_cache.get_ranks(image_ids[0],image_vector1,mask_key,
+                                         pairwise_deletion)
+    ranks2,valid2 = rank_cache.get_ranks(image_ids[1],image_vector2,mask_key,
+                                         pairwise_deletion)
+
+    return calculate_ranked_spearman(ranks1,image_vector1,valid1,
+                                     ranks2,image_vector2,valid2)
+
+
+def calculate_ranked_spearman(ranks1,image_vector1,valid1,
+                              ranks2,image_vector2,valid2):
+    '''calculate_ranked_spearman
+    Spearman correlation of two image vectors with pairwise deletion, from
+    the ranks of each vector over its own valid values (see rank_vector).
+    Only the values deleted from each vector are sorted.
+    '''
+    keep = valid1 & valid2
+    if keep.sum() < 2:
+        return np.nan
+
+    ranks1 = deletion_adjusted_ranks(ranks1,image_vector1,keep,valid1 & ~valid2)
+    ranks2 = deletion_adjusted_ranks(ranks2,image_vector2,keep,valid2 & ~valid1)
+    corr,pval = pearsonr(ranks1,ranks2)
+    return corr
+
+def calculate_regional_correlation(image_vector1,
+                                   image_vector2,
+                                   atlas_vector,
+                                   corr_type="pearson"):
+
+    '''calculate_regional_correlation
+    Calculate a correlation for every region of an atlas in one pass
+
+    image_vector1,image_vector2: vectors of equal length with image values
+
+    atlas_vector:
+        vector of region labels, same length as the image vectors
+
+    corr_type: str
+        pearson or spearman [default pearson]
+
+    Regions are mapped to integer codes, and the moments for every region
+    are accumulated together with np.bincount, so the cost does not grow
+    with the number of regions. Spearman is a pearson over ranks computed
+    within each region (ties get the average rank, as in scipy).
+
+    Returns the sorted unique labels and a vector of correlations, one per
+    label. Regions with fewer than two values, constant values, or any nan
+    have a correlation of nan.
+    '''
+    x = np.asarray(image_vector1,dtype=np.float64)
+    y = np.asarray(image_vector2,dtype=np.float64)
+    labels,codes = np.unique(np.asarray(atlas_vector),return_inverse=True)
+    codes = codes.ravel()
+    n_regions = len(labels)
+
+    # Any non finite value means the region correlation is undefined
+    finite = np.isfinite(x) & np.isfinite(y)
+    bad = np.bincount(codes,weights=~finite,minlength=n_regions) > 0
+
+    if corr_type == "spearman":
+        x = _grouped_rankdata(np.where(finite,x,0),codes)
+        y = _grouped_rankdata(np.where(finite,y,0),codes)
+    elif corr_type != "pearson":
+        raise ValueError("corr_type must be pearson or spearman")
+
+    counts = np.bincount(codes,minlength=n_regions).astype(np.float64)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        mean_x = np.bincount(codes,weights=x,minlength=n_regions) / counts
+        mean_y = np.bincount(codes,weights=y,minlength=n_regions) / counts
+        dx = x - mean_x[codes]
+        dy = y - mean_y[codes]
+        sxy = np.bincount(codes,weights=dx*dy,minlength=n_regions)
+        sxx = np.bincount(codes,weights=dx*dx,minlength=n_regions)
+        syy = np.bincount(codes,weights=dy*dy,minlength=n_regions)
+        corrs = sxy / np.sqrt(sxx*syy)
+
+    corrs = np.clip(corrs,-1.0,1.0)
+    corrs[bad | (counts < 2)] = np.nan
+    return labels,corrs
+
+
+def _grouped_rankdata(values,codes):
+    '''Rank values within each group of codes, ties get the average rank'''
+    n = len(values)
+    if n == 0:
+        return np.zeros(0)
+    order = np.lexsort((values,codes))
+    sorted_values = values[order]
+    sorted_codes = codes[order]
+    position = np.arange(n)
+
+    # Position of each value within its group (1 based)
+    new_group = np.ones(n,dtype=bool)
+    new_group[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    group_start = np.maximum.accumulate(np.where(new_group,position,0))
+    ordinal = position - group_start + 1
+
+    # Runs of tied values share the average of their ordinal ranks
+    new_run = new_group.copy()
+    new_run[1:] |= sorted_values[1:] != sorted_values[:-1]
+    run_id = np.cumsum(new_run) - 1
+    run_sizes = np.bincount(run_id)
+    average = ordinal[new_run] + (run_sizes - 1) / 2.0
+
+    ranks = np.empty(n)
+    ranks[order] = average[run_id]
+    return ranks
+
+
+def _pairwise_deletion_correlation(values_a,valid_a,values_b,valid_b):
+    '''Pearson correlation between all rows of two matrices, where each 
+    pair only uses voxels valid in both rows (pairwise deletion).
+
+    values_a,values_b: 2D arrays (images x voxels), zero where not valid
+    valid_a,valid_b: 2D arrays of the same shape, 1 where valid, 0 if not
+
+    The moments of every pair are matrix products of the values and the 
+    validity masks, so all pairs are done in three BLAS calls. Returns the 
+    correlation matrix (rows of a by rows of b) and the overlap counts.
+    '''
+    right = np.vstack((valid_b,values_b,values_b*values_b)).T
+    n_b = valid_b.shape[0]
+
+    # [N, Sb, Sbb] from the validity of a, [Sa, Sab] from values of a
+    moments_valid = np.dot(valid_a,right).astype(np.float64)
+    moments_values = np.dot(values_a,right[:,0:2*n_b]).astype(np.float64)
+    sum_aa = np.dot(values_a*values_a,right[:,0:n_b]).astype(np.float64)
+
+    counts = moments_valid[:,0:n_b]
+    sum_b = moments_valid[:,n_b:2*n_b]
+    sum_bb = moments_valid[:,2*n_b:]
+    sum_a = moments_values[:,0:n_b]
+    sum_ab = moments_values[:,n_b:]
+
+    with np.errstate(divide="ignore",invalid="ignore"):
+        cov = sum_ab - sum_a*sum_b/counts
+        var_a = sum_aa - sum_a*sum_a/counts
+        var_b = sum_bb - sum_b*sum_b/counts
+        corrs = cov / np.sqrt(var_a*var_b)
+
+    corrs = np.clip(corrs,-1.0,1.0)
+    corrs[(counts < 2) | (var_a <= 0) | (var_b <= 0)] = np.nan
+    return corrs,counts.astype(np.int64)
+
+
 def calculate_atlas_correlation(image_vector1,
                                 image_vector2,
                                 atlas_vector,
@@ -165,6 +455,10 @@ def calculate_atlas_correlation(image_vector1,
     
     atlas_vector: 
         vector of atlas labels same length as image vector
+
+    atlas_labels, atlas_colors:
+        dictionaries with the region name and color for each atlas value,
+        or (as before) vectors with a name and color for every voxel
     
     corr_type: str
         pearson or spearman
@@ -181,35 +475,267 @@ def calculate_atlas_correlation(image_vector1,
     ATLAS_CORR: the regional correlation for some point in input data 1 or 2
     ATLAS_COLOR: a hex value to render in the final d3
 
+    Regions are carried as integer codes, ATLAS_LABELS and ATLAS_COLORS
+    are pandas categoricals (one string per region, not per voxel).
+
     If summary == True
     returns only region labels and corresponding correlations
     '''
+    atlas_vector = np.asarray(atlas_vector)
+    labels,first,codes = np.unique(atlas_vector,return_index=True,
+                                   return_inverse=True)
+    codes = codes.ravel()
+    region_labels = _region_values(atlas_labels,labels,first)
+    region_colors = _region_values(atlas_colors,labels,first)
+
+    _,corrs = calculate_regional_correlation(image_vector1,image_vector2,
+                                             codes,corr_type=corr_type)
+
+    if summary == True:
+        order = np.argsort(first)
+        regional = pandas.DataFrame(index=first[order])
+        regional["ATLAS_LABELS"] = region_labels[order]
+        regional["ATLAS_CORR"] = corrs[order]
+        return regional.drop_duplicates()
 
     df = pandas.DataFrame()
     df["INPUT_DATA_ONE"] = image_vector1
     df["INPUT_DATA_TWO"] = image_vector2
     df["ATLAS_DATA"] = atlas_vector  
-    df["ATLAS_LABELS"] = atlas_labels   
-  
-    corrs = calculate_pairwise_correlation(image_vector1,image_vector2,
-                                           atlas_vector=atlas_vector,
-                                           corr_type=corr_type)
+    df["ATLAS_LABELS"] = _region_categorical(region_labels,codes)
+    df["ATLAS_CORR"] = corrs[codes]
+    df["ATLAS_COLORS"] = _region_categorical(region_colors,codes)
+    return df
 
-    df["ATLAS_CORR"] = [corrs[str(int(x))] for x in atlas_vector]
-    df["ATLAS_COLORS"] = atlas_colors   
-  
-    if summary == False: 
-        return df
-    else:
-        regional = df.copy()
-        regional = regional.loc[:,regional.columns[3:5]]
-        regional = regional.drop_duplicates()
-    return regional
+
+def _region_values(lookup,labels,first):
+    '''One value per region, from a dictionary keyed by atlas value, or
+    from a per voxel vector (the value at the first voxel of the region)'''
+    if isinstance(lookup,dict):
+        return np.array([lookup[int(l)] for l in labels],dtype=object)
+    return np.asarray(lookup,dtype=object)[first]
+
+
+def _region_categorical(region_values,codes):
+    '''Per voxel categorical from integer region codes'''
+    if len(set(region_values)) == len(region_values):
+        return pandas.Categorical.from_codes(codes,categories=region_values)
+    return region_values[codes]
   
 
-def do_multi_correlation(image_df,corr_type="pearson"):
-    '''comparison for an entire pandas data frame'''
-    return image_df.corr(method=corr_type, min_periods=1)
+def do_multi_correlation(image_df,corr_type="pearson",pairwise_deletion=False,
+                         exact_spearman=False,return_counts=False):
+    '''comparison for an entire pandas data frame (images in columns)
+
+    If pairwise_deletion is True, zeros and nans are both missing. Pearson
+    and spearman matrices then come from calculate_correlation_matrix (with
+    exact_spearman), and other methods from pandas with zeros set to nan.
+    If False (default), pandas is used (only nans are missing).
+
+    return_counts: also return a data frame of the number of voxels each
+        pair is correlated over
+    '''
+    if pairwise_deletion:
+        if corr_type in ["pearson","spearman"]:
+            corrs,counts = calculate_correlation_matrix(image_df,corr_type=corr_type,
+                                                        exact_spearman=exact_spearman)
+            if return_counts:
+                return corrs,counts
+            return corrs
+        image_df = image_df.replace(0,np.nan)
+    corrs = image_df.corr(method=corr_type, min_periods=1)
+    if return_counts:
+        present = image_df.notnull().values.astype(np.float32)
+        counts = pandas.DataFrame(present.T.dot(present).astype(np.int64),
+                                  index=image_df.columns,columns=image_df.columns)
+        return corrs,counts
+    return corrs
+
+
+def calculate_correlation_matrix(image_df,
+                                 corr_type="pearson",
+                                 block_size=1024,
+                                 exact_spearman=False):
+
+    '''calculate_correlation_matrix
+    Correlation matrix for all pairs of images with pairwise deletion of
+    zeros and nans (the rule of make_binary_deletion_mask)
+
+    image_df: pandas data frame
+        voxels in rows, images in columns (as for do_multi_correlation)
+
+    corr_type: str
+        pearson or spearman [default pearson]
+
+    block_size: int
+        number of images per block of the matrix products
+
+    The images are held as a float32 matrix of values, zero where missing,
+    and a matrix of validity masks. The moments of every pair come from
+    matrix products of the two (see _pairwise_deletion_correlation), done
+    block by block for the upper triangle. For spearman the products are
+    done on the ranks of each image over its own valid voxels, so a pair
+    that loses voxels to deletion is a pearson of those ranks over the
+    overlap, not re-ranked: close to, but not exactly, its spearman.
+
+    exact_spearman: bool
+        re-rank the pairs that lose voxels to deletion, exactly (see
+        calculate_ranked_spearman) [default False]. This is one step per
+        pair, not a matrix product, and real maps with different coverage
+        almost all lose voxels: for thousands of images it takes hours.
+
+    Returns a data frame of correlations and a data frame of the number of
+    overlapping voxels for each pair.
+    '''
+    names = image_df.columns
+    values = np.array(image_df.values.T,dtype=np.float32)
+    valid = (values != 0) & ~np.isnan(values)
+    values[~valid] = 0
+    number_images = values.shape[0]
+
+    if corr_type == "spearman":
+        if exact_spearman:
+            raw = values.copy()
+        rank_moments = np.ones((number_images,2))
+        for i in range(number_images):
+            if valid[i].any():
+                ranks = rankdata(values[i][valid[i]])
+                std = ranks.std()
+                rank_moments[i] = ranks.mean(),(std if std > 0 else 1)
+                values[i][valid[i]] = ranks
+    elif corr_type != "pearson":
+        raise ValueError("corr_type must be pearson or spearman")
+    standardize_vectors(values,valid)
+
+    corrs = np.empty((number_images,number_images))
+    counts = np.empty((number_images,number_images),dtype=np.int64)
+    for start in range(0,number_images,block_size):
+        end = min(start + block_size, number_images)
+        valid_block = valid[start:end].astype(np.float32)
+        for other in range(start,number_images,block_size):
+            other_end = min(other + block_size, number_images)
+            block,overlap = _pairwise_deletion_correlation(values[start:end],
+                                valid_block,
+                                values[other:other_end],
+                                valid[other:other_end].astype(np.float32))
+            corrs[start:end,other:other_end] = block
+            corrs[other:other_end,start:end] = block.T
+            counts[start:end,other:other_end] = overlap
+            counts[other:other_end,start:end] = overlap.T
+
+    if corr_type == "spearman" and exact_spearman:
+        # The ranks of each image come back from its standardized ranks
+        # (average ranks are multiples of 0.5), so they are not kept twice
+        def get_ranks(i):
+            ranks = np.zeros(values.shape[1])
+            mean,std = rank_moments[i]
+            ranks[valid[i]] = np.round(2*(values[i][valid[i]]*std + mean)) / 2
+            return ranks
+        number_valid = valid.sum(axis=1)
+        deleted = (counts != number_valid[:,np.newaxis]) | \
+                  (counts != number_valid[np.newaxis,:])
+        first,second = np.where(np.triu(deleted & (counts >= 2),1))
+        for i in np.unique(first):
+            ranks = get_ranks(i)
+            for j in second[first == i]:
+                corrs[i,j] = corrs[j,i] = calculate_ranked_spearman(ranks,raw[i],valid[i],
+                                                                    get_ranks(j),raw[j],valid[j])
+
+    corrs = pandas.DataFrame(corrs,index=names,columns=names)
+    counts = pandas.DataFrame(counts,index=names,columns=names)
+    return corrs,counts
+
+
+def calculate_threshold_sweep(image_vector1,
+                              image_vector2,
+                              thresholds=None,
+                              direction="posneg"):
+
+    '''calculate_threshold_sweep
+    Pearson correlation of two images thresholded at every level, the same
+    as apply_threshold on both images followed by pairwise deletion of
+    zeros and nans, without making a thresholded image for each level
+
+    image_vector1,image_vector2: vectors of equal length with image values
+
+    thresholds: list
+        threshold values [default generate_thresholds(), 0 to 4 by 0.01]
+
+    direction: str
+        posneg: voxels where both absolute values are >= threshold [default]
+        pos: voxels where both values are >= threshold
+        neg: voxels where both values are <= threshold
+
+    A voxel survives a threshold when the weaker of its two values passes,
+    so voxels are sorted once by that value, and the moments of every
+    threshold come from cumulative sums over the sorted voxels.
+
+    Returns a data frame with the threshold, the correlation, and the
+    number of overlapping voxels. Correlations of fewer than two voxels, or
+    of constant values, are nan.
+    '''
+    if thresholds is None:
+        thresholds = generate_thresholds()
+    thresholds = np.asarray(thresholds,dtype=np.float64)
+    x = np.asarray(image_vector1,dtype=np.float64).ravel()
+    y = np.asarray(image_vector2,dtype=np.float64).ravel()
+
+    keep = (x != 0) & (y != 0) & ~np.isnan(x) & ~np.isnan(y)
+    x, y = x[keep], y[keep]
+
+    # Sort voxels by decreasing score, a voxel survives if score >= level
+    if direction == "posneg":
+        score = np.minimum(np.abs(x),np.abs(y))
+        levels = thresholds
+    elif direction == "pos":
+        score = np.minimum(x,y)
+        levels = thresholds
+    elif direction == "neg":
+        score = -np.maximum(x,y)
+        levels = -thresholds
+    else:
+        raise ValueError("direction must be posneg, pos or neg")
+    order = np.argsort(-score,kind="stable")
+    sorted_score = score[order]
+
+    # Centering on the overall means keeps the cumulative sums stable
+    x = x[order] - x.mean() if len(x) else x
+    y = y[order] - y.mean() if len(y) else y
+    cumulative = [np.concatenate([[0],np.cumsum(v)])
+                  for v in [x,y,x*x,y*y,x*y]]
+
+    # Number of voxels with score >= level (score is sorted decreasing)
+    counts = np.searchsorted(-sorted_score,-levels,side="right")
+    sx,sy,sxx,syy,sxy = [c[counts] for c in cumulative]
+    with np.errstate(divide="ignore",invalid="ignore"):
+        cxx = sxx - sx*sx/counts
+        cyy = syy - sy*sy/counts
+        corrs = (sxy - sx*sy/counts) / np.sqrt(cxx*cyy)
+    corrs = np.clip(corrs,-1.0,1.0)
+    corrs[(counts < 2) | ~(cxx > 0) | ~(cyy > 0)] = np.nan
+
+    return pandas.DataFrame({"threshold":thresholds,
+                             "correlation":corrs,
+                             "voxels":counts},
+                            columns=["threshold","correlation","voxels"])
+
+
+def standardize_vectors(data,valid=None):
+    '''standardize_vectors
+    Standardize rows of a matrix in place over their valid (nonzero, non-nan)
+    values, setting values that are not valid to 0. Returns the boolean
+    validity matrix. A precomputed validity matrix can be given.
+    '''
+    if valid is None:
+        valid = (data != 0) & ~np.isnan(data)
+    data[~valid] = 0
+    for i in range(data.shape[0]):
+        row = data[i]
+        values = row[valid[i]].astype(np.float64)
+        if len(values) > 0:
+            std = values.std()
+            row[valid[i]] = (values - values.mean()) / (std if std > 0 else 1)
+    return valid
 
 
 def calc_rows_columns(ratio, n_images):
@@ -232,7 +758,7 @@ def TtoZ(t_stat_map,output_nii,dof):
     '''TtoZ: 
     for details see
     https://github.com/vsoch/TtoZ
-    Also provided for command line.
+    Also provided for command line (see main_ttoz).
 
     t_stat_map: 
         file path to t stat image
@@ -247,40 +773,144 @@ def TtoZ(t_stat_map,output_nii,dof):
     print("Converting map %s to Z-Scores..." %(t_stat_map))
   
     mr = nibabel.load(t_stat_map)
-    data = mr.get_data()
 
-    # Select just the nonzero voxels
-    nonzero = data[data!=0]
+    # One float32 copy of the data, converted in place
+    data = np.array(mr.dataobj,dtype=np.float32)
+    t_to_z_data(data,dof)
 
-    # We will store our results here
-    Z = np.zeros(len(nonzero))
+    # Write new image to file
+    header = mr.get_header().copy()
+    header.set_data_dtype(np.float32)
+    Z_nii_fixed = nibabel.nifti1.Nifti1Image(data,
+                                             affine=mr.get_affine(),
+                                             header=header)
+    nibabel.save(Z_nii_fixed,output_nii)
+    return output_nii
 
-    # Select values less than or == 0, and greater than zero
-    c  = np.zeros(len(nonzero))
-    k1 = (nonzero <= c)
-    k2 = (nonzero > c)
 
-    # Subset the data into two sets
-    t1 = nonzero[k1]
-    t2 = nonzero[k2]
+def TtoZ_batch(t_stat_maps,output_niis,dofs,n_jobs=None):
+    '''TtoZ_batch
+    Convert many t stat images to Z, in a pool of processes
 
-    # Calculate p values for <=0
-    p_values_t1 = t.cdf(t1, df = dof)
-    z_values_t1 = norm.ppf(p_values_t1)
+    t_stat_maps: list
+        file paths to t stat images
 
-    # Calculate p values for > 0
-    p_values_t2 = t.cdf(-t2, df = dof)
-    z_values_t2 = -norm.ppf(p_values_t2)
-    Z[k1] = z_values_t1
-    Z[k2] = z_values_t2
+    output_niis: list
+        output nifti files, one per t stat image
 
-    # Write new image to file
-    empty_nii = np.zeros(mr.shape)
-    empty_nii[mr.get_data()!=0] = Z
-    Z_nii_fixed = nibabel.nifti1.Nifti1Image(empty_nii,
-                                             affine=mr.get_affine(),
-                                             header=mr.get_header())
-    nibabel.save(Z_nii_fixed,output_nii)
+    dofs: int or list
+        degrees of freedom, one for all images or one per image
+
+    n_jobs: int
+        number of processes [default is number of cpus]
+
+    Returns the list of output files, in the same order as the inputs.
+    '''
+    if isinstance(t_stat_maps,str):
+        t_stat_maps = [t_stat_maps]
+    if isinstance(output_niis,str):
+        output_niis = [output_niis]
+    if not isinstance(dofs,(list,tuple,np.ndarray)):
+        dofs = [dofs] * len(t_stat_maps)
+    if not len(t_stat_maps) == len(output_niis) == len(dofs):
+        raise ValueError("Need one output file and dof for each t stat map.")
+
+    if n_jobs == 1:
+        return [TtoZ(t_map,output,dof) for t_map,output,dof
+                in zip(t_stat_maps,output_niis,dofs)]
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(TtoZ,t_stat_maps,output_niis,dofs))
+
+
+def t_to_z_data(data,dof,chunk_size=2**20):
+    '''t_to_z_data
+    Convert an array of t values to Z in place (nonzero values only)
+
+    data: numpy array
+        t values, float32 or float64, modified in place
+
+    dof: 
+        degrees of freedom
+
+    chunk_size: int
+        number of voxels converted at once (bounds float64 temporaries)
+
+    Both tails are done from the log survival function of |t|, so extreme 
+    t values give finite Z instead of saturating to inf:
+        Z = -sign(t) * ndtri(exp(logsf(|t|)))
+    '''
+    # A view in memory order (C or Fortran) so the work is done in place
+    flat = data.reshape(-1,order="A")
+    nonzero = np.flatnonzero(flat)
+    for start in range(0,len(nonzero),chunk_size):
+        idx = nonzero[start:start + chunk_size]
+        values = flat[idx].astype(np.float64)
+        log_p = _t_logsf(np.abs(values),dof)
+        flat[idx] = -np.sign(values) * _log_p_to_z(log_p)
+    if not np.shares_memory(flat,data):
+        data[...] = flat.reshape(data.shape,order="A")
+    return data
+
+
+def _t_logsf(t_values,dof):
+    '''log survival function of the t distribution, with an asymptotic
+    tail (sf ~ c * dof^((dof-1)/2) * t^-dof) where it underflows'''
+    with np.errstate(divide="ignore"):
+        log_p = t.logsf(t_values,dof)
+    underflow = np.isneginf(log_p)
+    if underflow.any():
+        log_c = gammaln((dof + 1) / 2.0) - gammaln(dof / 2.0) - \
+                0.5 * np.log(dof * np.pi)
+        log_p[underflow] = log_c + (dof - 1) / 2.0 * np.log(dof) - \
+                           dof * np.log(t_values[underflow])
+    return log_p
+
+
+def _log_p_to_z(log_p):
+    '''Inverse of the standard normal cdf, from log(p)'''
+    if ndtri_exp is not None:
+        return ndtri_exp(log_p)
+
+    # Older scipy: ppf where p is representable, else asymptotic + newton
+    z = norm.ppf(np.exp(log_p))
+    tiny = log_p < -700
+    if tiny.any():
+        x = -2 * log_p[tiny]
+        z_tail = -np.sqrt(x - np.log(x) - np.log(2 * np.pi))
+        for step in range(3):
+            log_cdf = log_ndtr(z_tail)
+            log_pdf = -0.5 * z_tail**2 - 0.5 * np.log(2 * np.pi)
+            z_tail = z_tail - (log_cdf - log_p[tiny]) / np.exp(log_pdf - log_cdf)
+        z[tiny] = z_tail
+    return z
+
+
+def main_ttoz(args=None):
+    '''Command line: convert t stat maps to Z, each with its own dof
+
+    pbc_ttoz tmap1.nii.gz tmap2.nii.gz --dof 28 30 --output_folder zmaps
+    '''
+    parser = argparse.ArgumentParser(description="Convert t maps to Z maps")
+    parser.add_argument("t_stat_maps", nargs="+", type=nifti_file,
+                        help="t stat images to convert")
+    parser.add_argument("--dof", nargs="+", type=float, required=True,
+                        help="degrees of freedom, one for all or one per map")
+    parser.add_argument("--output_folder", default=os.getcwd(),
+                        help="folder for the Z maps [default current folder]")
+    parser.add_argument("--n_jobs", type=int, default=None,
+                        help="number of processes [default number of cpus]")
+    args = parser.parse_args(args)
+
+    dofs = args.dof
+    if len(dofs) == 1:
+        dofs = dofs * len(args.t_stat_maps)
+    elif len(dofs) != len(args.t_stat_maps):
+        parser.error("Give one dof, or one dof per t stat map.")
+
+    output_niis = ["%s/%s_Z.nii.gz" %(args.output_folder,get_name(t_map))
+                   for t_map in args.t_stat_maps]
+    return TtoZ_batch(args.t_stat_maps,output_niis,dofs,n_jobs=args.n_jobs)
 
 # From Chrisfilo alleninf
 
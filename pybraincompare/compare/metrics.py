@@ -0,0 +1,289 @@
+'''
+metrics.py: part of pybraincompare package
+Registry of similarity metrics, computed together over the same vectors
+
+Every metric is a function of a MetricData (one query vector, and one or
+more images to compare it to, already masked) that returns one value per
+image. MetricData holds the values with missing voxels set to zero, and
+caches what metrics have in common (the overlap sums, ranks, thresholded
+maps), so asking for several metrics does the shared work once.
+
+Register a new metric with register_metric:
+
+    @register_metric("covariance")
+    def covariance(data,**options):
+        n,sx,sy,sxx,syy,sxy = data.get_moments()
+        return (sxy - sx*sy/n) / (n - 1)
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import str
+from builtins import range
+from builtins import object
+from .maths import calculate_ranked_spearman, rank_vector
+from scipy.stats import spearmanr
+import numpy as np
+import collections
+import pandas
+
+
+# Registered metrics, name: function(data,**options)
+metric_registry = collections.OrderedDict()
+
+def register_metric(name,function=None):
+    '''register_metric
+    Add a metric to the registry (replacing a metric of the same name). Can
+    be used as register_metric(name,function) or as a decorator. The
+    function takes a MetricData and keyword options, and returns a vector
+    with one value per image in data.images. It should accept (and ignore)
+    options meant for other metrics.
+    '''
+    def register(function):
+        metric_registry[name] = function
+        return function
+    if function is None:
+        return register
+    return register(function)
+
+def get_metric(name):
+    if name not in metric_registry:
+        raise ValueError("%s is not a registered metric, choices are %s"
+                         %(name,", ".join(metric_registry)))
+    return metric_registry[name]
+
+
+class MetricData(object):
+    '''
+    A query vector and a matrix of images (images in rows) in the same
+    mask, prepared once for all metrics. Values that are zero or nan are
+    missing, and each query/image pair is compared over the voxels valid in
+    both (pairwise deletion). If pairwise_deletion is False, only nans are
+    missing. Images already float32 are kept float32, and sums over the
+    images are done in float64 for block_size images at a time, so they do
+    not make another copy of the images.
+    '''
+
+    def __init__(self, query, images, pairwise_deletion=True, block_size=256):
+        self.query = np.array(query,dtype=np.float64).ravel()
+        self.images = np.array(images,ndmin=2)
+        if self.images.dtype != np.float32:
+            self.images = self.images.astype(np.float64,copy=False)
+        if self.images.shape[1] != len(self.query):
+            raise ValueError("Query and images must have the same number of voxels")
+        self.pairwise_deletion = pairwise_deletion
+        self.block_size = block_size
+        self.query_valid = self.get_valid(self.query)
+        self.images_valid = self.get_valid(self.images)
+        self.query[~self.query_valid] = 0
+        self.images[~self.images_valid] = 0
+        self.cache = dict()
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def get_valid(self,values):
+        valid = ~np.isnan(values)
+        if self.pairwise_deletion:
+            valid &= values != 0
+        return valid
+
+    def get(self,key,function):
+        '''Return a cached value shared between metrics, computing it once'''
+        if key not in self.cache:
+            self.cache[key] = function()
+        return self.cache[key]
+
+    def get_moments(self):
+        '''get_moments
+        Sums over the overlap of the query with each image: the number of
+        voxels, sum of image values, of query values, of squared image and
+        query values, and of products. Missing values are zero, so each
+        sum is a matrix product with a validity mask, done for a block of
+        images at a time.
+        '''
+        def moments():
+            query_valid = self.query_valid.astype(np.float64)
+            query_squared = self.query**2
+            sums = np.empty((6,len(self)))
+            for start in range(0,len(self),self.block_size):
+                end = min(start + self.block_size,len(self))
+                images = self.images[start:end].astype(np.float64,copy=False)
+                images_valid = self.images_valid[start:end].astype(np.float64)
+                sums[:,start:end] = (images_valid.dot(query_valid),
+                                     images.dot(query_valid),
+                                     images_valid.dot(self.query),
+                                     (images*images).dot(query_valid),
+                                     images_valid.dot(query_squared),
+                                     images.dot(self.query))
+            return tuple(sums)
+        return self.get("moments",moments)
+
+    def get_suprathreshold(self,threshold,direction="posneg"):
+        '''Query and images as float masks of values passing a threshold
+        (as in apply_threshold), limited to valid values'''
+        def suprathreshold():
+            return (_threshold_mask(self.query,self.query_valid,threshold,direction),
+                    _threshold_mask(self.images,self.images_valid,threshold,direction))
+        return self.get(("suprathreshold",threshold,direction),suprathreshold)
+
+
+def _threshold_mask(values,valid,threshold,direction):
+    if direction == "posneg":
+        passed = np.abs(values) >= threshold
+    elif direction == "pos":
+        passed = values >= threshold
+    elif direction == "neg":
+        passed = values <= threshold
+    else:
+        raise ValueError("direction must be posneg, pos or neg")
+    return (passed & valid).astype(np.float32)
+
+
+def calculate_metrics(image_vector1,
+                      image_vector2,
+                      metrics=None,
+                      pairwise_deletion=True,
+                      **options):
+
+    '''calculate_metrics
+    Several similarity metrics for two vectors, in one pass
+
+    image_vector1,image_vector2: vectors of equal length with image values
+
+    metrics: list
+        names of registered metrics [default all]
+
+    pairwise_deletion: boolean
+        compare only voxels that are nonzero and not nan in both [default True]
+
+    options: passed to every metric, eg threshold and direction for dice
+        and jaccard
+
+    Returns a dictionary with a value for each metric
+    '''
+    data = MetricData(image_vector1,image_vector2,
+                      pairwise_deletion=pairwise_deletion)
+    scores = calculate_data_metrics(data,metrics,**options)
+    return collections.OrderedDict((name,values[0]) for name,values in scores.items())
+
+
+def calculate_corpus_metrics(query,
+                             images,
+                             metrics=None,
+                             image_ids=None,
+                             pairwise_deletion=True,
+                             **options):
+
+    '''calculate_corpus_metrics
+    Several similarity metrics for a query against many images, in one pass
+
+    query: vector of query values (masked)
+
+    images: 2D array, images in rows and voxels in columns, or a data frame
+        with images in columns (eg, from get_images_df)
+
+    metrics: list
+        names of registered metrics [default all]
+
+    image_ids: ids of the images, for the index of the result [optional]
+
+    Returns a data frame with images in rows and metrics in columns
+    '''
+    if isinstance(images,pandas.DataFrame):
+        if image_ids is None:
+            image_ids = images.columns.tolist()
+        images = images.values.T
+    data = MetricData(query,images,pairwise_deletion=pairwise_deletion)
+    scores = calculate_data_metrics(data,metrics,**options)
+    return pandas.DataFrame(scores,index=image_ids,columns=list(scores.keys()))
+
+
+def calculate_data_metrics(data,metrics=None,**options):
+    '''Evaluate metrics (names, default all registered) on a MetricData'''
+    if metrics is None:
+        metrics = list(metric_registry.keys())
+    if isinstance(metrics,str):
+        metrics = [metrics]
+    scores = collections.OrderedDict()
+    for name in metrics:
+        scores[name] = np.asarray(get_metric(name)(data,**options),dtype=np.float64)
+    return scores
+
+
+# METRICS ######################################################################
+
+@register_metric("pearson")
+def pearson(data,**options):
+    n,sx,sy,sxx,syy,sxy = data.get_moments()
+    with np.errstate(divide="ignore",invalid="ignore"):
+        cxx = sxx - sx*sx/n
+        cyy = syy - sy*sy/n
+        corrs = (sxy - sx*sy/n) / np.sqrt(cxx*cyy)
+    corrs = np.clip(corrs,-1.0,1.0)
+    corrs[(n < 2) | ~(cxx > 0) | ~(cyy > 0)] = np.nan
+    return corrs
+
+@register_metric("spearman")
+def spearman(data,**options):
+    '''Exact spearman over the overlap of each pair. The query is ranked
+    once, each image is ranked when it is compared and not kept (see
+    calculate_ranked_spearman)'''
+    corrs = np.empty(len(data))
+    if not data.pairwise_deletion:
+        for i in range(len(data)):
+            overlap = data.images_valid[i] & data.query_valid
+            corrs[i] = spearmanr(data.images[i][overlap],data.query[overlap])[0]
+        return corrs
+    query_ranks = data.get("query_ranks",lambda: rank_vector(data.query,data.query_valid))
+    for i in range(len(data)):
+        image_valid = data.images_valid[i]
+        corrs[i] = calculate_ranked_spearman(rank_vector(data.images[i],image_valid),
+                                             data.images[i],image_valid,
+                                             query_ranks,data.query,data.query_valid)
+    return corrs
+
+@register_metric("cosine")
+def cosine(data,**options):
+    n,sx,sy,sxx,syy,sxy = data.get_moments()
+    with np.errstate(divide="ignore",invalid="ignore"):
+        similarity = sxy / np.sqrt(sxx*syy)
+    similarity[~((sxx > 0) & (syy > 0))] = np.nan
+    return np.clip(similarity,-1.0,1.0)
+
+@register_metric("euclidean")
+def euclidean(data,**options):
+    n,sx,sy,sxx,syy,sxy = data.get_moments()
+    distance = np.sqrt(np.maximum(sxx + syy - 2*sxy,0))
+    distance[n == 0] = np.nan
+    return distance
+
+def _threshold_overlap(data,threshold,direction):
+    '''Sizes of the thresholded query, images and their intersection, each
+    counted within the overlap of the pair'''
+    query,images = data.get_suprathreshold(threshold,direction)
+    query_valid = data.query_valid.astype(np.float32)
+    sizes = np.empty((3,len(data)))
+    for start in range(0,len(data),data.block_size):
+        end = min(start + data.block_size,len(data))
+        images_valid = data.images_valid[start:end].astype(np.float32)
+        sizes[:,start:end] = (images_valid.dot(query),
+                              images[start:end].dot(query_valid),
+                              images[start:end].dot(query))
+    return tuple(sizes)
+
+@register_metric("dice")
+def dice(data,threshold=1.96,direction="posneg",**options):
+    '''Dice coefficient of the maps thresholded as in apply_threshold'''
+    size_query,size_images,intersection = _threshold_overlap(data,threshold,direction)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        return 2*intersection / (size_query + size_images)
+
+@register_metric("jaccard")
+def jaccard(data,threshold=1.96,direction="posneg",**options):
+    '''Jaccard index of the maps thresholded as in apply_threshold'''
+    size_query,size_images,intersection = _threshold_overlap(data,threshold,direction)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        return intersection / (size_query + size_images - intersection)
@@ -10,47 +10,135 @@ from pybraincompare.template.futils import get_name
 from pybraincompare.report.image import make_anat_image
 from nilearn.masking import apply_mask, compute_epi_mask
 from nilearn.image import resample_img
+from .cache import cached_resample_img, get_resample_cache, ResampleCache
+from .resampling import resample_images
+from concurrent.futures import ProcessPoolExecutor
+import collections
 import subprocess
+import tempfile
+import shutil
+import hashlib
 import nibabel
 import pandas
 import numpy
 import os
 
+# PRECISION ------------------------------------------------------------------------------
+
+# Precision image data is loaded and processed in, see set_precision
+precision = None
+precision_choices = [None,"float64","float32","native"]
+
+def set_precision(dtype=None):
+    '''set_precision
+    Set the precision images are loaded and processed in, for functions
+    that take a dtype argument (a dtype given to the function wins):
+
+        None: as image.get_data(), results in float64 [default]
+        float64: image data as float64, not cached on the image
+        float32: image data as float32 (half the memory and bandwidth)
+        native: the data type on disk, scaled by nibabel only if the header
+                has a slope or intercept. New float results are float32.
+
+    Sums, means and variances are accumulated in float64 in every mode.
+    '''
+    global precision
+    precision = get_precision(dtype)
+    return precision
+
+def get_precision(dtype=None):
+    '''Precision for a call: dtype if given, else the one from set_precision'''
+    if dtype is None:
+        return precision
+    if not isinstance(dtype,str):
+        dtype = numpy.dtype(dtype).name
+    if dtype not in precision_choices:
+        raise ValueError("precision must be one of None, float64, float32 or native")
+    return dtype
+
+def get_image_data(image,dtype=None):
+    '''get_image_data
+    Data of a nibabel image in a precision (see set_precision). Except for
+    the default, the data is not cached on the image, and for native is not
+    copied or scaled beyond what the header asks for.
+    '''
+    dtype = get_precision(dtype)
+    if dtype is None:
+        return image.get_data()
+    if dtype == "native":
+        return numpy.asanyarray(image.dataobj)
+    return image.get_fdata(dtype=numpy.dtype(dtype),caching="unchanged")
+
+def get_output_dtype(values=None,dtype=None):
+    '''Data type for new float results in a precision: float64 (default
+    and float64), float32, or for native the dtype of values when it is a
+    float type, else float32'''
+    dtype = get_precision(dtype)
+    if dtype in [None,"float64"]:
+        return numpy.float64
+    if dtype == "native" and values is not None and \
+       numpy.asarray(values).dtype.kind == "f":
+        return numpy.asarray(values).dtype
+    return numpy.float32
+
 # GET MR IMAGE FUNCTIONS------------------------------------------------------------------
 
+# Software we have said is not installed (and used bundled templates for)
+bundled_standard_notices = set()
+
 def get_standard_mask(software):
-    '''Returns reference mask from FSL or FREESURFER'''
-    if software == "FSL":
+    '''Returns reference mask from FSL or FREESURFER, or the bundled 2mm
+    MNI152 mask if FSL is not installed'''
+    if software == "FSL" and "FSLDIR" in os.environ:
         reference = os.path.join(os.environ['FSLDIR'],
                                  'data', 
                                  'standard', 
                                  'MNI152_T1_2mm_brain_mask.nii.gz')
 
-    elif software == "FREESURFER":
+    elif software == "FREESURFER" and "FREESURFER_HOME" in os.environ:
         reference = os.path.join(os.environ['FREESURFER_HOME'],
                                  'subjects',
                                  'fsaverage',
                                  'mri',
                                  'brainmask.mgz')
+    else:
+        reference = get_bundled_standard(software,"brain_mask")
     return reference
 
 
 def get_standard_brain(software):
-    '''Returns reference brain from FSL or FREESURFER'''  
-    if software == "FSL":
+    '''Returns reference brain from FSL or FREESURFER, or the bundled 2mm
+    MNI152 brain if FSL is not installed'''  
+    if software == "FSL" and "FSLDIR" in os.environ:
         reference = os.path.join(os.environ['FSLDIR'],
                                 'data',
                                 'standard',
                                 'MNI152_T1_2mm_brain.nii.gz')
 
-    elif software == "FREESURFER":
+    elif software == "FREESURFER" and "FREESURFER_HOME" in os.environ:
         reference = os.path.join(os.environ['FREESURFER_HOME'],
                                 'subjects',
                                 'fsaverage',
                                 'mri',
                                 'brain.mgz')
+    else:
+        reference = get_bundled_standard(software,"brain")
     return reference
 
+def get_bundled_standard(software,name):
+    '''Path of a bundled MNI152 2mm template (brain or brain_mask), the FSL
+    standard, used when FSLDIR is not set. There is no bundled FREESURFER
+    (fsaverage) standard, so without FREESURFER_HOME it is an error.'''
+    if software not in ["FSL","FREESURFER"]:
+        raise ValueError("software must be FSL or FREESURFER")
+    if software == "FREESURFER":
+        raise ValueError("FREESURFER_HOME is not set, and there is no bundled FREESURFER standard.")
+    from pybraincompare.mr.datasets import get_data_directory
+    if software not in bundled_standard_notices:
+        bundled_standard_notices.add(software)
+        print("%s is not installed, using the bundled MNI152 2mm template." %(software))
+    return os.path.join(get_data_directory(),"MNI152_T1_2mm_%s.nii.gz" %(name))
+
 def get_standard_mat(software):
     '''Return MNI transformations for registration'''
     if software == "FREESURFER":
@@ -82,21 +170,60 @@ def get_images_df(file_paths,
                   mask,
                   dtype="f", 
                   smoothing_fwhm=None,
-                  ensure_finite=True):
-
+                  ensure_finite=True,
+                  store=None):
+    '''get_images_df
+    Masked values of images (in rows) as a data frame, for one image a
+    single column. If store is given (a VoxelStore or its directory, see
+    pybraincompare.compare.store), images are read from the store, and
+    only images not already in it are masked (and added to it). Images are
+    found in the store by path, size and modification time (see
+    get_image_key), so a file changed in place is masked again. The store
+    is not used with smoothing, and its ensure_finite must be the one
+    asked for.
+    '''
+    if store is not None and smoothing_fwhm is None:
+        from .store import VoxelStore, get_image_key
+        if not isinstance(mask,Mask):
+            mask = Mask(mask)
+        if not isinstance(store,VoxelStore):
+            store = VoxelStore(store,mask=mask,ensure_finite=ensure_finite)
+        if mask.key != store.mask_key:
+            raise ValueError("Mask does not match the mask of the store")
+        if ensure_finite != store.ensure_finite:
+            raise ValueError("ensure_finite does not match the ensure_finite of the store")
+        if store.mask is None:
+            store.mask = mask
+        single = isinstance(file_paths,(str,nibabel.nifti1.Nifti1Image))
+        images = [file_paths] if single else list(file_paths)
+        data = store.load(images,image_ids=[get_image_key(image) for image in images])
+        if single:
+            data = data[0]
+        return pandas.DataFrame(data.astype(dtype,copy=False),copy=False)
+
+    # Mask.mask gives a vector (a column) for one image, as apply_mask
+    if isinstance(mask,Mask) and smoothing_fwhm is None:
+        return pandas.DataFrame(mask.mask(file_paths,dtype=dtype,
+                                          ensure_finite=ensure_finite))
+    if isinstance(mask,Mask):
+        mask = mask.to_nifti()
     return pandas.DataFrame(apply_mask(file_paths, mask, dtype, 
                                        smoothing_fwhm,ensure_finite))
 
 
-def make_nii(data_vector,mask_template):
+def make_nii(data_vector,mask_template,dtype=None):
+    if isinstance(mask_template,Mask):
+        return mask_template.make_nii(data_vector,dtype=dtype)
     mask_nii = get_nii_obj(mask_template)[0]
-    empty_nii = numpy.zeros(shape=mask_nii.shape)
-    empty_nii[mask_nii.get_data()!=0] = data_vector
+    empty_nii = numpy.zeros(shape=mask_nii.shape,
+                            dtype=get_output_dtype(data_vector,dtype))
+    empty_nii[numpy.asanyarray(mask_nii.dataobj)!=0] = data_vector
     return nibabel.Nifti1Image(empty_nii,affine=mask_nii.get_affine())
 
 # RESAMPLING -----------------------------------------------------------------------------
 
-def resample_images_ref(images,reference,interpolation,resample_dim=None):
+def resample_images_ref(images,reference,interpolation,resample_dim=None,
+                        cache=None,sparse=False,n_jobs=None,executor=None):
     '''Resample many images to single reference
 
     images: nibabal.Nifti1Image list 
@@ -104,12 +231,36 @@ def resample_images_ref(images,reference,interpolation,resample_dim=None):
     
     reference: nibabel.Nifti1Image
         single image file or nibabel image
+
+    cache: pybraincompare.compare.cache.ResampleCache or directory
+        keep resampled images on disk, so an image already resampled to
+        the reference is loaded instead [default the cache from 
+        set_resample_cache, if any]
+
+    sparse: boolean
+        resample with sparse interpolation operators, built once for each
+        grid the images are on (see pybraincompare.compare.resampling), 
+        faster for many images on few grids [default False]. Not with
+        n_jobs or executor.
+
+    n_jobs: int
+        number of worker processes to resample images in [default None,
+        resample in this process]. Results are in the order of images,
+        only a few images per worker are in flight at once, and resampled
+        data comes back through temporary memory mapped files.
+
+    executor: concurrent.futures executor to use instead of a new process
+        pool of n_jobs workers [optional]
     '''
 
+    if sparse and ((n_jobs is not None and n_jobs > 1) or executor is not None):
+        raise ValueError("sparse resampling runs in this process, n_jobs and executor cannot be used with it")
+
     if isinstance(reference,str): reference = nibabel.load(reference)
     if resample_dim:
         affine = numpy.diag(resample_dim)
-        reference = resample_img(reference, target_affine=affine)
+        reference = cached_resample_img(reference, target_affine=affine,
+                                        cache=cache)
 
     # Resample images to match reference mask affine and shape
     if not isinstance(images,list): images = [images]
@@ -118,14 +269,32 @@ def resample_images_ref(images,reference,interpolation,resample_dim=None):
     # Make sure we don't have any with singleton dimension
     images = squeeze_fourth_dimension(images_nii)
 
+    if sparse:
+        images_resamp = resample_images(images_nii,
+                                        target_affine=reference.get_affine(),
+                                        target_shape=reference.shape,
+                                        interpolation=interpolation,
+                                        cache=cache)
+        return images_resamp, reference
+
+    if (n_jobs is not None and n_jobs > 1) or executor is not None:
+        images_resamp = resample_images_parallel(images_nii,
+                                                 reference=reference,
+                                                 interpolation=interpolation,
+                                                 cache=cache,
+                                                 n_jobs=n_jobs,
+                                                 executor=executor)
+        return images_resamp, reference
+
     images_resamp = []
     for image in images_nii:
         # Only resample if the image is different from the reference
         if not (image.get_affine() == reference.get_affine()).all():
-            resampled_img = resample_img(image,
+            resampled_img = cached_resample_img(image,
                                          target_affine=reference.get_affine(), 
                                          target_shape=reference.shape,
-                                         interpolation=interpolation)
+                                         interpolation=interpolation,
+                                         cache=cache)
         else: 
             resampled_img = image
         
@@ -133,6 +302,78 @@ def resample_images_ref(images,reference,interpolation,resample_dim=None):
     
     return images_resamp, reference
 
+def resample_images_parallel(images,reference,interpolation,cache=None,
+                             n_jobs=None,executor=None,max_in_flight=None):
+    '''resample_images_parallel
+    Resample nibabel images to a reference in worker processes (see
+    resample_images_ref). Each worker saves its result to a temporary .npy
+    file, which is opened here as a memory map (and unlinked), so large
+    arrays are not pickled back. At most max_in_flight images [default two
+    per worker] are submitted and not yet collected, in order of images.
+    '''
+    cache = get_resample_cache(cache)
+    cache_dir = cache.cache_dir if cache is not None else None
+    max_bytes = cache.max_bytes if cache is not None else None
+    target_affine = reference.get_affine()
+    target_shape = reference.shape
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+    if max_in_flight is None:
+        max_in_flight = 2 * (n_jobs or getattr(executor,"_max_workers",1) or 1)
+    output_folder = tempfile.mkdtemp(prefix="pybraincompare_resample_")
+
+    images_resamp = [None] * len(images)
+    in_flight = collections.deque()
+    try:
+        for i,image in enumerate(images):
+            # Only resample if the image is different from the reference
+            if (image.get_affine() == target_affine).all():
+                images_resamp[i] = image
+                continue
+            task = (image,target_affine,target_shape,interpolation,
+                    cache_dir,max_bytes,"%s/%s.npy" %(output_folder,i))
+            in_flight.append((i,executor.submit(_resample_to_file,task)))
+            while len(in_flight) >= max_in_flight:
+                index,future = in_flight.popleft()
+                images_resamp[index] = _load_resampled(future.result())
+        while in_flight:
+            index,future = in_flight.popleft()
+            images_resamp[index] = _load_resampled(future.result())
+    finally:
+        for index,future in in_flight:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+        shutil.rmtree(output_folder,ignore_errors=True)
+    return images_resamp
+
+def _resample_to_file(task):
+    '''Resample one image (in a worker), save the data to output_file'''
+    image,target_affine,target_shape,interpolation,cache_dir,max_bytes,output_file = task
+    cache = None
+    if cache_dir is not None:
+        cache = ResampleCache(cache_dir=cache_dir,max_bytes=max_bytes)
+    resampled = cached_resample_img(image,
+                                    target_affine=target_affine,
+                                    target_shape=target_shape,
+                                    interpolation=interpolation,
+                                    cache=cache)
+    numpy.save(output_file,numpy.asanyarray(resampled.dataobj))
+    return output_file, resampled.affine
+
+def _load_resampled(result):
+    '''Memory map the data saved by a worker, the file is removed at once
+    (the mapping keeps the data until the image is released)'''
+    output_file,affine = result
+    data = numpy.load(output_file,mmap_mode="c")
+    try:
+        os.remove(output_file)
+    except OSError:
+        pass
+    return nibabel.Nifti1Image(data,affine=affine)
+
 def squeeze_fourth_dimension(images):
     '''squeeze out extra fourth dimension'''
     shapes = [len(i.shape) == 4 for i in images]
@@ -147,28 +388,225 @@ def squeeze_fourth_dimension(images):
     else:
         return images
 
+# ATLAS CACHE ------------------------------------------------------------------
+
+# Atlas volumes resampled to image grids, and atlas vectors for masks
+atlas_cache = collections.OrderedDict()
+atlas_cache_size = 32
+
+def get_atlas_vector(atlas_file,reference,mask=None):
+    '''get_atlas_vector
+    Return the atlas labels in a mask, for images on the grid of reference.
+    The atlas volume resampled (nearest) to each grid, and the vector for 
+    each mask, are kept in a process-wide cache (atlas_cache), so repeated
+    comparisons on the same grid do not load or resample the atlas again.
+
+    atlas_file: path to the atlas image (eg, atlas.file)
+    reference: nibabel.Nifti1Image on the target grid (eg, the first image)
+    mask: nibabel.Nifti1Image or Mask on the same grid [optional, else all voxels]
+
+    The returned vector is shared with the cache, and is read only.
+    '''
+    atlas_file = os.path.abspath(atlas_file)
+    grid_key = (atlas_file,
+                os.path.getmtime(atlas_file),
+                reference.get_affine().tobytes(),
+                tuple(reference.shape[0:3]))
+
+    if isinstance(mask,Mask):
+        mask_data = mask.get_data()
+        mask_key = mask.key
+    elif mask is not None:
+        mask_data = numpy.squeeze(mask.get_data()) != 0
+        mask_key = hashlib.sha1(numpy.packbits(mask_data).tobytes()).hexdigest()
+    else:
+        mask_data = None
+        mask_key = None
+
+    vector_key = grid_key + (mask_key,)
+    if vector_key in atlas_cache:
+        atlas_cache.move_to_end(vector_key)
+        return atlas_cache[vector_key]
+
+    if grid_key in atlas_cache:
+        atlas_cache.move_to_end(grid_key)
+        atlas_data = atlas_cache[grid_key]
+    else:
+        atlas_nii = nibabel.load(atlas_file)
+        if not (atlas_nii.get_affine() == reference.get_affine()).all():
+            atlas_nii, _ = resample_images_ref(images=atlas_nii,
+                                               reference=reference,
+                                               interpolation="nearest")
+            atlas_nii = atlas_nii[0]
+        atlas_data = numpy.squeeze(atlas_nii.get_data()).astype(numpy.float32)
+        _add_atlas_cache(grid_key,atlas_data)
+
+    if mask_data is not None:
+        atlas_vector = atlas_data[mask_data]
+    else:
+        atlas_vector = atlas_data.flatten()
+    _add_atlas_cache(vector_key,atlas_vector)
+    return atlas_vector
+
+def _add_atlas_cache(key,value):
+    value.setflags(write=False)
+    atlas_cache[key] = value
+    while len(atlas_cache) > atlas_cache_size:
+        atlas_cache.popitem(last=False)
+
+def clear_atlas_cache(atlas_file=None):
+    '''Remove all cached atlas volumes and vectors, or only those of one file'''
+    if atlas_file is None:
+        atlas_cache.clear()
+    else:
+        atlas_file = os.path.abspath(atlas_file)
+        for key in [k for k in atlas_cache if k[0] == atlas_file]:
+            del atlas_cache[key]
+
 # MASKING ----------------------------------------------------------------------
 
-def do_mask(images,mask):
+class Mask(object):
+    '''
+    A binary mask compiled once: the flat indices of the voxels in the mask,
+    with the affine, header and shape of the mask image. Values are taken
+    (and put back) with np.take and flat assignment, on a view of the data
+    when it is C or Fortran contiguous (including memory maps), so nothing
+    is re-binarized, re-validated or copied per image. Voxels are in the
+    same order as nilearn apply_mask (and do_mask).
+
+    mask: nibabel.Nifti1Image, image file, or a Mask
+    '''
+
+    def __init__(self, mask):
+        if isinstance(mask,Mask):
+            mask = mask.to_nifti()
+        mask = get_nii_obj(mask)[0]
+        self.affine = mask.get_affine()
+        self.header = mask.get_header()
+        self.shape = tuple(mask.shape[0:3])
+        mask_bin = numpy.asanyarray(mask.dataobj).reshape(self.shape) != 0
+        self.indices = numpy.flatnonzero(mask_bin)
+        self.indices_fortran = numpy.ravel_multi_index(
+                                   numpy.unravel_index(self.indices,self.shape),
+                                   self.shape,order="F")
+        self.key = hashlib.sha1(numpy.packbits(mask_bin).tobytes()).hexdigest()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_data(self):
+        '''Boolean volume of the mask'''
+        data = numpy.zeros(self.shape,dtype=bool)
+        data.flat[self.indices] = True
+        return data
+
+    def to_nifti(self):
+        return nibabel.Nifti1Image(self.get_data().astype(numpy.int8),
+                                   affine=self.affine)
+
+    def take(self,data):
+        '''Values of a volume (array) in the mask'''
+        data = numpy.asanyarray(data)
+        if data.ndim == 4 and data.shape[3] == 1:
+            data = data[:,:,:,0]
+        if data.shape != self.shape:
+            raise ValueError("Image shape %s does not match mask shape %s"
+                             %(data.shape,self.shape))
+        if data.flags.c_contiguous:
+            return numpy.take(data.reshape(-1),self.indices)
+        if data.flags.f_contiguous:
+            return numpy.take(data.reshape(-1,order="F"),self.indices_fortran)
+        return data[numpy.unravel_index(self.indices,self.shape)]
+
+    def mask(self,images,dtype=numpy.float32,ensure_finite=False):
+        '''mask
+        Values in the mask for one image (a vector) or a list of images (a
+        matrix, images in rows), as apply_mask. Images are nibabel images,
+        files, or arrays on the mask grid. If ensure_finite, nans and infs
+        are replaced with 0. If dtype is None, values keep the data type of
+        the (first) image data.
+        '''
+        single = isinstance(images,(str,nibabel.nifti1.Nifti1Image)) or \
+                 (isinstance(images,numpy.ndarray) and images.ndim == 3)
+        if single:
+            images = [images]
+        masked = None
+        for i,image in enumerate(images):
+            if not isinstance(image,numpy.ndarray):
+                image = get_nii_obj(image)[0]
+                if not numpy.allclose(image.get_affine(),self.affine):
+                    raise ValueError("Image affine does not match mask affine")
+                image = image.dataobj
+            values = self.take(image)
+            if masked is None:
+                masked = numpy.empty((len(images),len(self)),
+                                     dtype=values.dtype if dtype is None else dtype)
+            masked[i] = values
+        if masked is None:
+            masked = numpy.empty((0,len(self)),dtype=dtype or numpy.float32)
+        if ensure_finite:
+            masked[~numpy.isfinite(masked)] = 0
+        if single:
+            return masked[0]
+        return masked
+
+    def unmask(self,vectors,dtype=numpy.float64):
+        '''Put masked values (a vector, or a matrix with images in rows) back
+        in volumes, zero outside of the mask'''
+        vectors = numpy.asanyarray(vectors)
+        if vectors.ndim == 1:
+            data = numpy.zeros(self.shape,dtype=dtype)
+            data.flat[self.indices] = vectors
+            return data
+        data = numpy.zeros((vectors.shape[0],) + self.shape,dtype=dtype)
+        data.reshape(vectors.shape[0],-1)[:,self.indices] = vectors
+        return data
+
+    def make_nii(self,data_vector,dtype=None):
+        '''A nifti image on the mask grid from masked values'''
+        return nibabel.Nifti1Image(self.unmask(data_vector,
+                                               dtype=get_output_dtype(data_vector,dtype)),
+                                   affine=self.affine)
+
+
+def do_mask(images,mask,dtype=None):
     '''do_mask
     Mask registered images - should already be in same space
     
     images: nibabel.Nifti1Image list
         a list of nifti1 objects [same size and shape]
 
-    mask: nibabel.Nifti1Image
+    mask: nibabel.Nifti1Image or Mask
         a nifti1 object mask [same size and shape]
+
+    dtype: precision of the masked values (see set_precision) [default
+        float32, or float64 with the float64 precision]
     '''
+    dtype = get_precision(dtype)
+    if dtype in [None,"float32"]:
+        masked_dtype = numpy.float32
+    elif dtype == "float64":
+        masked_dtype = numpy.float64
+    else:
+        masked_dtype = None
 
     # If we only have one image
     if isinstance(images,nibabel.nifti1.Nifti1Image):
         images = [images]
 
+    # A compiled mask takes the values directly
+    if isinstance(mask,Mask):
+        try:
+            return mask.mask(images,dtype=masked_dtype)
+        except ValueError:
+            print("Reference and images affines do not match, or all data masked.") 
+            return numpy.nan
+
     # Make sure images are 3d (squeeze out extra dimension)
     images = squeeze_fourth_dimension(images)
 
     # Don't trust that mask is binary  
-    mask_bin = mask.get_data().astype(bool).astype(int)
+    mask_bin = numpy.asanyarray(mask.dataobj).astype(bool).astype(numpy.int8)
     mask = nibabel.nifti1.Nifti1Image(mask_bin,
                                       affine=mask.get_affine(),
                                       header=mask.get_header())
@@ -176,7 +614,7 @@ def do_mask(images,mask):
     # if ensure_finite is True, nans and infs get replaced by zeros
 
     try:
-        masked_data = apply_mask(images, mask, dtype='f',
+        masked_data = apply_mask(images, mask, dtype=masked_dtype,
                                  smoothing_fwhm=None, ensure_finite=False)
         return masked_data
 
@@ -184,59 +622,83 @@ def do_mask(images,mask):
         print("Reference and images affines do not match, or all data masked.") 
         return numpy.nan
   
-def make_binary_deletion_mask(images):
+def make_binary_deletion_mask(images,mask=None,dtype=None):
     '''Make binary deletion mask (pairwise deletion) - 
        intersection of nonzero and non-nan values
+       
+       mask: a Mask, nibabel image or file, to also limit to [optional]
+       dtype: precision (see set_precision), the mask is float64 by default
+              and float32 otherwise. Image values are compared as they are
+              on disk (only zero and nan matter), never upcast.
     '''
+    output_dtype = get_output_dtype(dtype=dtype)
     if isinstance(images, nibabel.nifti1.Nifti1Image):
         images = [images]
-    images_data = [numpy.squeeze(image.get_data()) for image in images]
-    mask = numpy.ones(images_data[0].shape)
-    for image_data in images_data:
-        mask *= (image_data != 0) & ~numpy.isnan(image_data)
-    return mask
-
-def make_binary_deletion_vector(image_vectors):
+    if mask is not None:
+        mask = Mask(mask)
+        valid = numpy.ones(len(mask),dtype=bool)
+        for image in images:
+            values = mask.take(image.dataobj)
+            valid &= (values != 0) & ~numpy.isnan(values)
+        return mask.unmask(valid,dtype=output_dtype)
+    mask = None
+    for image in images:
+        image_data = numpy.squeeze(numpy.asanyarray(image.dataobj))
+        valid = (image_data != 0) & ~numpy.isnan(image_data)
+        if mask is None:
+            mask = valid
+        else:
+            mask &= valid
+    return mask.astype(output_dtype)
+
+def make_binary_deletion_vector(image_vectors,dtype=None):
     '''Make binary deletion vector (pairwise deletion) - 
        intersection of nonzero and non-nan values
     '''
-    mask = numpy.ones(image_vectors[0].shape)
-    mask *= (image_vectors[0] != 0) & ~numpy.isnan(image_vectors[0])
-    mask *= (image_vectors[1] != 0) & ~numpy.isnan(image_vectors[1])
-    return mask
+    mask = (image_vectors[0] != 0) & ~numpy.isnan(image_vectors[0])
+    mask &= (image_vectors[1] != 0) & ~numpy.isnan(image_vectors[1])
+    return mask.astype(get_output_dtype(dtype=dtype))
 
 def make_in_out_mask(mask_bin,
                      mr_folder,
                      masked_in,
                      masked_out,
                      img_dir,
-                     save_png=True):
+                     save_png=True,
+                     dtype=None,
+                     save_nii=True):
 
-    '''generate masked image, return two images:
+    '''generate masked image, return two images (in memory):
                 voxels in mask, and voxels outside
-    '''
-    mr_in_mask = numpy.zeros(mask_bin.shape)
-    mr_out_mask = numpy.zeros(mask_bin.shape)
-    mr_out_mask[mask_bin.get_data()==0] = masked_out
 
-    mr_out_mask = nibabel.Nifti1Image(mr_out_mask,
-                                      affine=mask_bin.get_affine(),
-                                      header=mask_bin.get_header())
-    mr_in_mask[mask_bin.get_data()!=0] = masked_in
-
-    mr_in_mask = nibabel.Nifti1Image(mr_in_mask,
-                                     affine=mask_bin.get_affine(),
-                                     header=mask_bin.get_header())
-
-    nibabel.save(mr_in_mask,"%s/masked.nii" %(mr_folder))
-    nibabel.save(mr_out_mask,"%s/masked_out.nii" %(mr_folder))
+       save_png: render masked.png and masked_out.png in img_dir, from the
+                 images in memory
+       save_nii: write the in mask image to mr_folder/masked.nii
+    '''
+    mask_data = numpy.asanyarray(mask_bin.dataobj)
+    mr_in_mask = numpy.zeros(mask_bin.shape,dtype=get_output_dtype(masked_in,dtype))
+    mr_out_mask = numpy.zeros(mask_bin.shape,dtype=get_output_dtype(masked_out,dtype))
+    mr_out_mask[mask_data==0] = masked_out
+    mr_in_mask[mask_data!=0] = masked_in
+
+    # The header keeps the type of the values, not of the mask
+    images = []
+    for data in [mr_in_mask,mr_out_mask]:
+        header = mask_bin.get_header().copy()
+        header.set_data_dtype(data.dtype)
+        images.append(nibabel.Nifti1Image(data,
+                                          affine=mask_bin.get_affine(),
+                                          header=header))
+    mr_in_mask,mr_out_mask = images
+
+    if save_nii:
+        nibabel.save(mr_in_mask,"%s/masked.nii" %(mr_folder))
 
     if save_png:
-        make_anat_image("%s/masked.nii" %(mr_folder),
+        make_anat_image(mr_in_mask,
                         png_img_file="%s/masked.png" %(img_dir))
-        make_anat_image("%s/masked_out.nii" %(mr_folder),
+        make_anat_image(mr_out_mask,
                         png_img_file="%s/masked_out.png" %(img_dir))
-    os.remove("%s/masked_out.nii" %(mr_folder))
     return mr_in_mask,mr_out_mask
 
 # THRESHOLDING -----------------------------------------------------------------
@@ -249,7 +711,7 @@ def generate_thresholds(lower=0,upper=4,by=0.01):
         thresholds = thresholds + [(float(x) * by)+ii for x in range(0,100)]
     return thresholds
 
-def apply_threshold(image1,thresh,direction="posneg"):
+def apply_threshold(image1,thresh,direction="posneg",dtype=None):
     '''apply_threshold
     Threshold an image 
 
@@ -262,15 +724,24 @@ def apply_threshold(image1,thresh,direction="posneg"):
         posneg: include both positive and negative values [default]
         pos: include only positive values
         neg: include only negative values
+
+    dtype: precision (see set_precision). With a precision set the
+        thresholded image keeps the data type the data was loaded in.
     '''
 
-    data = image1.get_data()
-    tmp = numpy.zeros(image1.shape)  
+    data = get_image_data(image1,dtype)
+    if get_precision(dtype) is None:
+        tmp = numpy.zeros(image1.shape)
+    else:
+        tmp = numpy.zeros(image1.shape,dtype=data.dtype)
     if direction == "posneg":
-        tmp[numpy.abs(data) >= thresh] = data[numpy.abs(data) >= thresh]  
+        keep = numpy.abs(data) >= thresh
     elif direction == "pos":
-        tmp[data >= thresh] = data[data >= thresh]  
+        keep = data >= thresh
     elif direction == "neg":
-        tmp[data <= thresh] = data[data <= thresh]  
+        keep = data <= thresh
+    else:
+        keep = numpy.zeros(image1.shape,dtype=bool)
+    tmp[keep] = data[keep]
     new_image = nibabel.Nifti1Image(tmp,affine = image1.get_affine(),header=image1.get_header())
     return new_image
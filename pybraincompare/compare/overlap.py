@@ -0,0 +1,127 @@
+'''
+overlap.py: part of pybraincompare package
+Bit-packed validity of images, and counts of overlapping voxels
+
+A voxel of an image is valid when it is nonzero and not nan (the rule of
+make_binary_deletion_mask). The validity of each image is kept as bits,
+eight voxels per byte (1/64 of a float64 mask), and the number of voxels
+every pair of images has in common comes from the packed bits: unpacked a
+block of voxels at a time into a matrix product, or with a popcount of
+the bitwise and for chosen pairs.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import range
+from builtins import object
+import numpy as np
+
+
+# Number of set bits in every byte value
+popcount_table = np.array([bin(x).count("1") for x in range(256)],dtype=np.uint8)
+
+
+class PackedValidity(object):
+    '''
+    Validity (nonzero and not nan) of images in rows, packed into bits
+
+    bits: uint8 matrix from np.packbits(valid,axis=1)
+    number_voxels: number of voxels (columns) before packing
+    '''
+
+    def __init__(self, bits, number_voxels):
+        self.bits = np.ascontiguousarray(bits,dtype=np.uint8)
+        self.number_voxels = int(number_voxels)
+
+    @classmethod
+    def from_valid(cls,valid):
+        '''Pack a boolean matrix (images in rows) of valid voxels'''
+        valid = np.array(valid,dtype=bool,ndmin=2)
+        return cls(np.packbits(valid,axis=1),valid.shape[1])
+
+    @classmethod
+    def from_vectors(cls,data,block_size=256):
+        '''Pack the validity of masked vectors (images in rows)'''
+        data = np.array(data,copy=False,ndmin=2)
+        bits = np.empty((data.shape[0],(data.shape[1] + 7) // 8),dtype=np.uint8)
+        for start in range(0,data.shape[0],block_size):
+            block = data[start:start + block_size]
+            bits[start:start + block_size] = np.packbits((block != 0) & ~np.isnan(block),
+                                                         axis=1)
+        return cls(bits,data.shape[1])
+
+    def __len__(self):
+        return self.bits.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def append(self,other):
+        '''Add the images of another PackedValidity (same voxels)'''
+        if other.number_voxels != self.number_voxels:
+            raise ValueError("Validity must be for the same number of voxels")
+        self.bits = np.vstack([self.bits,other.bits])
+        return self
+
+    def unpack(self,start=0,end=None,dtype=bool):
+        '''Validity of images start:end as a (dtype) matrix'''
+        valid = np.unpackbits(self.bits[start:end],axis=1,
+                              count=self.number_voxels)
+        return valid.astype(dtype,copy=False)
+
+    def unpack_rows(self,rows,dtype=bool):
+        '''Validity of the images at rows (any order) as a (dtype) matrix'''
+        valid = np.unpackbits(self.bits[np.asarray(rows,dtype=np.int64)],axis=1,
+                              count=self.number_voxels)
+        return valid.astype(dtype,copy=False)
+
+    def get_valid(self,i):
+        '''Validity of one image, as a boolean vector'''
+        return self.unpack(i,i + 1)[0]
+
+    def counts(self):
+        '''Number of valid voxels of each image'''
+        return popcount_table[self.bits].sum(axis=1,dtype=np.int64)
+
+    def intersection(self,i,j,other=None):
+        '''Boolean vector of voxels valid in both image i and image j (of
+        other, default this one) - the pairwise deletion mask of the pair'''
+        other = self if other is None else other
+        both = np.bitwise_and(self.bits[i],other.bits[j])
+        return np.unpackbits(both,count=self.number_voxels).astype(bool)
+
+    def pair_counts(self,pairs,other=None):
+        '''Overlap counts for a list of (i,j) pairs, with a popcount of the
+        bitwise and of the packed rows'''
+        other = self if other is None else other
+        pairs = np.array(pairs,dtype=np.int64,ndmin=2)
+        both = np.bitwise_and(self.bits[pairs[:,0]],other.bits[pairs[:,1]])
+        return popcount_table[both].sum(axis=1,dtype=np.int64)
+
+    def overlap_counts(self,other=None,block_size=8192):
+        '''overlap_counts
+        Number of voxels valid in both, for every image here (rows) and in
+        other (columns, default all images here). The bits are unpacked
+        block_size voxels at a time to float32 matrices, and counted with
+        a matrix product (exact, since each block count is below 2**24).
+        '''
+        other = self if other is None else other
+        if other.number_voxels != self.number_voxels:
+            raise ValueError("Validity must be for the same number of voxels")
+        block_size = max(8,min(block_size - block_size % 8,2**24))
+        counts = np.zeros((len(self),len(other)),dtype=np.int64)
+        for start in range(0,self.number_voxels,block_size):
+            end = min(start + block_size,self.number_voxels)
+            columns = slice(start // 8,(end + 7) // 8)
+            block = np.unpackbits(self.bits[:,columns],axis=1,
+                                  count=end - start).astype(np.float32)
+            if other is self:
+                other_block = block
+            else:
+                other_block = np.unpackbits(other.bits[:,columns],axis=1,
+                                            count=end - start).astype(np.float32)
+            counts += np.rint(block.dot(other_block.T)).astype(np.int64)
+        return counts
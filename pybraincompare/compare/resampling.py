@@ -0,0 +1,324 @@
+'''
+resampling.py: part of pybraincompare package
+Resampling with sparse interpolation operators, reused across images
+
+nilearn resample_img works out the interpolation geometry again for every
+image. Here the interpolation from one grid (source affine and shape) to
+another is built once as sparse matrices, and applied to every image on
+that grid as matrix products. When the transform between the grids is
+diagonal (scaling and translation, as between MNI grids) the operator is
+separable, one small matrix per axis, otherwise it is one matrix from
+source voxels to target voxels.
+
+The results are those of resample_img (scipy.ndimage.affine_transform,
+with the same boundary rules and clipping). For continuous interpolation
+(cubic splines) each image is first put through the same spline prefilter
+(scipy.ndimage.spline_filter) that resample_img uses, which is separable
+and cheap, and the operator holds the cubic spline weights.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import range
+from builtins import object
+from scipy.ndimage import spline_filter
+from .cache import get_resample_cache
+from scipy import sparse
+import numpy as np
+import collections
+import nibabel
+
+try:
+    from nilearn.masking import _extrapolate_out_mask
+except ImportError:
+    _extrapolate_out_mask = None
+
+
+interpolation_orders = {"continuous":3, "linear":1, "nearest":0}
+
+
+class ResamplingOperator(object):
+    '''
+    Interpolation from a source grid to a target grid, as sparse matrices
+
+    source_affine, source_shape: grid of the images to resample
+    target_affine, target_shape: grid to resample to (4x4 affine)
+    interpolation: continuous, linear or nearest [default continuous]
+    target_mask: boolean volume on the target grid. If given, only voxels
+        in the mask are interpolated, and transform returns a vector
+    '''
+
+    def __init__(self, source_affine,
+                       source_shape,
+                       target_affine,
+                       target_shape,
+                       interpolation="continuous",
+                       target_mask=None):
+
+        if interpolation not in interpolation_orders:
+            raise ValueError("interpolation must be continuous, linear or nearest")
+        self.order = interpolation_orders[interpolation]
+        self.interpolation = interpolation
+        self.source_shape = tuple(int(x) for x in source_shape[0:3])
+        self.target_shape = tuple(int(x) for x in target_shape[0:3])
+        self.target_affine = np.asarray(target_affine,dtype=np.float64)
+        self.target_mask = None
+        if target_mask is not None:
+            self.target_mask = np.asarray(target_mask,dtype=bool).reshape(self.target_shape)
+
+        # Target voxel coordinates to source voxel coordinates
+        self.source_affine = np.asarray(source_affine,dtype=np.float64)
+        transform = np.linalg.inv(self.source_affine).dot(self.target_affine)
+        self.matrix = transform[0:3,0:3]
+        self.offset = transform[0:3,3]
+        self.separable = np.all(np.diag(np.diag(self.matrix)) == self.matrix)
+
+        if self.separable:
+            self.axes = [self.axis_operator(axis) for axis in range(3)]
+        else:
+            self.operator = self.full_operator()
+
+    def axis_operator(self,axis):
+        '''Sparse matrix (target x source) for one axis of a diagonal transform'''
+        coordinates = self.matrix[axis,axis] * np.arange(self.target_shape[axis]) + \
+                      self.offset[axis]
+        rows,columns,weights = _axis_weights(coordinates,
+                                             self.source_shape[axis],
+                                             self.order)
+        rows = np.repeat(np.arange(len(coordinates)),self.order + 1)
+        return sparse.csr_matrix((weights.ravel(),(rows,columns.ravel())),
+                                 shape=(self.target_shape[axis],self.source_shape[axis]))
+
+    def full_operator(self):
+        '''Sparse matrix (target voxels x source voxels) for any affine'''
+        if self.target_mask is not None:
+            voxels = np.array(np.where(self.target_mask))
+        else:
+            voxels = np.array(np.unravel_index(np.arange(np.prod(self.target_shape)),
+                                               self.target_shape))
+        coordinates = self.matrix.dot(voxels) + self.offset[:,np.newaxis]
+        number_weights = self.order + 1
+
+        # Weights of each target voxel are the product of the axis weights
+        indices = np.zeros((voxels.shape[1],1),dtype=np.int64)
+        weights = np.ones((voxels.shape[1],1))
+        for axis in range(3):
+            rows,axis_columns,axis_weights = _axis_weights(coordinates[axis],
+                                                           self.source_shape[axis],
+                                                           self.order)
+            stride = int(np.prod(self.source_shape[axis+1:]))
+            indices = (indices[:,:,np.newaxis] + axis_columns[:,np.newaxis,:]*stride).reshape(len(indices),-1)
+            weights = (weights[:,:,np.newaxis] * axis_weights[:,np.newaxis,:]).reshape(len(weights),-1)
+
+        keep = weights != 0
+        rows = np.repeat(np.arange(voxels.shape[1]),number_weights**3).reshape(keep.shape)
+        return sparse.csr_matrix((weights[keep],(rows[keep],indices[keep])),
+                                 shape=(voxels.shape[1],int(np.prod(self.source_shape))))
+
+    def apply(self,data):
+        '''Apply the operator to a source volume (already prefiltered)'''
+        if self.separable:
+            result = np.asarray(data,dtype=np.float64)
+            for axis in range(3):
+                result = np.moveaxis(result,axis,0)
+                shape = result.shape
+                result = self.axes[axis].dot(result.reshape(shape[0],-1))
+                result = np.moveaxis(result.reshape((-1,) + shape[1:]),0,axis)
+            if self.target_mask is not None:
+                return result[self.target_mask]
+            return result
+        result = self.operator.dot(np.asarray(data,dtype=np.float64).ravel())
+        if self.target_mask is None:
+            result = result.reshape(self.target_shape)
+        return result
+
+    def transform(self,data):
+        '''transform
+        Resample a volume from the source grid, the same as resample_img
+        (non finite values are extrapolated, then set back to nan where the
+        nearest source voxel is not finite, and values are clipped to the
+        range of the data and 0)
+        '''
+        data = np.asarray(data)
+        if data.ndim == 4 and data.shape[3] == 1:
+            data = data[:,:,:,0]
+        if data.shape != self.source_shape:
+            raise ValueError("Data shape %s does not match the operator source grid %s"
+                             %(data.shape,self.source_shape))
+        vmin = min(data.min(),0)
+        vmax = max(data.max(),0)
+        dtype = _resampled_dtype(data.dtype,self.interpolation)
+
+        not_finite = None
+        if data.dtype.kind not in ["i","u"]:
+            not_finite = ~np.isfinite(data)
+            if not not_finite.any():
+                not_finite = None
+            elif _extrapolate_out_mask is not None:
+                data = _extrapolate_out_mask(data,~not_finite,iterations=2)[0]
+            else:
+                data = np.where(not_finite,0,data)
+
+        if self.order > 1:
+            data = spline_filter(data,self.order,output=np.float64,mode="constant")
+        result = self.apply(data)
+
+        if not_finite is not None:
+            result[self.nearest().apply(not_finite) != 0] = np.nan
+
+        result = result.astype(dtype)
+        np.clip(result,vmin,vmax,out=result)
+        return result
+
+    def nearest(self):
+        '''The nearest neighbour operator between the same grids'''
+        if self.order == 0:
+            return self
+        return get_operator(self.source_affine,self.source_shape,
+                            self.target_affine,self.target_shape,
+                            interpolation="nearest",
+                            target_mask=self.target_mask)
+
+
+def _resampled_dtype(dtype,interpolation):
+    '''Data type of resample_img results: integers are cast to floats of the
+    same size (at least float32) for continuous interpolation'''
+    if interpolation == "continuous" and dtype.kind == "i":
+        name = dtype.name.replace("int","float")
+        if name in ["float8","float16"]:
+            name = "float32"
+        return np.dtype(name)
+    return dtype
+
+
+def _axis_weights(coordinates,length,order):
+    '''_axis_weights
+    Source indices and weights along one axis, for each coordinate, with
+    the rules of scipy.ndimage in constant mode: coordinates outside
+    [0,length-1] get no weight (the fill value 0), and neighbours beyond
+    the edges are mirrored.
+    '''
+    coordinates = np.asarray(coordinates,dtype=np.float64)
+    if order % 2:
+        start = np.floor(coordinates).astype(np.int64) - order // 2
+    else:
+        start = np.floor(coordinates + 0.5).astype(np.int64) - order // 2
+    columns = start[:,np.newaxis] + np.arange(order + 1)
+    t = coordinates - np.floor(coordinates)
+    if order == 0:
+        weights = np.ones((len(coordinates),1))
+    elif order == 1:
+        weights = np.column_stack([1 - t,t])
+    elif order == 3:
+        weights = np.column_stack([(1 - t)**3,
+                                   4 - 6*t**2 + 3*t**3,
+                                   1 + 3*t + 3*t**2 - 3*t**3,
+                                   t**3]) / 6.0
+    else:
+        raise ValueError("Interpolation order must be 0, 1 or 3")
+
+    outside = (coordinates < 0) | (coordinates > length - 1)
+    weights[outside] = 0
+    columns = _mirror(columns,length)
+    rows = np.repeat(np.arange(len(coordinates)),order + 1)
+    return rows,columns,weights
+
+
+def _mirror(indices,length):
+    '''Mirror indices beyond the edges back into [0,length)'''
+    if length == 1:
+        return np.zeros_like(indices)
+    period = 2*(length - 1)
+    indices = np.abs(indices) % period
+    return np.where(indices >= length,period - indices,indices)
+
+
+# Operators for recent pairs of grids, reused across calls
+operator_cache = collections.OrderedDict()
+operator_cache_size = 8
+
+def get_operator(source_affine,source_shape,target_affine,target_shape,
+                 interpolation="continuous",target_mask=None):
+    '''Return a ResamplingOperator for two grids, built once (kept in a
+    bounded cache, operator_cache, keyed by the grids and interpolation)'''
+    mask_key = None
+    if target_mask is not None:
+        mask_key = np.packbits(np.asarray(target_mask,dtype=bool)).tobytes()
+    key = (np.asarray(source_affine,dtype=np.float64).tobytes(),
+           tuple(source_shape[0:3]),
+           np.asarray(target_affine,dtype=np.float64).tobytes(),
+           tuple(target_shape[0:3]),
+           interpolation,
+           mask_key)
+    if key in operator_cache:
+        operator_cache.move_to_end(key)
+        return operator_cache[key]
+    operator = ResamplingOperator(source_affine,source_shape,
+                                  target_affine,target_shape,
+                                  interpolation=interpolation,
+                                  target_mask=target_mask)
+    operator_cache[key] = operator
+    while len(operator_cache) > operator_cache_size:
+        operator_cache.popitem(last=False)
+    return operator
+
+
+def resample_images(images,target_affine,target_shape,
+                    interpolation="continuous",target_mask=None,cache=None):
+    '''resample_images
+    Resample nibabel images to one target grid, like resample_img on each.
+    Images are grouped by their grid, and one operator is built per grid.
+
+    images: list of nibabel.Nifti1Image
+    target_affine, target_shape: the grid to resample to (4x4 affine)
+    interpolation: continuous, linear or nearest [default continuous]
+    target_mask: boolean volume on the target grid. If given, a vector of
+        the values in the mask is returned for each image, not an image
+    cache: a ResampleCache or directory, for whole images (no target_mask)
+        [default the cache from set_resample_cache, if any]
+
+    Returns resampled images (or vectors), in the order of images
+    '''
+    target_affine = np.asarray(target_affine,dtype=np.float64)
+    target_shape = tuple(int(x) for x in target_shape[0:3])
+    if target_mask is None:
+        cache = get_resample_cache(cache)
+    else:
+        cache = None
+
+    resampled = [None] * len(images)
+    keys = dict()
+    groups = collections.OrderedDict()
+    for i,image in enumerate(images):
+
+        # Images already on the target grid are not resampled
+        if target_mask is None and np.allclose(image.affine,target_affine) and \
+           tuple(image.shape[0:3]) == target_shape:
+            resampled[i] = image
+            continue
+
+        if cache is not None:
+            keys[i] = cache.get_key(image,target_affine,target_shape,interpolation)
+            resampled[i] = cache.get(keys[i])
+            if resampled[i] is not None:
+                continue
+
+        grid = (image.affine.tobytes(),tuple(image.shape[0:3]))
+        groups.setdefault(grid,[]).append(i)
+
+    for grid,members in groups.items():
+        image = images[members[0]]
+        operator = get_operator(image.affine,image.shape,
+                                target_affine,target_shape,
+                                interpolation=interpolation,
+                                target_mask=target_mask)
+        for i in members:
+            data = operator.transform(np.asanyarray(images[i].dataobj))
+            if target_mask is None:
+                data = nibabel.Nifti1Image(data,affine=target_affine)
+                if cache is not None:
+                    cache.put(keys[i],data)
+            resampled[i] = data
+    return resampled
@@ -123,7 +123,9 @@ def scatterplot_compare_vector(image_vector1,
     and embed in your page.
     '''
 
-    if len(image_vector1) == len(image_vector2) == len(atlas_vector) == len(atlas_labels) == len(atlas_colors):
+    # Labels and colors can be per region (dictionaries) or per voxel
+    per_voxel = [x for x in [atlas_labels,atlas_colors] if not isinstance(x,dict)]
+    if all(len(x) == len(image_vector1) for x in [image_vector2,atlas_vector] + per_voxel):
 
         # Calculate a binary deletion vector - eliminating zeros and nans.
         pdmask = make_binary_deletion_vector([image_vector1,image_vector2])
@@ -136,8 +138,10 @@ def scatterplot_compare_vector(image_vector1,
             image_vector1 = image_vector1[pdmask_idx]
             image_vector2 = image_vector2[pdmask_idx]
             atlas_vector = np.array(atlas_vector)[pdmask_idx]
-            atlas_labels = np.array(atlas_labels)[pdmask_idx]
-            atlas_colors = np.array(atlas_colors)[pdmask_idx]
+            if not isinstance(atlas_labels,dict):
+                atlas_labels = np.array(atlas_labels)[pdmask_idx]
+            if not isinstance(atlas_colors,dict):
+                atlas_colors = np.array(atlas_colors)[pdmask_idx]
 
             if subsample_every != None:
                 sample_index = np.arange(0,len(image_vector1),
@@ -146,15 +150,17 @@ def scatterplot_compare_vector(image_vector1,
                 image_vector1 = image_vector1[sample_index]
                 image_vector2 = image_vector2[sample_index]
                 atlas_vector = atlas_vector[sample_index]
-                atlas_labels = atlas_labels[sample_index]
-                atlas_colors = atlas_colors[sample_index]
+                if not isinstance(atlas_labels,dict):
+                    atlas_labels = atlas_labels[sample_index]
+                if not isinstance(atlas_colors,dict):
+                    atlas_colors = atlas_colors[sample_index]
       
             corrs_df = calculate_atlas_correlation(image_vector1,
                                                    image_vector2,
                                                    atlas_vector,
                                                    atlas_labels,
                                                    atlas_colors,
-                                                   corr_type="pearson",
+                                                   corr_type=corr_type,
                                                    summary=False)
             error = None
 
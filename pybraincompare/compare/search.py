@@ -27,6 +27,7 @@ from .maths import calculate_correlation
 import numpy as np
 import collections
 import pandas
+import json
 import nibabel
 import os
 
@@ -47,7 +48,9 @@ def similarity_search(image_scores,
                       top_text=None,
                       bottom_text=None,
                       container_width=940,
-                      remove_scripts=None):
+                      remove_scripts=None,
+                      json_data=False,
+                      columns=None):
 
     """similarity_search: interface to see most similar brain images.
     image_scores: list of image scores
@@ -67,42 +70,48 @@ def similarity_search(image_scores,
     bottom_text: a list of text labels to show on bottoms of images [OPTIONAL]
     remove_scripts: list of strings corresponding to js or css template 
                     tags to remove [OPTIONAL]
+    json_data: ship results as a compact json payload that the page renders,
+               instead of html for each result (smaller and faster to make
+               for many results) [default False]
+    columns: SearchColumns made once for many queries of the same images,
+             instead of tags, png_paths, image_ids, top_text and bottom_text
+             [OPTIONAL]
     """
 
 
     # Get template
     template = get_template("similarity_search")
 
-    if query_id not in image_ids:
+    if columns is None:
+        if len(tags) != len(png_paths) or len(png_paths) != len(image_ids):
+            print("ERROR: Number of image paths, tags, image_ids must be equal")
+            return
+        columns = SearchColumns(png_paths=png_paths,
+                                tags=tags,
+                                image_ids=image_ids,
+                                top_text=top_text,
+                                bottom_text=bottom_text)
+
+    if query_id not in columns.positions:
         print("ERROR: Query id must be in list of image ids!")
         return
 
-    if len(tags) != len(png_paths) != len(image_ids):
-        print("ERROR: Number of image paths, tags, image_ids must be equal")
-        return
-
-    if query_png not in png_paths: 
+    if query_png not in columns.png_set: 
         print("ERROR: Query image png path must be in data frame 'png' paths!") 
         return
 
-    corr_df = pandas.DataFrame() 
-    corr_df["png"] = png_paths
-    corr_df["tags"] = tags
-    corr_df["scores"] = image_scores
-    corr_df["image_ids"] = image_ids
-    corr_df["top_text"] = top_text
-    corr_df["bottom_text"] = bottom_text
-    corr_df.index = image_ids
-
     html_snippet = calculate_similarity_search(template=template,
-                                               corr_df=corr_df,
+                                               corr_df=None,
+                                               columns=columns,
+                                               image_scores=image_scores,
                                                query_png=query_png,
                                                query_id=query_id,
                                                button_url=button_url,
                                                image_url=image_url,
                                                max_results=max_results,
                                                absolute_value=absolute_value,
-                                               container_width=container_width)
+                                               container_width=container_width,
+                                               json_data=json_data)
 
     if remove_scripts != None:
         if isinstance(remove_scripts,str): 
@@ -122,7 +131,10 @@ def calculate_similarity_search(template,
                                 max_results,
                                 absolute_value,
                                 container_width,
-                                responsive=True):
+                                responsive=True,
+                                json_data=False,
+                                columns=None,
+                                image_scores=None):
 
     """Generate web interface for similarity search
     template: html template (similarity_search)
@@ -130,6 +142,8 @@ def calculate_similarity_search(template,
     query_id: id of the query image, to look up in corr_df
     corr_df: matrix of correlation values for images, with "png" column 
              corresponding to image paths, "tags" corresponding to 
+             tags, and "scores", "image_ids", "top_text", "bottom_text".
+             Not needed if columns and image_scores are given.
     button_url: prefix of url that the "compare" button will link to.
                 format will be prefix/[query_id]/[other_id]
     image_url: prefix of the url that the "view" button will link to.
@@ -138,30 +152,28 @@ def calculate_similarity_search(template,
     absolute_value: return absolute value of score (default=True)
     responsive: for larger number of returned results: will load
                 images only when scrolled to.
+    json_data: render results in the page from a json payload [default False]
+    columns: SearchColumns of the images, with image_scores in the same order
     """
 
-    query_row = corr_df[corr_df["png"] == query_png]
-    
-    # Sort based on (absolute value of) similarity score
-    if absolute_value: 
-        query_similar = corr_df["scores"].abs()
-        query_similar.sort(ascending=False)
-        query_similar = corr_df.loc[query_similar.index]
-    else: 
-        query_similar = corr_df.sort(columns="scores", ascending=False)
-  
-    # Remove the query image, and cut down to 100 results
-    query_similar = query_similar[query_similar.index != query_id]
-    if query_similar.shape[0] > max_results:
-        query_similar = query_similar[0:max_results]
+    if columns is None:
+        columns = SearchColumns.from_df(corr_df)
+        image_scores = corr_df["scores"].values
+
+    # Top results by (absolute value of) similarity score, without the query
+    top = rank_top_scores(image_scores,
+                          max_results=max_results,
+                          absolute_value=absolute_value,
+                          exclude=columns.get_positions(query_id))
 
     # Prepare data for show_similarity_search
-    image_ids = query_similar.image_ids.tolist()
-    all_tags = query_similar.tags.tolist()
-    scores = np.round(query_similar.scores.values,2)
-    png_images = query_similar.png.tolist()
-    top_text = query_similar.top_text.tolist()
-    bottom_text = query_similar.bottom_text.tolist()
+    results = columns.gather(top)
+    image_ids = results["image_ids"]
+    all_tags = results["tags"]
+    scores = np.round(np.asarray(image_scores,dtype=np.float64)[top],2)
+    png_images = results["png"]
+    top_text = results["top_text"]
+    bottom_text = results["bottom_text"]
 
     # Get the unique tags
     unique_tags = unwrap_list_unique(all_tags)
@@ -172,23 +184,130 @@ def calculate_similarity_search(template,
     button_urls = ["%s/%s/%s" %(button_url,query_id,x) for x in image_ids]
     image_urls = ["%s/%s" %(image_url,x) for x in image_ids]
 
-    portfolio = create_glassbrain_portfolio(image_paths=png_images,
-                                            all_tags=all_tags,
-                                            unique_tags=unique_tags,
-                                            placeholders=placeholders,
-                                            values=scores,
-                                            button_urls=button_urls,
-                                            image_urls=image_urls,
-                                            top_text=top_text,
-                                            bottom_text=bottom_text)
+    if json_data:
+        create_portfolio = create_glassbrain_portfolio_json
+    else:
+        create_portfolio = create_glassbrain_portfolio
+    portfolio = create_portfolio(image_paths=png_images,
+                                 all_tags=all_tags,
+                                 unique_tags=unique_tags,
+                                 placeholders=placeholders,
+                                 values=scores,
+                                 button_urls=button_urls,
+                                 image_urls=image_urls,
+                                 top_text=top_text,
+                                 bottom_text=bottom_text)
 
     elements = {"SIMILARITY_PORTFOLIO":portfolio,
                 "CONTAINER_WIDTH":container_width}
     template = add_string(elements,template)
+    # The query image tag is in the portfolio filters, filled after they are added
     html_snippet = add_string({"QUERY_IMAGE":query_png},template)
     return html_snippet
 
 
+def rank_top_scores(scores,max_results=100,absolute_value=True,exclude=None):
+    '''rank_top_scores
+    Positions of the max_results highest scores (or absolute values of
+    scores), best first (ties in order of position), without a full sort.
+    Scores that are nan come last, and positions in exclude are left out.
+
+    For many scores, a threshold from a strided sample of the scores first
+    keeps a small set of candidates (every score at or above it), and only
+    those are partitioned. If fewer than max_results pass, all scores are.
+    '''
+    key = np.array(scores,dtype=np.float64)
+    if absolute_value:
+        np.abs(key,out=key)
+    missing = np.isnan(key)
+    if missing.any():
+        key[missing] = -np.inf
+    exclude = np.unique(np.asarray([] if exclude is None else exclude,dtype=np.int64))
+    key[exclude] = -np.inf
+    k = min(max(int(max_results),0) + len(exclude),len(key))
+    if k == 0:
+        return np.zeros(0,dtype=np.int64)
+
+    candidates = None
+    if len(key) > 16*k and len(key) > 4096:
+        sample = key[::len(key) // 4096]
+        rank = min(len(sample) - 1,int(2 * k * len(sample) / len(key)) + 1)
+        threshold = np.partition(sample,len(sample) - 1 - rank)[len(sample) - 1 - rank]
+        candidates = np.flatnonzero(key >= threshold)
+        if len(candidates) < k:
+            candidates = None
+
+    # Every score tied with the last one selected is kept, for the order
+    values = key if candidates is None else key[candidates]
+    if k < len(values):
+        top = np.argpartition(values,len(values) - k)[len(values) - k:]
+        top = np.flatnonzero(values >= values[top].min())
+    else:
+        top = np.arange(len(values))
+    if candidates is not None:
+        top = candidates[top]
+    top = top[np.lexsort((top,-key[top]))]
+    if len(exclude) > 0:
+        top = top[~np.in1d(top,exclude)]
+    return top[0:max(int(max_results),0)]
+
+
+class SearchColumns(object):
+    '''
+    Result fields of the images of a search (png paths, tags, ids, top and
+    bottom text), held once as arrays. The fields of the top results for
+    each query are gathered by position.
+    '''
+
+    def __init__(self, png_paths, tags, image_ids, top_text=None, bottom_text=None):
+        self.png = _object_array(png_paths)
+        self.tags = _object_array(tags)
+        self.image_ids = _object_array(image_ids)
+        self.top_text = None if top_text is None else _object_array(top_text)
+        self.bottom_text = None if bottom_text is None else _object_array(bottom_text)
+        if not len(self.png) == len(self.tags) == len(self.image_ids):
+            raise ValueError("Number of image paths, tags, image_ids must be equal")
+        self.positions = dict()
+        for i,image_id in enumerate(image_ids):
+            self.positions.setdefault(image_id,[]).append(i)
+        self.png_set = set(png_paths)
+
+    @classmethod
+    def from_df(cls,corr_df):
+        '''Columns from a data frame with png, tags, image_ids, top_text
+        and bottom_text columns (as calculate_similarity_search took)'''
+        return cls(png_paths=corr_df["png"].tolist(),
+                   tags=corr_df["tags"].tolist(),
+                   image_ids=corr_df.index.tolist(),
+                   top_text=corr_df["top_text"].tolist() if "top_text" in corr_df else None,
+                   bottom_text=corr_df["bottom_text"].tolist() if "bottom_text" in corr_df else None)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def get_positions(self,image_id):
+        return self.positions.get(image_id,[])
+
+    def gather(self,positions):
+        '''Fields (lists) of the images at positions, in that order'''
+        return {"png":self.png[positions].tolist(),
+                "tags":self.tags[positions].tolist(),
+                "image_ids":self.image_ids[positions].tolist(),
+                "top_text":None if self.top_text is None else self.top_text[positions].tolist(),
+                "bottom_text":None if self.bottom_text is None else self.bottom_text[positions].tolist()}
+
+
+def _object_array(values):
+    '''1D object array of values (keeps lists, eg of tags, as elements)'''
+    array = np.empty(len(values),dtype=object)
+    for i,value in enumerate(values):
+        array[i] = value
+    return array
+
+
+# Shown until a portfolio image is scrolled to
+glass_brain_loading = "http://placehold.it/324x128&text=Loading..."
+
 def create_glassbrain_portfolio(image_paths,
                                 all_tags,
                                 unique_tags,
@@ -196,48 +315,129 @@ def create_glassbrain_portfolio(image_paths,
                                 button_urls=None,
                                 image_urls=None,
                                 top_text=None,
-                                bottom_text=None):
-
-    '''Base brainglass portfolio for image comparison'''
+                                bottom_text=None,
+                                sink=None):
 
-    # Create portfolio filters
-    portfolio_filters = '<div class="row"><div class="col-md-8" style="padding-left:20px"><ul class="portfolio-filter">\n<li><a class="btn btn-default active" href="#" data-filter="*">All</a></li>'     
+    '''Base brainglass portfolio for image comparison. Markup is written to
+    sink (anything with a write method, eg an open file) as each item is
+    made, and the sink is returned. Without a sink, the markup is returned
+    as one string, joined once.'''
 
-    # Get loading message image
-    glass_brain_loading = "http://placehold.it/324x128&text=Loading..."
-
-    for t in range(0,len(unique_tags)):
-        tag = unique_tags[t]; 
-        placeholder = placeholders[tag]      
-        portfolio_filters = '%s<li><a class="btn btn-default" href="#" data-filter=".%s">%s</a></li>\n' %(portfolio_filters, placeholder, tag) 
-    portfolio_filters = '%s</ul><!--/#portfolio-filter--></div><div>\n' %(portfolio_filters)
-    portfolio_filters = '%s<img class = "query_image" src="[QUERY_IMAGE]"/></div></div>' %(portfolio_filters)
+    parts = []
+    write = parts.append if sink is None else sink.write
+    write(create_portfolio_filters(unique_tags,placeholders))
 
     # Create portfolio items
-    portfolio_items = '<ul class="portfolio-items col-3">'
-
+    write('<ul class="portfolio-items col-3">')
     for i in range(0,len(image_paths)):
-        image = image_paths[i]    
-        portfolio_items = '%s<li class="portfolio-item ' %(portfolio_items) 
-        image_tags = all_tags[i]
-        if image_urls != None: image_url = image_urls[i]
-        else: image_url = image
-        if top_text != None: ttext = "%s" %(top_text[i])
-        else: ttext = ""
-        if bottom_text != None: btext = "%s" %(bottom_text[i])
-        else: btext = ""
-        if values != None: value = values[i]
-        else: value = image
-        if button_urls != None: button_url = button_urls[i]
-        else: button_url = image
-        for it in image_tags:
-            portfolio_items = '%s %s ' %(portfolio_items,placeholders[it])
-        if i != (len(image_paths)-1):
-            portfolio_items = '%s" style="position: absolute; left: 303px; top: 0px;">\n<div class="item-inner">\n<h5><span style="color:#FF8C00; align:right">%s</span></h5>\n<img data-layzr="%s" src="%s" alt="">\n' %(portfolio_items,ttext,image,glass_brain_loading)
-            portfolio_items = '%s\n<h5>Score: %s <span style="color:#FF8C00;">%s</span></h5>\n<div class="overlay"><a class="preview btn btn-danger" href="%s">compare</i></a><a class="preview btn btn-success" href="%s">view</i></a></div></div></li><!--/.portfolio-item-->' %(portfolio_items,value,btext,button_url,image_url)
-        else:
-            portfolio_items = '%s" style="position: absolute; left: 303px; top: 0px;">\n<div class="item-inner">\n<h5><span style="color:#FF8C00; align:right">%s</span></h5>\n<img data-layzr="%s" src="%s" alt="" onload="imgLoaded(this)">\n' %(portfolio_items,ttext,image,glass_brain_loading)
-            portfolio_items = '%s\n<h5>Score: %s <span style="color:#FF8C00;">%s</span></h5>\n<div class="overlay"><a class="preview btn btn-danger" href="%s">compare</i></a><a class="preview btn btn-success" href="%s">view</i></a></div></div></li><!--/.portfolio-item-->' %(portfolio_items,value,btext,button_url,image_url)
-    portfolio_items = '%s\n</ul>' %(portfolio_items)                
-    portfolio = '%s%s' %(portfolio_filters,portfolio_items)
-    return portfolio
+        image = image_paths[i]
+        write(create_portfolio_item(image=image,
+                                    classes=[placeholders[it] for it in all_tags[i]],
+                                    value=image if values is None else values[i],
+                                    button_url=image if button_urls is None else button_urls[i],
+                                    image_url=image if image_urls is None else image_urls[i],
+                                    top_text="" if top_text is None else top_text[i],
+                                    bottom_text="" if bottom_text is None else bottom_text[i],
+                                    last=(i == len(image_paths)-1)))
+    write('\n</ul>')
+    if sink is None:
+        return "".join(parts)
+    return sink
+
+
+def create_portfolio_filters(unique_tags,placeholders):
+    '''Filter buttons (one per tag) and the query image of a portfolio'''
+    filters = ['<div class="row"><div class="col-md-8" style="padding-left:20px"><ul class="portfolio-filter">\n<li><a class="btn btn-default active" href="#" data-filter="*">All</a></li>']
+    for tag in unique_tags:
+        filters.append('<li><a class="btn btn-default" href="#" data-filter=".%s">%s</a></li>\n' %(placeholders[tag], tag))
+    filters.append('</ul><!--/#portfolio-filter--></div><div>\n')
+    filters.append('<img class = "query_image" src="[QUERY_IMAGE]"/></div></div>')
+    return "".join(filters)
+
+
+def create_portfolio_item(image,classes,value,button_url,image_url,
+                          top_text="",bottom_text="",last=False):
+    '''Markup of one portfolio item, the last one tells the page when it is
+    loaded'''
+    onload = ' onload="imgLoaded(this)"' if last else ''
+    return '<li class="portfolio-item %s" style="position: absolute; left: 303px; top: 0px;">\n<div class="item-inner">\n<h5><span style="color:#FF8C00; align:right">%s</span></h5>\n<img data-layzr="%s" src="%s" alt=""%s>\n\n<h5>Score: %s <span style="color:#FF8C00;">%s</span></h5>\n<div class="overlay"><a class="preview btn btn-danger" href="%s">compare</i></a><a class="preview btn btn-success" href="%s">view</i></a></div></div></li><!--/.portfolio-item-->' %("".join(" %s " %(c) for c in classes),top_text,image,glass_brain_loading,onload,value,bottom_text,button_url,image_url)
+
+
+# Renders portfolio items in the page from create_portfolio_data, with the
+# same markup as create_portfolio_item
+portfolio_renderer = '''<script>
+(function(data){
+    function column(values,i){ return values[0] + values[1][i]; }
+    var items = [], number = data.score.length;
+    for (var i = 0; i < number; i++) {
+        var classes = "", image = column(data.png,i);
+        for (var j = 0; j < data.tags[i].length; j++) {
+            classes += " " + data.placeholders[data.tags[i][j]] + " ";
+        }
+        items.push('<li class="portfolio-item ' + classes + '" style="position: absolute; left: 303px; top: 0px;">\\n<div class="item-inner">\\n<h5><span style="color:#FF8C00; align:right">' +
+                   (data.top ? data.top[i] : "") + '</span></h5>\\n<img data-layzr="' + image + '" src="' + data.loading + '" alt=""' +
+                   (i == number - 1 ? ' onload="imgLoaded(this)"' : '') + '>\\n\\n<h5>Score: ' + data.score[i] +
+                   ' <span style="color:#FF8C00;">' + (data.bottom ? data.bottom[i] : "") +
+                   '</span></h5>\\n<div class="overlay"><a class="preview btn btn-danger" href="' + column(data.button,i) +
+                   '">compare</i></a><a class="preview btn btn-success" href="' + column(data.view,i) +
+                   '">view</i></a></div></div></li><!--/.portfolio-item-->');
+    }
+    document.getElementById("portfolio-items").innerHTML = items.join("");
+})(%s);
+</script>'''
+
+
+def create_portfolio_data(image_paths,
+                          all_tags,
+                          unique_tags,
+                          placeholders,
+                          values=None,
+                          button_urls=None,
+                          image_urls=None,
+                          top_text=None,
+                          bottom_text=None):
+
+    '''Compact payload of portfolio items for portfolio_renderer: tags as
+    indices, and strings (image paths, urls) as a shared prefix and the
+    rest of each string'''
+    image_paths = [str(x) for x in image_paths]
+    tag_index = dict((tag,t) for t,tag in enumerate(unique_tags))
+    data = {"placeholders":[placeholders[tag] for tag in unique_tags],
+            "tags":[[tag_index[tag] for tag in tags] for tags in all_tags],
+            "score":image_paths if values is None else [_to_json(x) for x in values],
+            "png":_compact_strings(image_paths),
+            "button":_compact_strings(image_paths if button_urls is None else button_urls),
+            "view":_compact_strings(image_paths if image_urls is None else image_urls),
+            "loading":glass_brain_loading}
+    if top_text is not None:
+        data["top"] = ["%s" %(x) for x in top_text]
+    if bottom_text is not None:
+        data["bottom"] = ["%s" %(x) for x in bottom_text]
+    return data
+
+
+def create_glassbrain_portfolio_json(image_paths,
+                                     all_tags,
+                                     unique_tags,
+                                     placeholders,
+                                     **kwargs):
+
+    '''Portfolio filters, an empty list of items, and a script that fills
+    the items in the page from a compact json payload (see
+    create_portfolio_data), for many results'''
+    data = create_portfolio_data(image_paths,all_tags,unique_tags,placeholders,**kwargs)
+    payload = json.dumps(data,separators=(",",":")).replace("</","<\\/")
+    return "".join([create_portfolio_filters(unique_tags,placeholders),
+                    '<ul class="portfolio-items col-3" id="portfolio-items"></ul>\n',
+                    portfolio_renderer %(payload)])
+
+
+def _compact_strings(strings):
+    strings = ["%s" %(x) for x in strings]
+    prefix = os.path.commonprefix(strings) if strings else ""
+    return [prefix,[x[len(prefix):] for x in strings]]
+
+def _to_json(value):
+    if isinstance(value,(np.integer,np.floating)):
+        return value.item()
+    return value
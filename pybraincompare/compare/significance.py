@@ -0,0 +1,235 @@
+'''
+significance.py: part of pybraincompare package
+Permutation and bootstrap significance for image correlations
+
+Parametric p-values (from pearsonr/spearmanr) assume independent voxels,
+which neighbouring voxels are not. The functions here build null (or
+bootstrap) distributions instead. Resamples are generated in batches as
+index matrices (one row per resample), and the correlations of a whole
+batch, for every region at once, come from grouped sums with np.bincount.
+Each batch has its own seed (spawned from one SeedSequence), so results
+depend on the seed only, not on the number of workers.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import str
+from builtins import range
+from concurrent.futures import ProcessPoolExecutor
+from .maths import _grouped_rankdata
+import numpy as np
+import pandas
+
+
+def calculate_correlation_significance(image_vector1,
+                                       image_vector2,
+                                       corr_type="pearson",
+                                       atlas_vector=None,
+                                       method="permutation",
+                                       n_resamples=1000,
+                                       block_size=None,
+                                       batch_size=None,
+                                       n_jobs=None,
+                                       seed=None,
+                                       pairwise_deletion=True):
+
+    '''calculate_correlation_significance
+    Correlation of two image vectors, with a p-value from resampling
+
+    image_vector1,image_vector2: vectors of equal length with image values
+
+    corr_type: str
+        pearson or spearman [default pearson]
+
+    atlas_vector: vector of region labels, same length as the image vectors.
+        If given, the correlation and p-value of every region is returned,
+        and permutations shuffle voxels within regions only [optional]
+
+    method: str
+        permutation: shuffle one image against the other, a null
+                     distribution for no association [default]
+        bootstrap: resample blocks of block_size consecutive voxels with
+                   replacement, which keeps the spatial autocorrelation
+                   within blocks. The p-value is for the bootstrap
+                   distribution, centered on the observed value, reaching
+                   zero (for spearman the ranks are fixed before resampling)
+
+    n_resamples: int
+        number of permutations or bootstrap samples [default 1000]
+
+    block_size: int
+        voxels per bootstrap block [default: cube root of the voxel count]
+
+    batch_size: int
+        resamples evaluated together [default: about 2**24 values per batch]
+
+    n_jobs: int
+        number of worker processes for batches [default None, serial]
+
+    seed: int or numpy.random.SeedSequence, for reproducible resamples
+
+    pairwise_deletion: boolean
+        skip voxels that are zero or nan in either image [default True]
+
+    Returns a data frame (indexed by region label as str(int(label)), or
+    "brain" without an atlas) with the correlation, the two sided p-value
+    and the number of voxels, and the resampled correlations (resamples in
+    rows, in the same column order as the data frame).
+    '''
+    if corr_type not in ["pearson","spearman"]:
+        raise ValueError("corr_type must be pearson or spearman")
+    if method not in ["permutation","bootstrap"]:
+        raise ValueError("method must be permutation or bootstrap")
+
+    x = np.asarray(image_vector1,dtype=np.float64).ravel()
+    y = np.asarray(image_vector2,dtype=np.float64).ravel()
+    regional = atlas_vector is not None
+    if not regional:
+        atlas_vector = np.zeros(len(x))
+    atlas_vector = np.asarray(atlas_vector,dtype=np.float64).ravel()
+    if not len(x) == len(y) == len(atlas_vector):
+        raise ValueError("Image and atlas vectors must be of equal length")
+
+    keep = np.isfinite(x) & np.isfinite(y) & ~np.isnan(atlas_vector)
+    if pairwise_deletion:
+        keep &= (x != 0) & (y != 0)
+    x, y = x[keep], y[keep]
+    labels,codes = np.unique(atlas_vector[keep],return_inverse=True)
+    codes = codes.ravel()
+    n_regions = len(labels)
+
+    # Voxels ordered by region, standardized within region
+    order = np.argsort(codes,kind="stable")
+    x, y, codes = x[order], y[order], codes[order]
+    if corr_type == "spearman":
+        x = _grouped_rankdata(x,codes)
+        y = _grouped_rankdata(y,codes)
+    x = _standardize_groups(x,codes,n_regions)
+    y = _standardize_groups(y,codes,n_regions)
+
+    observed = _batch_correlations(x[np.newaxis,:],y[np.newaxis,:],
+                                   codes[np.newaxis,:],n_regions)[0]
+
+    # Split resamples into batches, each with its own seed
+    if block_size is None:
+        block_size = max(1,int(round(len(x) ** (1/3.0))))
+    if batch_size is None:
+        batch_size = max(1,min(n_resamples,2**24 // max(1,len(x))))
+    batches = [min(batch_size,n_resamples - start)
+               for start in range(0,n_resamples,batch_size)]
+    if not isinstance(seed,np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    tasks = [(x,y,codes,n_regions,method,block_size,size,child)
+             for size,child in zip(batches,seed.spawn(len(batches)))]
+
+    if n_jobs is not None and n_jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            null = list(executor.map(_resample_batch,tasks))
+    else:
+        null = [_resample_batch(task) for task in tasks]
+    null = np.vstack(null) if null else np.zeros((0,n_regions))
+
+    # Two sided p-values, counting the observed value as one resample
+    with np.errstate(invalid="ignore"):
+        if method == "permutation":
+            extreme = np.abs(null) >= np.abs(observed) - 1e-12
+        else:
+            extreme = np.abs(null - observed) >= np.abs(observed) - 1e-12
+    valid = ~np.isnan(null)
+    pvalues = (1 + (extreme & valid).sum(axis=0)) / (1.0 + valid.sum(axis=0))
+    pvalues[np.isnan(observed)] = np.nan
+
+    if regional:
+        index = [str(int(l)) for l in labels]
+    else:
+        index = ["brain"]
+    result = pandas.DataFrame({"correlation":observed,
+                               "pvalue":pvalues,
+                               "voxels":np.bincount(codes,minlength=n_regions)},
+                              index=index,
+                              columns=["correlation","pvalue","voxels"])
+    return result, null
+
+
+def permutation_indices(codes,n_resamples,rng):
+    '''permutation_indices
+    Index matrix (resamples x voxels) that shuffles voxels within groups.
+    codes must be sorted (voxels ordered by group), and the group of each
+    voxel is kept: sorting codes plus a uniform [0,1) key shuffles within.
+    '''
+    keys = rng.random((n_resamples,len(codes)))
+    keys += codes
+    return np.argsort(keys,axis=1,kind="stable")
+
+
+def block_bootstrap_indices(n_voxels,n_resamples,block_size,rng):
+    '''block_bootstrap_indices
+    Index matrix (resamples x voxels) of blocks of block_size consecutive
+    voxels, with start positions drawn with replacement (moving blocks)
+    '''
+    block_size = max(1,min(block_size,n_voxels))
+    n_blocks = -(-n_voxels // block_size)
+    starts = rng.integers(0,n_voxels - block_size + 1,
+                          size=(n_resamples,n_blocks))
+    indices = starts[:,:,np.newaxis] + np.arange(block_size)
+    return indices.reshape(n_resamples,-1)[:,:n_voxels]
+
+
+def _resample_batch(task):
+    '''Correlations of one batch of resamples (run in a worker process)'''
+    x,y,codes,n_regions,method,block_size,n_resamples,seed = task
+    rng = np.random.default_rng(seed)
+    if len(x) == 0:
+        return np.full((n_resamples,n_regions),np.nan)
+    if method == "permutation":
+        # Shuffling within regions keeps each region standardized
+        indices = permutation_indices(codes,n_resamples,rng)
+        return _batch_correlations(x[np.newaxis,:],y[indices],
+                                   codes[np.newaxis,:],n_regions,
+                                   standardized=True)
+    indices = block_bootstrap_indices(len(x),n_resamples,block_size,rng)
+    return _batch_correlations(x[indices],y[indices],codes[indices],n_regions)
+
+
+def _batch_correlations(x,y,codes,n_regions,standardized=False):
+    '''batch_correlations
+    Correlation in every region for every row of x,y (resamples x voxels).
+    Each row and region is a group of a single bincount, with the key
+    row * n_regions + code. If x and y are standardized within regions
+    (mean 0, variance 1) only the cross products are needed.
+    '''
+    n_rows = max(x.shape[0],y.shape[0])
+    keys = (np.arange(n_rows)[:,np.newaxis] * n_regions + codes).ravel()
+    size = n_rows * n_regions
+    sums = lambda w: np.bincount(keys,
+                                 weights=np.broadcast_to(w,(n_rows,w.shape[1])).ravel(),
+                                 minlength=size).reshape(n_rows,n_regions)
+    count = np.bincount(keys,minlength=size).reshape(n_rows,n_regions)
+    sxy = sums(x * y)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        if standardized:
+            corrs = sxy / count
+        else:
+            sx,sy = sums(x),sums(y)
+            cxy = sxy - sx*sy/count
+            cxx = sums(x * x) - sx*sx/count
+            cyy = sums(y * y) - sy*sy/count
+            corrs = cxy / np.sqrt(cxx*cyy)
+    corrs = np.clip(corrs,-1.0,1.0)
+    corrs[count < 2] = np.nan
+    return corrs
+
+
+def _standardize_groups(values,codes,n_regions):
+    '''Mean 0, variance 1 (population) within each group, 0 if constant'''
+    count = np.bincount(codes,minlength=n_regions).astype(np.float64)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        means = np.bincount(codes,weights=values,minlength=n_regions) / count
+        centered = values - means[codes]
+        sds = np.sqrt(np.bincount(codes,weights=centered**2,
+                                  minlength=n_regions) / count)
+        standardized = centered / sds[codes]
+    standardized[~np.isfinite(standardized)] = 0
+    return standardized
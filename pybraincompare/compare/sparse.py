@@ -0,0 +1,279 @@
+'''
+sparse.py: part of pybraincompare package
+Thresholded maps as sparse rows, with overlap and correlation of many maps
+
+A thresholded map keeps only a few percent of its voxels, so a collection
+of them is held as one CSR matrix (maps x voxels in a shared mask): for
+each map, the mask indices of voxels that pass the threshold and their
+values. Overlap counts, Dice, Jaccard and correlations for every pair of
+maps are sparse matrix products, and maps are turned back into nifti
+images only when asked for.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import range
+from builtins import object
+from .mrutils import Mask
+from .store import VoxelStore
+from scipy import sparse
+import numpy as np
+import nibabel
+
+
+def threshold_passes(values,threshold,direction="posneg"):
+    '''Values passing a threshold, as apply_threshold. Zeros and nans are
+    missing and never pass, so a threshold at or below 0 keeps maps sparse'''
+    with np.errstate(invalid="ignore"):
+        if direction == "posneg":
+            passes = np.abs(values) >= threshold
+        elif direction == "pos":
+            passes = values >= threshold
+        elif direction == "neg":
+            passes = values <= threshold
+        else:
+            raise ValueError("direction must be posneg, pos or neg")
+    return passes & (values != 0)
+
+
+class ThresholdedMaps(object):
+    '''
+    Thresholded maps in a shared mask, as sparse rows
+
+    matrix: scipy.sparse matrix, maps x voxels in the mask, holding the
+        values that passed the threshold
+    mask: Mask (or nibabel image or file) the columns are voxels of, needed
+        only to make nifti images [optional]
+    image_ids: ids of the maps [default index]
+    threshold, direction: the threshold the maps were made with
+    '''
+
+    def __init__(self, matrix,
+                       mask=None,
+                       image_ids=None,
+                       threshold=None,
+                       direction="posneg"):
+
+        self.matrix = sparse.csr_matrix(matrix,dtype=np.float32)
+        self.matrix.sort_indices()
+        if mask is not None and not isinstance(mask,Mask):
+            mask = Mask(mask)
+        if mask is not None and len(mask) != self.matrix.shape[1]:
+            raise ValueError("Mask does not have the number of voxels of the maps")
+        self.mask = mask
+        if image_ids is None:
+            image_ids = list(range(self.matrix.shape[0]))
+        if len(image_ids) != self.matrix.shape[0]:
+            raise ValueError("Number of image_ids must equal number of maps")
+        self.image_ids = list(image_ids)
+        self.threshold = threshold
+        self.direction = direction
+        self.cache = dict()
+
+    @classmethod
+    def from_vectors(cls,vectors,
+                         mask=None,
+                         threshold=1.96,
+                         direction="posneg",
+                         image_ids=None,
+                         block_size=1024):
+        '''from_vectors
+        Threshold masked vectors (a 2D array with maps in rows, or a
+        VoxelStore), block_size rows at a time, into sparse rows
+        '''
+        if isinstance(vectors,VoxelStore):
+            if image_ids is None:
+                image_ids = list(vectors.ids)
+            blocks = (rows for ids,rows in vectors.iter_chunks())
+            number_maps,number_voxels = len(vectors),vectors.number_voxels
+        else:
+            vectors = np.array(vectors,copy=False,ndmin=2)
+            blocks = (vectors[start:start + block_size]
+                      for start in range(0,vectors.shape[0],block_size))
+            number_maps,number_voxels = vectors.shape
+
+        counts = []
+        indices = []
+        values = []
+        for block in blocks:
+            passed = threshold_passes(block,threshold,direction)
+            rows,columns = np.nonzero(passed)
+            counts.append(np.bincount(rows,minlength=block.shape[0]))
+            indices.append(columns.astype(np.int32))
+            values.append(np.asarray(block[rows,columns],dtype=np.float32))
+
+        indptr = np.zeros(number_maps + 1,dtype=np.int64)
+        if number_maps > 0:
+            np.cumsum(np.concatenate(counts),out=indptr[1:])
+        matrix = sparse.csr_matrix((np.concatenate(values) if values else np.zeros(0,np.float32),
+                                    np.concatenate(indices) if indices else np.zeros(0,np.int32),
+                                    indptr),
+                                   shape=(number_maps,number_voxels))
+        return cls(matrix,mask=mask,image_ids=image_ids,
+                   threshold=threshold,direction=direction)
+
+    @classmethod
+    def from_images(cls,images,
+                        mask,
+                        threshold=1.96,
+                        direction="posneg",
+                        image_ids=None,
+                        block_size=256):
+        '''from_images
+        Mask and threshold images (files or nibabel images, in the mask),
+        block_size images at a time
+        '''
+        if not isinstance(mask,Mask):
+            mask = Mask(mask)
+        if isinstance(images,(str,nibabel.nifti1.Nifti1Image)):
+            images = [images]
+        blocks = []
+        for start in range(0,len(images),block_size):
+            vectors = mask.mask(images[start:start + block_size])
+            blocks.append(cls.from_vectors(vectors,threshold=threshold,
+                                           direction=direction).matrix)
+        matrix = sparse.vstack(blocks,format="csr") if blocks else \
+                 sparse.csr_matrix((0,len(mask)),dtype=np.float32)
+        return cls(matrix,mask=mask,image_ids=image_ids,
+                   threshold=threshold,direction=direction)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    @property
+    def number_voxels(self):
+        return self.matrix.shape[1]
+
+    @property
+    def density(self):
+        '''Fraction of voxels kept over all maps'''
+        return self.nnz / float(max(len(self) * self.number_voxels,1))
+
+    @property
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + \
+               self.matrix.indptr.nbytes
+
+    def get(self,key,function):
+        '''Return a cached matrix derived from the maps, computing it once'''
+        if key not in self.cache:
+            self.cache[key] = function()
+        return self.cache[key]
+
+    def get_binary(self):
+        '''The maps as sparse rows of ones where voxels passed'''
+        def binary():
+            matrix = self.matrix.copy()
+            matrix.data = np.ones(len(matrix.data),dtype=np.float64)
+            return matrix
+        return self.get("binary",binary)
+
+    def get_values(self,power=1):
+        '''The maps as float64 sparse rows, values to a power'''
+        def values():
+            matrix = self.matrix.astype(np.float64)
+            matrix.data **= power
+            return matrix
+        return self.get(("values",power),values)
+
+    def sizes(self):
+        '''Number of voxels that passed, for each map'''
+        return np.diff(self.matrix.indptr)
+
+    def check_other(self,other):
+        other = self if other is None else other
+        if other.number_voxels != self.number_voxels:
+            raise ValueError("Maps must be in the same mask")
+        return other
+
+    def overlap_counts(self,other=None):
+        '''overlap_counts
+        Number of voxels that passed in both, for every map here (rows) and
+        in other (columns, default all maps here)
+        '''
+        other = self.check_other(other)
+        counts = self.get_binary().dot(other.get_binary().T)
+        return np.rint(counts.toarray()).astype(np.int64)
+
+    def dice(self,other=None):
+        '''Dice coefficient for every pair of maps (here x other)'''
+        other = self.check_other(other)
+        intersection = self.overlap_counts(other)
+        total = self.sizes()[:,np.newaxis] + other.sizes()[np.newaxis,:]
+        with np.errstate(divide="ignore",invalid="ignore"):
+            return 2.0*intersection / total
+
+    def jaccard(self,other=None):
+        '''Jaccard index for every pair of maps (here x other)'''
+        other = self.check_other(other)
+        intersection = self.overlap_counts(other)
+        union = self.sizes()[:,np.newaxis] + other.sizes()[np.newaxis,:] - intersection
+        with np.errstate(divide="ignore",invalid="ignore"):
+            return intersection / union
+
+    def correlation(self,other=None,pairwise_deletion=True):
+        '''correlation
+        Pearson correlation for every pair of maps (here x other)
+
+        pairwise_deletion: correlate each pair over the voxels that passed
+            in both, as calculate_pairwise_correlation on the thresholded
+            vectors [default True]. If False, correlate the thresholded maps
+            over the whole mask, voxels that did not pass counting as zero.
+
+        Pairs with fewer than two voxels (or no variance) are nan.
+        '''
+        other = self.check_other(other)
+        x,x2,bx = self.get_values(),self.get_values(2),self.get_binary()
+        y,y2,by = other.get_values(),other.get_values(2),other.get_binary()
+        sxy = x.dot(y.T).toarray()
+        if pairwise_deletion:
+            n = bx.dot(by.T).toarray()
+            sx = x.dot(by.T).toarray()
+            sy = bx.dot(y.T).toarray()
+            sxx = x2.dot(by.T).toarray()
+            syy = bx.dot(y2.T).toarray()
+        else:
+            n = np.full((len(self),len(other)),float(self.number_voxels))
+            sx = np.asarray(x.sum(axis=1))
+            sy = np.asarray(y.sum(axis=1)).T
+            sxx = np.asarray(x2.sum(axis=1))
+            syy = np.asarray(y2.sum(axis=1)).T
+        with np.errstate(divide="ignore",invalid="ignore"):
+            cxx = sxx - sx*sx/n
+            cyy = syy - sy*sy/n
+            corrs = (sxy - sx*sy/n) / np.sqrt(cxx*cyy)
+        corrs = np.clip(corrs,-1.0,1.0)
+        corrs[(n < 2) | ~(cxx > 0) | ~(cyy > 0)] = np.nan
+        return corrs
+
+    def get_index(self,image_id):
+        return self.image_ids.index(image_id)
+
+    def get_row(self,i):
+        '''Mask indices and values of the voxels that passed in map i'''
+        start,end = self.matrix.indptr[i],self.matrix.indptr[i + 1]
+        return self.matrix.indices[start:end],self.matrix.data[start:end]
+
+    def to_vector(self,i):
+        '''Map i as a dense vector over the mask'''
+        vector = np.zeros(self.number_voxels,dtype=np.float32)
+        indices,values = self.get_row(i)
+        vector[indices] = values
+        return vector
+
+    def to_nifti(self,i):
+        '''Map i as a nifti image on the mask grid, as apply_threshold'''
+        if self.mask is None:
+            raise ValueError("A mask is needed to make nifti images")
+        return self.mask.make_nii(self.to_vector(i),dtype="float32")
+
+    def iter_nifti(self):
+        '''Yield (image id, nifti image) for each map, one made at a time'''
+        for i in range(len(self)):
+            yield self.image_ids[i],self.to_nifti(i)
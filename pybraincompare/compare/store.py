@@ -0,0 +1,245 @@
+'''
+store.py: part of pybraincompare package
+Persistent, memory mapped matrix of masked images (images x voxels)
+
+A VoxelStore is a directory of float32 .npy chunks of chunk_size images
+each, and an index.json with the image ids, the number of rows used, and
+the fingerprint of the mask the images were taken in. Images are masked
+once when they are appended, and read back (as memory maps, without
+copying when the rows are in one chunk) by anything working on the
+collection, instead of loading and masking nifti files again.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import str
+from builtins import range
+from builtins import object
+from .mrutils import Mask
+from .cache import get_image_fingerprint
+import nibabel
+import numpy as np
+import pandas
+import json
+import os
+
+
+class VoxelStore(object):
+    '''
+    Images x voxels float32 store, chunked along images
+
+    store_dir: directory of the store (created if it does not exist)
+    mask: the mask images are in (nibabel image, file or Mask). Required to
+        create a store, and checked against the store fingerprint if given
+        to open one
+    chunk_size: number of images per chunk file [default 256]
+    ensure_finite: replace nan and inf with 0 when images are added, as
+        get_images_df [default True]
+    '''
+
+    def __init__(self, store_dir, mask=None, chunk_size=256, ensure_finite=True):
+        self.store_dir = store_dir
+        self.index_file = os.path.join(store_dir,"index.json")
+        self.chunks = dict()
+        if mask is not None and not isinstance(mask,Mask):
+            mask = Mask(mask)
+        self.mask = mask
+
+        if os.path.exists(self.index_file):
+            with open(self.index_file,"r") as filey:
+                self.index = json.load(filey)
+            if mask is not None and mask.key != self.index["mask_key"]:
+                raise ValueError("Mask does not match the mask of the store at %s" %(store_dir))
+        else:
+            if mask is None:
+                raise ValueError("A mask is required to create a store")
+            if not os.path.exists(store_dir):
+                os.makedirs(store_dir)
+            self.index = {"mask_key":mask.key,
+                          "number_voxels":len(mask),
+                          "chunk_size":int(chunk_size),
+                          "ensure_finite":bool(ensure_finite),
+                          "ids":[]}
+            self.save_index()
+        self.rows = dict((image_id,row) for row,image_id in enumerate(self.ids))
+
+    def __len__(self):
+        return len(self.index["ids"])
+
+    def __contains__(self,image_id):
+        return str(image_id) in self.rows
+
+    @property
+    def ids(self):
+        return self.index["ids"]
+
+    @property
+    def mask_key(self):
+        return self.index["mask_key"]
+
+    @property
+    def number_voxels(self):
+        return self.index["number_voxels"]
+
+    @property
+    def chunk_size(self):
+        return self.index["chunk_size"]
+
+    @property
+    def ensure_finite(self):
+        return self.index["ensure_finite"]
+
+    def save_index(self):
+        '''Write the index (to a temporary file first)'''
+        with open(self.index_file + ".tmp","w") as filey:
+            json.dump(self.index,filey)
+        os.replace(self.index_file + ".tmp",self.index_file)
+
+    def get_chunk_file(self,chunk):
+        return os.path.join(self.store_dir,"chunk_%05d.npy" %(chunk))
+
+    def get_chunk(self,chunk,mode="r"):
+        '''Memory map of one chunk (chunk_size x number_voxels)'''
+        key = (chunk,mode)
+        if key not in self.chunks:
+            chunk_file = self.get_chunk_file(chunk)
+            if not os.path.exists(chunk_file):
+                np.lib.format.open_memmap(chunk_file,mode="w+",dtype=np.float32,
+                                          shape=(self.chunk_size,self.number_voxels))
+            self.chunks[key] = np.load(chunk_file,mmap_mode=mode)
+        return self.chunks[key]
+
+    def append(self,images,image_ids=None):
+        '''append
+        Mask images and add them to the store
+
+        images: image files or nibabel images (in the store mask), or a 2D
+            array of masked vectors (images x voxels)
+        image_ids: ids for the images [default, file names for files, else
+            row numbers]. Ids must be new to the store.
+        '''
+        if isinstance(images,(str,np.ndarray)) and np.ndim(images) != 2:
+            images = [images]
+        if image_ids is None:
+            if all(isinstance(image,str) for image in images):
+                image_ids = list(images)
+            else:
+                image_ids = list(range(len(self),len(self) + len(images)))
+        image_ids = [str(image_id) for image_id in image_ids]
+        if len(image_ids) != len(images):
+            raise ValueError("Number of image_ids must equal number of images")
+        if len(set(image_ids)) != len(image_ids) or any(i in self.rows for i in image_ids):
+            raise ValueError("Image ids must be unique in the store")
+
+        for image,image_id in zip(images,image_ids):
+            row = len(self)
+            chunk = self.get_chunk(row // self.chunk_size,mode="r+")
+            chunk[row % self.chunk_size] = self.mask_image(image)
+            self.index["ids"].append(image_id)
+            self.rows[image_id] = row
+        for key,chunk in self.chunks.items():
+            if key[1] == "r+":
+                chunk.flush()
+        self.save_index()
+        return image_ids
+
+    def mask_image(self,image):
+        '''Masked values of one image (or a vector already masked)'''
+        if isinstance(image,np.ndarray) and image.ndim == 1:
+            vector = np.asarray(image,dtype=np.float32)
+        else:
+            if self.mask is None:
+                raise ValueError("Open the store with its mask to add images")
+            vector = self.mask.mask(image)
+        if len(vector) != self.number_voxels:
+            raise ValueError("Image does not have the number of voxels of the store")
+        if self.ensure_finite:
+            vector = np.where(np.isfinite(vector),vector,0)
+        return vector
+
+    def get_row_numbers(self,image_ids):
+        return [self.rows[str(image_id)] for image_id in image_ids]
+
+    def get_rows(self,rows=None,image_ids=None):
+        '''get_rows
+        Matrix of images (rows of the store, or by id), images x voxels.
+        Rows in one chunk in increasing steps are a read only view of the
+        memory map, anything else is gathered into a new array.
+        '''
+        if image_ids is not None:
+            rows = self.get_row_numbers(image_ids)
+        if rows is None:
+            rows = slice(0,len(self))
+        if isinstance(rows,slice):
+            start,stop,step = rows.indices(len(self))
+            if step > 0 and stop > start and \
+               start // self.chunk_size == (stop - 1) // self.chunk_size:
+                offset = start // self.chunk_size * self.chunk_size
+                return self.get_chunk(start // self.chunk_size)[start - offset:stop - offset:step]
+            rows = list(range(start,stop,step))
+        rows = np.asarray(rows,dtype=np.int64)
+        data = np.empty((len(rows),self.number_voxels),dtype=np.float32)
+        chunks = rows // self.chunk_size
+        for chunk in np.unique(chunks):
+            members = np.where(chunks == chunk)[0]
+            data[members] = self.get_chunk(chunk)[rows[members] % self.chunk_size]
+        return data
+
+    def iter_chunks(self):
+        '''Yield (image ids, read only view of the rows) for each chunk'''
+        for start in range(0,len(self),self.chunk_size):
+            end = min(start + self.chunk_size,len(self))
+            yield self.ids[start:end], self.get_rows(slice(start,end))
+
+    def load(self,images,image_ids=None):
+        '''load
+        Matrix (images x voxels) of images by id, masking and appending
+        the images not yet in the store first
+
+        images: image files or nibabel images
+        image_ids: ids of the images [default, the file names]
+        '''
+        if isinstance(images,str):
+            images = [images]
+        images = list(images)
+        if image_ids is None:
+            image_ids = images
+        image_ids = [str(image_id) for image_id in image_ids]
+        # An image asked for more than once is appended once
+        missing = dict()
+        for i,image_id in enumerate(image_ids):
+            if image_id not in self.rows and image_id not in missing:
+                missing[image_id] = i
+        missing = list(missing.values())
+        if len(missing) > 0:
+            self.append([images[i] for i in missing],
+                        image_ids=[image_ids[i] for i in missing])
+        rows = self.get_row_numbers(image_ids)
+        if len(rows) > 0 and rows == list(range(rows[0],rows[0] + len(rows))):
+            return self.get_rows(slice(rows[0],rows[0] + len(rows)))
+        return self.get_rows(rows)
+
+    def get_images_df(self,image_ids=None):
+        '''Data frame of images (rows, indexed by id) x voxels, as returned
+        by get_images_df'''
+        if image_ids is None:
+            image_ids = self.ids
+        image_ids = [str(image_id) for image_id in image_ids]
+        return pandas.DataFrame(self.get_rows(image_ids=image_ids),
+                                index=image_ids,copy=False)
+
+
+def get_image_key(image):
+    '''get_image_key
+    Id of an image for a store, that changes when the image does: the
+    absolute path, size and modification time for a file (or an image
+    loaded from one), else a fingerprint of the image content
+    '''
+    filename = image if isinstance(image,str) else image.get_filename()
+    if filename is not None and os.path.exists(filename) and \
+       (isinstance(image,str) or isinstance(image.dataobj,nibabel.arrayproxy.ArrayProxy)):
+        stat = os.stat(filename)
+        return "%s:%s:%s" %(os.path.abspath(filename),stat.st_size,stat.st_mtime)
+    return get_image_fingerprint(image)
@@ -0,0 +1,223 @@
+'''
+streaming.py: part of pybraincompare package
+Correlations accumulated over chunks of voxels
+
+The accumulators keep the count, means and centered sums of squares and
+cross products of two images. They can be updated with chunks of voxels
+(eg, slabs read from disk) and merged with accumulators filled somewhere
+else (eg, in worker processes), so whole volumes never need to be in memory.
+
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import str
+from builtins import range
+from builtins import object
+from .mrutils import get_nii_obj
+import numpy as np
+
+
+class PearsonAccumulator(object):
+    '''
+    Mergeable moments for a whole brain pearson correlation.
+
+    pairwise_deletion: if True (default), voxels that are zero or nan in
+        either image are skipped, as with make_binary_deletion_vector
+    '''
+
+    def __init__(self, pairwise_deletion=True):
+        self.pairwise_deletion = pairwise_deletion
+        self.moments = _empty_moments(1)
+
+    @property
+    def count(self):
+        return self.moments[0].sum()
+
+    def update(self,image_vector1,image_vector2):
+        '''Add a chunk of voxels (two vectors of equal length)'''
+        x,y,keep = self._prepare(image_vector1,image_vector2)
+        chunk = _chunk_moments(x,y,np.zeros(len(x),dtype=np.int64),1)
+        self.moments = _merge_moments(self.moments,chunk)
+        return self
+
+    def merge(self,other):
+        '''Merge the moments of another accumulator into this one'''
+        self.moments = _merge_moments(self.moments,other.moments)
+        return self
+
+    def correlation(self):
+        '''Return the pearson correlation of everything seen so far'''
+        return _moments_correlation(self.moments)[0]
+
+    def _prepare(self,image_vector1,image_vector2):
+        x = np.asarray(image_vector1,dtype=np.float64).ravel()
+        y = np.asarray(image_vector2,dtype=np.float64).ravel()
+        if self.pairwise_deletion:
+            keep = (x != 0) & (y != 0) & ~np.isnan(x) & ~np.isnan(y)
+            return x[keep], y[keep], keep
+        return x, y, np.ones(len(x),dtype=bool)
+
+
+class RegionalPearsonAccumulator(PearsonAccumulator):
+    '''
+    Mergeable moments for a pearson correlation in each region of an atlas.
+    Regions are added as they are seen in the chunks of the atlas vector.
+
+    labels: region labels to start with [optional]
+    pairwise_deletion: skip voxels that are zero or nan [default True]
+    '''
+
+    def __init__(self, labels=None, pairwise_deletion=True):
+        self.pairwise_deletion = pairwise_deletion
+        if labels is None:
+            labels = []
+        self.labels = np.unique(np.asarray(labels,dtype=np.float64))
+        self.moments = _empty_moments(len(self.labels))
+
+    def update(self,image_vector1,image_vector2,atlas_vector):
+        '''Add a chunk of voxels, with the atlas labels for the same voxels'''
+        x,y,keep = self._prepare(image_vector1,image_vector2)
+        atlas_vector = np.asarray(atlas_vector,dtype=np.float64).ravel()[keep]
+        labels,codes = np.unique(atlas_vector,return_inverse=True)
+        chunk = _chunk_moments(x,y,codes.ravel(),len(labels))
+        self._merge_labeled(labels,chunk)
+        return self
+
+    def merge(self,other):
+        '''Merge the moments of another regional accumulator into this one'''
+        self._merge_labeled(other.labels,other.moments)
+        return self
+
+    def correlation(self):
+        '''Return a dictionary of correlations, with atlas labels as keys
+        (the same as calculate_pairwise_correlation with an atlas_vector)'''
+        corrs = _moments_correlation(self.moments)
+        return dict((str(int(l)),c) for l,c in zip(self.labels,corrs))
+
+    def _merge_labeled(self,labels,moments):
+        '''Align both sets of moments on the union of labels, then merge'''
+        union = np.union1d(self.labels,labels)
+        if len(union) != len(self.labels):
+            self.moments = _reindex_moments(self.moments,self.labels,union)
+            self.labels = union
+        moments = _reindex_moments(moments,labels,union)
+        self.moments = _merge_moments(self.moments,moments)
+
+
+def calculate_correlation_streamed(images,
+                                   mask=None,
+                                   atlas_image=None,
+                                   slab_size=8,
+                                   pairwise_deletion=True):
+
+    '''calculate_correlation_streamed
+    Pearson correlation between two images, read slab by slab (along the
+    last spatial axis) so only slab_size slices of each image are in memory.
+
+    images: list
+        two image files or nibabel images, registered to the same space
+
+    mask: nibabel.Nifti1Image or file
+        only voxels in the mask are used [optional]
+
+    atlas_image: nibabel.Nifti1Image or file
+        an atlas volume in the same space. If given, a dictionary of regional
+        correlations is returned, as from calculate_pairwise_correlation
+
+    slab_size: int
+        number of slices to read at once [default 8]
+
+    pairwise_deletion: boolean
+        skip voxels that are zero or nan in either image [default True]
+    '''
+    images = get_nii_obj(images)
+    if mask is not None:
+        mask = get_nii_obj(mask)[0]
+    if atlas_image is not None:
+        atlas_image = get_nii_obj(atlas_image)[0]
+        accumulator = RegionalPearsonAccumulator(pairwise_deletion=pairwise_deletion)
+    else:
+        accumulator = PearsonAccumulator(pairwise_deletion=pairwise_deletion)
+
+    number_slices = images[0].shape[2]
+    for start in range(0,number_slices,slab_size):
+        end = min(start + slab_size, number_slices)
+        slab1 = read_slab(images[0],start,end)
+        slab2 = read_slab(images[1],start,end)
+        if mask is not None:
+            keep = read_slab(mask,start,end) != 0
+        else:
+            keep = np.ones(slab1.shape,dtype=bool)
+        if atlas_image is not None:
+            accumulator.update(slab1[keep],slab2[keep],
+                               read_slab(atlas_image,start,end)[keep])
+        else:
+            accumulator.update(slab1[keep],slab2[keep])
+
+    return accumulator.correlation()
+
+
+def read_slab(image,start,end):
+    '''Read slices start:end (last spatial axis) of an image from disk'''
+    if len(image.shape) == 4:
+        return np.asarray(image.dataobj[:,:,start:end,0])
+    return np.asarray(image.dataobj[:,:,start:end])
+
+
+# Moments are (count, mean_x, mean_y, sxx, syy, sxy), one value per region
+
+def _empty_moments(number_regions):
+    return tuple(np.zeros(number_regions) for x in range(6))
+
+
+def _chunk_moments(x,y,codes,number_regions):
+    '''Moments of each region for one chunk of voxels'''
+    count = np.bincount(codes,minlength=number_regions).astype(np.float64)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        mean_x = np.bincount(codes,weights=x,minlength=number_regions) / count
+        mean_y = np.bincount(codes,weights=y,minlength=number_regions) / count
+    mean_x[count == 0] = 0
+    mean_y[count == 0] = 0
+    dx = x - mean_x[codes]
+    dy = y - mean_y[codes]
+    sxx = np.bincount(codes,weights=dx*dx,minlength=number_regions)
+    syy = np.bincount(codes,weights=dy*dy,minlength=number_regions)
+    sxy = np.bincount(codes,weights=dx*dy,minlength=number_regions)
+    return (count,mean_x,mean_y,sxx,syy,sxy)
+
+
+def _merge_moments(a,b):
+    '''Combine two sets of moments (Chan et al. parallel update)'''
+    count_a,mean_xa,mean_ya,sxx_a,syy_a,sxy_a = a
+    count_b,mean_xb,mean_yb,sxx_b,syy_b,sxy_b = b
+    count = count_a + count_b
+    with np.errstate(divide="ignore",invalid="ignore"):
+        weight = np.where(count > 0, count_b / count, 0)
+    dx = mean_xb - mean_xa
+    dy = mean_yb - mean_ya
+    mean_x = mean_xa + dx*weight
+    mean_y = mean_ya + dy*weight
+    cross = count_a*weight
+    sxx = sxx_a + sxx_b + dx*dx*cross
+    syy = syy_a + syy_b + dy*dy*cross
+    sxy = sxy_a + sxy_b + dx*dy*cross
+    return (count,mean_x,mean_y,sxx,syy,sxy)
+
+
+def _reindex_moments(moments,labels,new_labels):
+    '''Place moments for labels into arrays for new_labels (a superset)'''
+    index = np.searchsorted(new_labels,labels)
+    reindexed = _empty_moments(len(new_labels))
+    for old,new in zip(moments,reindexed):
+        new[index] = old
+    return reindexed
+
+
+def _moments_correlation(moments):
+    count,mean_x,mean_y,sxx,syy,sxy = moments
+    with np.errstate(divide="ignore",invalid="ignore"):
+        corrs = np.clip(sxy / np.sqrt(sxx*syy),-1.0,1.0)
+    corrs[count < 2] = np.nan
+    return corrs
@@ -3,8 +3,11 @@ datasets.py: part of pybraincompare package
 Return sets of images or atlas files
 
 '''
-
+from __future__ import print_function
+from builtins import object
+from pybraincompare.compare.mrutils import Mask
 import os
+import tempfile
 import nibabel as nib
 import numpy
 import pybraincompare.compare.atlas as Atlas
@@ -37,24 +40,105 @@ def get_pair_images(voxdims=["2","2"]):
     image2 = "%s/%smm16_zstat3_1.nii" %(mr_directory,voxdims[1])
     return [image1,image2]
 
+# STANDARD SPACE ---------------------------------------------------------------
+
+# Standard spaces already resolved in this process, by resolution and cache_dir
+standard_spaces = dict()
+
+class StandardSpace(object):
+    '''
+    MNI152 brain and brain mask (from FSL, bundled) at one resolution.
+    Resolutions that are not bundled are resampled from 2mm once, and saved
+    in cache_dir for other processes. The mask is compiled (a Mask), so
+    the mask indices are ready for code working on many images.
+
+    The brain and mask images are read once, and shared: treat them as
+    read only. get_standard_brain and get_standard_mask return copies.
+
+    voxdim: voxel size in mm (isotropic)
+    cache_dir: directory for derived resolutions [default from the
+        PYBRAINCOMPARE_STANDARD_CACHE environment variable, else in tmp]
+    '''
+
+    def __init__(self, voxdim=2, cache_dir=None):
+        self.voxdim = get_voxdim_name(voxdim)
+        self.cache_dir = get_standard_cache_dir(cache_dir)
+        self.brain = self.load_template("brain","continuous")
+        self.mask = self.load_template("brain_mask","nearest")
+        self.compiled_mask = Mask(self.mask)
+
+    def load_template(self,name,interpolation):
+        '''Load a bundled template, else a cached one, else resample 2mm'''
+        filename = "MNI152_T1_%smm_%s.nii.gz" %(self.voxdim,name)
+        for directory in [get_data_directory(),self.cache_dir]:
+            template = os.path.join(directory,filename)
+            if os.path.exists(template):
+                return copy_image(nib.load(template))
+        template = nib.load("%s/MNI152_T1_2mm_%s.nii.gz" %(get_data_directory(),name))
+        voxdim = float(self.voxdim)
+        template = resample_img(template,target_affine=numpy.diag([voxdim,voxdim,voxdim]),
+                                interpolation=interpolation)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            temporary = os.path.join(self.cache_dir,"%s.%s.nii.gz" %(filename[:-7],os.getpid()))
+            nib.save(template,temporary)
+            os.replace(temporary,os.path.join(self.cache_dir,filename))
+        except (IOError,OSError):
+            print("Cannot save %s to %s, it will be resampled again next time." %(filename,self.cache_dir))
+        return template
+
+    @property
+    def affine(self):
+        return self.mask.affine
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    @property
+    def indices(self):
+        '''Flat (C order) indices of the voxels in the mask'''
+        return self.compiled_mask.indices
+
+    @property
+    def mask_bin(self):
+        '''Boolean volume of the mask'''
+        return self.compiled_mask.get_data()
+
+
+def get_voxdim_name(voxdim):
+    '''Voxel size as in template file names (2, 4, 2.5)'''
+    return "%g" %(float(voxdim))
+
+def get_standard_cache_dir(cache_dir=None):
+    '''Directory for derived resolutions: cache_dir, else the one named in
+    PYBRAINCOMPARE_STANDARD_CACHE, else a folder in tmp'''
+    if cache_dir is None:
+        cache_dir = os.environ.get("PYBRAINCOMPARE_STANDARD_CACHE",
+                                   os.path.join(tempfile.gettempdir(),"pybraincompare_standard"))
+    return os.path.abspath(cache_dir)
+
+def copy_image(image):
+    '''An image with its data read into (a new array in) memory, and the
+    file name, affine and header of image'''
+    copy = nib.Nifti1Image(numpy.array(image.dataobj),image.affine,image.header)
+    if image.get_filename() is not None:
+        copy.set_filename(image.get_filename())
+    return copy
+
+def get_standard_space(voxdim=2,cache_dir=None):
+    '''Return the StandardSpace for a resolution (and cache directory),
+    resolved once per process'''
+    key = (get_voxdim_name(voxdim),get_standard_cache_dir(cache_dir))
+    if key not in standard_spaces:
+        standard_spaces[key] = StandardSpace(voxdim,cache_dir=cache_dir)
+    return standard_spaces[key]
+
 # Get pybraincompare standard brain (from FSL) if user doesn't have software
 def get_standard_brain(voxdim=2):
-    mr_directory = get_data_directory()
-    brain = "%s/MNI152_T1_%smm_brain.nii.gz" %(mr_directory,voxdim)
-    if not os.path.exists(brain):
-        brain = nib.load("%s/MNI152_T1_2mm_brain.nii.gz" %(mr_directory))
-        brain = resample_img(brain,target_affine=numpy.diag([voxdim,voxdim,voxdim]))
-        return brain
-    else:
-        return nib.load(brain)
+    return copy_image(get_standard_space(voxdim).brain)
 
 # Get pybraincompare standard brain mask (from FSL) if user doesn't have software
 def get_standard_mask(voxdim=2):
-    mr_directory = get_data_directory()
-    mask = "%s/MNI152_T1_%smm_brain_mask.nii.gz" %(mr_directory,voxdim)
-    if not os.path.exists(mask):
-        mask = nib.load("%s/MNI152_T1_2mm_brain_mask.nii.gz" %(mr_directory))
-        mask = resample_img(mask,target_affine=numpy.diag([voxdim,voxdim,voxdim]),interpolation="nearest")
-        return mask
-    else:
-        return nib.load(mask)
+    return copy_image(get_standard_space(voxdim).mask)
@@ -3,26 +3,31 @@ transformation.py: part of pybraincompare package
 Return transformations of images
 
 '''
-from pybraincompare.mr.datasets import get_standard_mask
+from pybraincompare.mr.datasets import get_standard_space
 from pybraincompare.compare.mrutils import get_nii_obj
-from nilearn.image import resample_img
+from pybraincompare.compare.cache import cached_resample_img
+from pybraincompare.compare.resampling import resample_images
 import nibabel as nib
 import numpy
 import os
 
 # Return resampled transformation image as vector
-def make_resampled_transformation_vector(nii_obj,resample_dim=[4,4,4],standard_mask=True):
+def make_resampled_transformation_vector(nii_obj,resample_dim=[4,4,4],standard_mask=True,
+                                         sparse=False):
 
-    resamp_nii = make_resampled_transformation(nii_obj,resample_dim,standard_mask)
+    resamp_nii = make_resampled_transformation(nii_obj,resample_dim,standard_mask,sparse)
     if standard_mask:
-        standard = get_standard_mask(voxdim=resample_dim[0])
-        return resamp_nii.get_data()[standard.get_data()!=0]
+        standard = get_standard_space(voxdim=resample_dim[0])
+        return standard.compiled_mask.take(resamp_nii.dataobj)
     else:
         return resamp_nii.get_data().flatten()
 
 
 # Make a resampled image transformation
-def make_resampled_transformation(nii_obj,resample_dim=[4,4,4],standard_mask=True):
+# sparse: resample to the standard mask with an interpolation operator that
+# is built once per grid, and reused for every image on the same grid
+def make_resampled_transformation(nii_obj,resample_dim=[4,4,4],standard_mask=True,
+                                  sparse=False):
 
     nii_obj = get_nii_obj(nii_obj)[0]
 
@@ -36,18 +41,26 @@ def make_resampled_transformation(nii_obj,resample_dim=[4,4,4],standard_mask=Tru
     
     # Standard brain masking
     if standard_mask == True:
-        standard = get_standard_mask(voxdim=resample_dim[0])
-        true_zeros = resample_img(true_zeros,target_affine=standard.get_affine(), 
-                                  target_shape=standard.shape)
+        # Template and mask indices are resolved once per resolution
+        standard = get_standard_space(voxdim=resample_dim[0])
+        if sparse:
+            true_zeros = resample_images([true_zeros],
+                                         target_affine=standard.affine,
+                                         target_shape=standard.shape)[0]
+        else:
+            true_zeros = cached_resample_img(true_zeros,
+                                             target_affine=standard.affine, 
+                                             target_shape=standard.shape)
       
         # Mask the image 
         masked_true_zeros = numpy.zeros(true_zeros.shape)
-        masked_true_zeros[standard.get_data()!=0] = true_zeros.get_data()[standard.get_data()!=0]
+        masked_true_zeros.flat[standard.indices] = standard.compiled_mask.take(true_zeros.dataobj)
         true_zeros = nib.nifti1.Nifti1Image(masked_true_zeros,affine=true_zeros.get_affine())
 
     # or just resample
     else: 
         if (resample_dim != numpy.diag(true_zeros.get_affine())[0:3]).all():
-            true_zeros = resample_img(true_zeros,target_affine=numpy.diag(resample_dim))
+            true_zeros = cached_resample_img(true_zeros,
+                                             target_affine=numpy.diag(resample_dim))
 
     return true_zeros
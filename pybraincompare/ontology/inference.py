@@ -22,7 +22,7 @@ import os
 
 
 def likelihood_groups_from_tree(tree,standard_mask,input_folder,image_pattern="[0]+%s[.]",
-                                output_folder=None,node_pattern="[0-9]+",):
+                                output_folder=None,node_pattern="[0-9]+",store=None):
     '''likelihood_groups_from_tree
     Function to generate likelihood groups from a pybraincompare.ontology.tree 
     object. These groups can then be used to calculate likelihoods (eg, 
@@ -68,6 +68,9 @@ def likelihood_groups_from_tree(tree,standard_mask,input_folder,image_pattern="[
                       to calculate the range is based on the mins and max of 
                       the entire set of images
 
+    If store is given (a pybraincompare.compare.store.VoxelStore, or its 
+    directory), masked images are read from (and added to) the store.
+
     '''
     # Find all nodes in the tree, match to images in folder
     nodes = get_node_fields(tree,field="name",nodes=[])
@@ -99,7 +102,7 @@ def likelihood_groups_from_tree(tree,standard_mask,input_folder,image_pattern="[
     concept_nodes = [x for x in nodes if x not in image_nodes] 
 
     # create table of voxels for all images (the top node)
-    mr = get_images_df(file_paths=files.path,mask=standard_mask)
+    mr = get_images_df(file_paths=files.path,mask=standard_mask,store=store)
     mr.index = files.index
 
     range_table = make_range_table(mr)
@@ -188,7 +191,7 @@ def make_range_table(mr,ranges=None):
 
 
 def get_likelihood_df(nid,in_images,out_images,standard_mask,range_table,
-                      threshold=2.96,output_folder=None,method=["binary"]):
+                      threshold=2.96,output_folder=None,method=["binary"],store=None):
 
     '''get_likelihood_df
 
@@ -225,6 +228,9 @@ def get_likelihood_df(nid,in_images,out_images,standard_mask,range_table,
     :param output_folder: path
         folder to save likelihood pickles [default is None]
 
+    :param store: pybraincompare.compare.store.VoxelStore or directory
+        read masked images from a voxel store instead of the files [optional]
+
   
     If output_folder is not specified, the df objects are returned.
     If specified, will return paths to saved pickle objects:
@@ -237,7 +243,7 @@ def get_likelihood_df(nid,in_images,out_images,standard_mask,range_table,
     if len(numpy.intersect1d(in_images,out_images)) > 0:
         raise ValueError("ERROR: in_images and out_images should not share images!")
     all_images = in_images + out_images
-    mr = get_images_df(file_paths=all_images,mask=standard_mask)
+    mr = get_images_df(file_paths=all_images,mask=standard_mask,store=store)
     mr.index = all_images
     in_subset = mr.loc[in_images]
     out_subset = mr.loc[out_images] 
@@ -372,7 +378,8 @@ def calculate_reverse_inference_distance(query_image,
                                          in_images,
                                          out_images,
                                          standard_mask,
-                                         equal_priors=True):    
+                                         equal_priors=True,
+                                         store=None):    
 
     '''calculate_reverse_inference_distance
 
@@ -400,11 +407,14 @@ def calculate_reverse_inference_distance(query_image,
         use 0.5 as a prior for each group [default True]. If set to False, the
         frequency of the concept in the total set will be used. "True" is recommended for small sets.
 
+    :param store: pybraincompare.compare.store.VoxelStore or directory
+        read masked images from a voxel store instead of the files [optional]
+
     '''
     if len(numpy.intersect1d(in_images,out_images)) > 0:
         raise ValueError("ERROR: in_images and out_images should not overlap!")
     all_images = in_images + out_images
-    mr = get_images_df(file_paths=all_images,mask=standard_mask)
+    mr = get_images_df(file_paths=all_images,mask=standard_mask,store=store)
     mr.index = all_images
     in_subset = mr.loc[in_images]
     out_subset = mr.loc[out_images] 
@@ -419,7 +429,7 @@ def calculate_reverse_inference_distance(query_image,
         p_process_out = old_div(float(out_count), total)  # % out
 
     # Read in the query image
-    query = get_images_df(file_paths=query_image,mask=standard_mask)
+    query = get_images_df(file_paths=query_image,mask=standard_mask,store=store)
 
     # Generate a mean image for each group
     mean_image_in = pandas.DataFrame(in_subset.mean())
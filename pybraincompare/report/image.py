@@ -22,13 +22,21 @@ from matplotlib.gridspec import GridSpec
 from pylab import cm
 import numpy as np
 import pylab as P
+import nibabel
 
 
 # Plot brain images
 
+def get_plot_image(nifti_file):
+    """Images already in memory (nibabel) are plotted as they are, anything
+    else is taken as a file name"""
+    if isinstance(nifti_file,nibabel.spatialimages.SpatialImage):
+        return nifti_file
+    return str(nifti_file)
+
 def make_roi_image(nifti_file,png_img_file=None):
     """Make roi (mask) image"""
-    nifti_file = str(nifti_file)
+    nifti_file = get_plot_image(nifti_file)
     mask_brain = plot_roi(nifti_file)
     if png_img_file:    
         mask_brain.savefig(png_img_file)
@@ -38,7 +46,7 @@ def make_roi_image(nifti_file,png_img_file=None):
 
 def make_stat_image(nifti_file,png_img_file=None):
     """Make statmap image"""
-    nifti_file = str(nifti_file)
+    nifti_file = get_plot_image(nifti_file)
     brain = plot_stat_map(nifti_file)
     if png_img_file:    
         brain.savefig(png_img_file)
@@ -49,7 +57,7 @@ def make_stat_image(nifti_file,png_img_file=None):
 def make_anat_image(nifti_file,png_img_file=None):
     """Make anat image"""
 
-    nifti_file = str(nifti_file)
+    nifti_file = get_plot_image(nifti_file)
     brain = plot_anat(nifti_file)
     if png_img_file:    
         brain.savefig(png_img_file)
@@ -59,7 +67,7 @@ def make_anat_image(nifti_file,png_img_file=None):
 
 def make_glassbrain_image(nifti_file,png_img_file=None):
     """Make glassbrain image, optional save image to png file (not vector)"""
-    nifti_file = str(nifti_file)
+    nifti_file = get_plot_image(nifti_file)
     glass_brain = plot_glass_brain(nifti_file)
     if png_img_file:    
         glass_brain.savefig(png_img_file)
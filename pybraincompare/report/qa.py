@@ -5,6 +5,8 @@ Functions to check quality of statistical maps
 '''
 from __future__ import division
 from past.utils import old_div
+from pybraincompare.compare.maths import t_to_z_data
+from pybraincompare.compare.mrutils import get_image_data
 import numpy as np
 import nibabel
 
@@ -17,16 +19,17 @@ def header_metrics(image):
     header = image.get_header()
     return {"shape":mr_shape,"affine":mr_affine,"header":header}
 
-def central_tendency(data):
+def central_tendency(data,dtype=None):
     '''Central tendency:
-    standard measures of central tendency and variance
+    standard measures of central tendency and variance, accumulated in
+    float64 for data in any precision (see mrutils.set_precision)
     '''
 
     if isinstance(data,nibabel.nifti1.Nifti1Image):
-        data = data.get_data()
-    mr_mean = data.mean()
-    mr_var = data.var()
-    mr_std = data.std()
+        data = get_image_data(data,dtype)
+    mr_mean = data.mean(dtype=np.float64)
+    mr_var = data.var(dtype=np.float64)
+    mr_std = np.sqrt(mr_var)
     mr_med = np.median(data)
     return {"std":mr_std,"var":mr_var,"mean":mr_mean,"med":mr_med}
 
@@ -85,9 +88,9 @@ def is_only_positive(nii_obj):
     if lower>=0: return True
     else: return False
 
-def get_voxel_range(nii_obj):
+def get_voxel_range(nii_obj,dtype=None):
     '''Get the maximum and minimum value in the image'''
-    data = nii_obj.get_data()
+    data = get_image_data(nii_obj,dtype)
     return (np.min(data), np.max(data))
   
 def count_voxels(masked_in,masked_out):
@@ -100,38 +103,12 @@ def count_voxels(masked_in,masked_out):
 
 # Convert to Z Scores (return entire images) -----------------------------------
 def t_to_z(mr, dof):
-  
-    data = mr.get_data()
-
-    # Select just the nonzero voxels
-    nonzero = data[data!=0]
-
-    # We will store our results here
-    Z = np.zeros(len(nonzero))
-
-    # Select values less than or == 0, and greater than zero
-    c  = np.zeros(len(nonzero))
-    k1 = (nonzero <= c)
-    k2 = (nonzero > c)
-
-    # Subset the data into two sets
-    t1 = nonzero[k1]
-    t2 = nonzero[k2]
-
-    # Calculate p values for <=0
-    p_values_t1 = t.cdf(t1, df = dof)
-    z_values_t1 = norm.ppf(p_values_t1)
-
-    # Calculate p values for > 0
-    p_values_t2 = t.cdf(-t2, df = dof)
-    z_values_t2 = -norm.ppf(p_values_t2)
-    Z[k1] = z_values_t1
-    Z[k2] = z_values_t2
-
-    # Create new nifti
-    empty_nii = np.zeros(mr.shape)
-    empty_nii[mr.get_data()!=0] = Z
-    Z_nii_fixed = nib.nifti1.Nifti1Image(empty_nii,
-                                         affine=mr.get_affine(),
-                                         header=mr.get_header())
+    '''Convert a t stat image to a Z image (float32), see maths.TtoZ'''
+    data = np.array(mr.dataobj,dtype=np.float32)
+    t_to_z_data(data,dof)
+    header = mr.get_header().copy()
+    header.set_data_dtype(np.float32)
+    Z_nii_fixed = nibabel.nifti1.Nifti1Image(data,
+                                             affine=mr.get_affine(),
+                                             header=header)
     return Z_nii_fixed
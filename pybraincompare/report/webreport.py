@@ -23,11 +23,11 @@ from pybraincompare.template.futils import make_tmp_folder, make_dir, unzip, get
 from pybraincompare.report.image import make_glassbrain_image, make_anat_image, make_stat_image
 from pybraincompare.report.histogram import get_histogram_data
 from .qa import header_metrics, central_tendency, outliers, get_percent_nonzero, count_voxels, is_thresholded
-from pybraincompare.compare.mrutils import do_mask, resample_images_ref, get_standard_brain, get_standard_mask, make_in_out_mask
+from pybraincompare.compare.mrutils import do_mask, resample_images_ref, get_standard_brain, get_standard_mask, make_in_out_mask, get_image_data, get_output_dtype
 from nilearn.image import resample_img
 
 def run_qa(mr_paths,html_dir,software="FSL",voxdim=[2,2,2],outlier_sds=6,investigator="brainman",
-           nonzero_thresh=0.25,calculate_mean_image=True,view=True):
+           nonzero_thresh=0.25,calculate_mean_image=True,view=True,n_jobs=None):
     '''run_qa: a tool to generate an interactive qa report for statistical maps
 
     mr_paths: a list of paths to brain statistical maps that can be read with nibabel [REQUIRED]
@@ -38,13 +38,14 @@ def run_qa(mr_paths,html_dir,software="FSL",voxdim=[2,2,2],outlier_sds=6,investi
     nonzero_thresh: images with # of nonzero voxels in brain mask < this value will be flagged as thresholded [default:0.25] 
     calculate_mean_image: Default True, should be set to False for larger datasets where memory is an issue
     view: view the web report in a browser at the end [default:True]
+    n_jobs: number of worker processes to resample images in [default:None, no workers]
     '''
 
     # First resample to standard space
     print("Resampling all data to %s using %s standard brain..." %(voxdim,software))
     reference_file = get_standard_brain(software)
     mask_file = get_standard_mask(software)
-    images_resamp, reference_resamp = resample_images_ref(mr_paths,reference_file,resample_dim=voxdim,interpolation="continuous")
+    images_resamp, reference_resamp = resample_images_ref(mr_paths,reference_file,resample_dim=voxdim,interpolation="continuous",n_jobs=n_jobs)
     mask = resample_img(mask_file, target_affine=np.diag(voxdim))
     mask_bin = compute_epi_mask(mask)
     mask_out = np.zeros(mask_bin.shape)
@@ -72,23 +73,27 @@ def run_qa(mr_paths,html_dir,software="FSL",voxdim=[2,2,2],outlier_sds=6,investi
     if calculate_mean_image == True:
         print("Calculating mean image...")
         all_masked_data = apply_mask(images_resamp, mask_bin, dtype='f', smoothing_fwhm=None, ensure_finite=True)
-        mean_image = np.zeros(mask_bin.shape)
-        mean_image[mask_bin.get_data()==1] = np.mean(all_masked_data,axis=0)
+        mean_image = np.zeros(mask_bin.shape,dtype=get_output_dtype(all_masked_data))
+        mean_image[mask_bin.get_data()==1] = np.mean(all_masked_data,axis=0,dtype=np.float64)
         mean_image = nib.Nifti1Image(mean_image,affine=mask_bin.get_affine())
         mean_intensity = np.mean(mean_image.get_data()[mask_bin.get_data()==1])
         histogram_data_mean = get_histogram_data(mean_image.get_data()[mask_bin.get_data()==1])
         histogram_mean_counts = ",".join([str(x) for x in histogram_data_mean["counts"]])
         nib.save(mean_image,"%s/mean.nii" %(html_dir))
-        make_stat_image("%s/mean.nii" %(html_dir),png_img_file="%s/mean.png" %(html_dir))    
+        make_stat_image(mean_image,png_img_file="%s/mean.png" %(html_dir))    
 
     nib.save(reference_resamp,"%s/standard.nii" %(html_dir))
     nib.save(mask_bin,"%s/mask.nii" %(html_dir))
     nib.save(mask_out,"%s/mask_out.nii" %(html_dir))
-    make_anat_image("%s/mask.nii" %(html_dir),png_img_file="%s/mask.png" %(html_dir))
-    make_anat_image("%s/mask_out.nii" %(html_dir),png_img_file="%s/mask_out.png" %(html_dir))
+    make_anat_image(mask_bin,png_img_file="%s/mask.png" %(html_dir))
+    make_anat_image(mask_out,png_img_file="%s/mask_out.png" %(html_dir))
     
     unzip("%s/static/qa_report.zip" %(pwd),html_dir)
 
+    # Voxels in and out of the mask, the same for every image
+    in_mask_voxels = mask_bin.get_data()==1
+    out_mask_voxels = mask_out.get_data()==1
+
     for m in range(0,len(mr_paths)):
         mr = images_resamp[m]
         mr_original = nib.load(mr_paths[m])
@@ -100,13 +105,14 @@ def run_qa(mr_paths,html_dir,software="FSL",voxdim=[2,2,2],outlier_sds=6,investi
         make_dir(mr_folder)
         mr_images = "%s/img" %(mr_folder)
         make_dir(mr_images)
-        masked_in_data = mr.get_data()[mask_bin.get_data()==1]
-        masked_out_data = mr.get_data()[mask_out.get_data()==1]
+        mr_data = get_image_data(mr)
+        masked_in_data = mr_data[in_mask_voxels]
+        masked_out_data = mr_data[out_mask_voxels]
         mr_in_mask,mr_out_mask = make_in_out_mask(mask_bin=mask_bin,mr_folder=mr_folder,masked_in=masked_in_data,masked_out=masked_out_data,img_dir=mr_images)
 
-        # Glass brain, masked, and histogram data
-        make_stat_image("%s/masked.nii" %(mr_folder),png_img_file="%s/mr_masked.png" %(mr_images))
-        make_glassbrain_image("%s/masked.nii" %(mr_folder),png_img_file="%s/glassbrain.png" %(mr_images))
+        # Glass brain, masked, and histogram data, all from the volumes in memory
+        make_stat_image(mr_in_mask,png_img_file="%s/mr_masked.png" %(mr_images))
+        make_glassbrain_image(mr_in_mask,png_img_file="%s/glassbrain.png" %(mr_images))
         metrics = central_tendency(masked_in_data)
 
         # Header metrics
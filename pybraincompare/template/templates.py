@@ -6,6 +6,7 @@ Functions to work with html templates
 from __future__ import absolute_import
 
 from builtins import str
+from builtins import range
 from .futils import get_package_dir
 import pandas
 import os
@@ -50,9 +51,15 @@ def read_template(html_name):
 '''Add strings (eg, svg code) to a template - the key of the atlas_svg should correspond to replacement text. eg, svg["coronal"] will replace [coronal] tag in template!'''
 def add_string(svg,template):
   # If the number of svgs is != text_substitutions, we add them all to same spot
-  for tag,code in svg.items():
-    template = [t.replace("[%s]" %(tag),"%s" %(code)) for t in template]
-  return template
+  if len(svg) == 0:
+    return template
+  codes = dict(("[%s]" %(tag),"%s" %(code)) for tag,code in svg.items())
+  expression = re.compile("|".join(re.escape(tag) for tag in codes))
+  substitute = lambda match: codes[match.group(0)]
+
+  # One scan of each line for all tags. Inserted code is not scanned again, so
+  # tags inside it are left for a later add_string
+  return [expression.sub(substitute,line) for line in template]
 
 '''Get an image by name in the img directory'''
 def get_image(image_name):
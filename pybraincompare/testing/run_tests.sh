@@ -11,4 +11,4 @@ if [ "$#" -ne 2 ]; then
 fi
 
 cd $TEST_RUN_FOLDER
-nosetests --verbosity=3 --with-doctest --with-coverage --nocapture --cover-package=pybraincompare $TESTDIR/test_histogram.py $TESTDIR/test_masking.py $TESTDIR/test_correlation.py $TESTDIR/test_transformation.py
+nosetests --verbosity=3 --with-doctest --with-coverage --nocapture --cover-package=pybraincompare $TESTDIR/test_histogram.py $TESTDIR/test_masking.py $TESTDIR/test_correlation.py $TESTDIR/test_transformation.py $TESTDIR/test_search.py $TESTDIR/test_ttoz.py
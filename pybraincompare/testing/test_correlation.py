@@ -4,12 +4,37 @@
 Test regional and whole brain correlation scores
 """
 from builtins import range
-from pybraincompare.compare.mrutils import make_binary_deletion_mask,do_mask
+from pybraincompare.compare.mrutils import make_binary_deletion_mask,make_binary_deletion_vector,do_mask,apply_threshold
 from numpy.testing import assert_array_equal, assert_almost_equal, assert_equal
-from pybraincompare.compare.maths import calculate_correlation
-from pybraincompare.mr.datasets import get_data_directory
+from pybraincompare.compare.maths import (
+    calculate_correlation,
+    calculate_atlas_correlation,
+    calculate_cached_spearman,
+    calculate_correlation_matrix,
+    do_multi_correlation,
+    calculate_pairwise_correlation,
+    calculate_regional_correlation,
+    calculate_threshold_sweep,
+    RankCache
+)
+from pybraincompare.compare.streaming import (
+    calculate_correlation_streamed,
+    PearsonAccumulator,
+    RegionalPearsonAccumulator
+)
+from pybraincompare.compare.significance import calculate_correlation_significance
+from pybraincompare.compare.metrics import (
+    calculate_corpus_metrics,
+    calculate_data_metrics,
+    calculate_metrics,
+    metric_registry,
+    MetricData,
+    register_metric
+)
+from pybraincompare.compare.sparse import ThresholdedMaps
+from pybraincompare.mr.datasets import get_data_directory, get_pair_images
 from nose.tools import assert_true, assert_false
-from scipy.stats import norm, pearsonr
+from scipy.stats import norm, pearsonr, spearmanr
 import nibabel
 import random
 import pandas
@@ -45,3 +70,308 @@ def test_simulated_correlations():
     pdmask = nibabel.Nifti1Image(pdmask,header=mr1.get_header(),affine=mr1.get_affine())
     score = calculate_correlation(images = [mr1,mr2],mask=pdmask)  
     assert_almost_equal(corr,score,decimal=5)
+
+'''Test that regional correlations match scipy for each atlas region'''
+def test_regional_correlations():
+
+  numpy.random.seed(9191986)
+  number_values = 5000
+  data1 = numpy.round(norm.rvs(size=number_values),1)
+  data2 = numpy.round(data1 * 0.5 + norm.rvs(size=number_values),1)
+  atlas_vector = numpy.random.randint(1,50,size=number_values).astype(float)
+
+  for corr_type,corr_function in [("pearson",pearsonr),("spearman",spearmanr)]:
+    labels,corrs = calculate_regional_correlation(data1,data2,atlas_vector,
+                                                  corr_type=corr_type)
+    for label,corr in zip(labels,corrs):
+      region = atlas_vector == label
+      expected = corr_function(data1[region],data2[region])[0]
+      assert_almost_equal(expected,corr,decimal=10)
+
+    # calculate_pairwise_correlation returns the same values by label
+    regional = calculate_pairwise_correlation(data1,data2,corr_type=corr_type,
+                                              atlas_vector=atlas_vector)
+    for label,corr in zip(labels,corrs):
+      assert_almost_equal(regional[str(int(label))],corr,decimal=10)
+
+'''Test that spearman over cached ranks matches re-ranking after deletion'''
+def test_cached_spearman():
+
+  numpy.random.seed(9191986)
+  data1 = numpy.round(norm.rvs(size=2000),1)
+  data2 = numpy.round(data1 + norm.rvs(size=2000),1)
+  data1[numpy.random.choice(2000,300)] = 0
+  data2[numpy.random.choice(2000,300)] = numpy.nan
+  pdmask = make_binary_deletion_vector([data1,data2]) != 0
+  expected = spearmanr(data1[pdmask],data2[pdmask])[0]
+
+  cache = RankCache()
+  for x in range(2):
+    corr = calculate_cached_spearman(data1,data2,image_ids=["image1","image2"],
+                                     rank_cache=cache)
+    assert_almost_equal(expected,corr,decimal=10)
+    assert_equal(len(cache),2)
+
+  # Ids only turn on caching, the answer is the spearmanr of the vectors
+  cache = RankCache()
+  for vector2 in [data2,numpy.nan_to_num(data2)]:
+    expected = spearmanr(data1,vector2)[0]
+    for x in range(2):
+      corr = calculate_pairwise_correlation(data1,vector2,corr_type="spearman",
+                                            image_ids=["image1","image2"],
+                                            rank_cache=cache)
+      assert_almost_equal(expected,corr,decimal=10)
+
+  # An id with new values (and the same zeros and nans) is ranked again
+  cache = RankCache()
+  changed = data1 * -1
+  for vector1 in [data1,changed]:
+    pdmask = make_binary_deletion_vector([vector1,data2]) != 0
+    corr = calculate_cached_spearman(vector1,data2,image_ids=["image1","image2"],
+                                     rank_cache=cache)
+    assert_almost_equal(spearmanr(vector1[pdmask],data2[pdmask])[0],corr,decimal=10)
+
+'''Test that the correlation matrix matches pairwise deletion for each pair'''
+def test_correlation_matrix():
+
+  numpy.random.seed(9191986)
+  signal = norm.rvs(size=1000)
+  image_df = pandas.DataFrame()
+  for x in range(6):
+    data = numpy.round(signal * numpy.random.uniform(-1,1) + norm.rvs(size=1000),1)
+    data[numpy.random.choice(1000,100*x)] = 0
+    data[numpy.random.choice(1000,50*x)] = numpy.nan
+    image_df["image%s" %x] = data
+
+  for corr_type,corr_function in [("pearson",pearsonr),("spearman",spearmanr)]:
+    corrs,counts = calculate_correlation_matrix(image_df,corr_type=corr_type,
+                                                block_size=4,exact_spearman=True)
+    for image1 in image_df.columns:
+      for image2 in image_df.columns:
+        pdmask = make_binary_deletion_vector([image_df[image1].values,
+                                              image_df[image2].values]) != 0
+        expected = corr_function(image_df[image1][pdmask],image_df[image2][pdmask])[0]
+        assert_equal(counts.loc[image1,image2],pdmask.sum())
+        assert_almost_equal(expected,corrs.loc[image1,image2],decimal=4)
+
+  # By default spearman is a pearson of the ranks of each image, close to exact
+  approximate,approximate_counts = calculate_correlation_matrix(image_df,corr_type="spearman")
+  assert_array_equal(approximate_counts.values,counts.values)
+  assert_almost_equal(numpy.diag(approximate.values),numpy.ones(6))
+  assert_true(numpy.abs(approximate.values - corrs.values).max() < 0.05)
+  corrs,multi_counts = do_multi_correlation(image_df,corr_type="spearman",
+                                            pairwise_deletion=True,return_counts=True)
+  assert_almost_equal(corrs.values,approximate.values)
+  assert_array_equal(multi_counts.values,counts.values)
+
+  # do_multi_correlation is pandas by default, and for methods other than these
+  assert_almost_equal(do_multi_correlation(image_df).values,
+                      image_df.corr(min_periods=1).values)
+  corrs = do_multi_correlation(image_df,corr_type="kendall",pairwise_deletion=True)
+  assert_almost_equal(corrs.values,image_df.replace(0,numpy.nan).corr(method="kendall").values)
+  corrs,multi_counts = do_multi_correlation(image_df,return_counts=True)
+  present = image_df.notnull()
+  assert_equal(multi_counts.loc["image2","image4"],(present["image2"] & present["image4"]).sum())
+
+'''Test that streamed and merged accumulators match whole vector correlations'''
+def test_streaming_correlation():
+
+  numpy.random.seed(9191986)
+  data1 = norm.rvs(size=3000)
+  data2 = data1 * 0.3 + norm.rvs(size=3000)
+  data1[numpy.random.choice(3000,200)] = 0
+  atlas_vector = numpy.random.randint(1,10,size=3000).astype(float)
+  pdmask = make_binary_deletion_vector([data1,data2]) != 0
+  expected = pearsonr(data1[pdmask],data2[pdmask])[0]
+  regional = calculate_pairwise_correlation(data1[pdmask],data2[pdmask],
+                                            atlas_vector=atlas_vector[pdmask])
+
+  # Two workers each see half of the data, in chunks
+  whole = [PearsonAccumulator(),PearsonAccumulator()]
+  regions = [RegionalPearsonAccumulator(),RegionalPearsonAccumulator()]
+  for start in range(0,3000,250):
+    end = start + 250
+    worker = (start // 250) % 2
+    whole[worker].update(data1[start:end],data2[start:end])
+    regions[worker].update(data1[start:end],data2[start:end],atlas_vector[start:end])
+  assert_almost_equal(expected,whole[0].merge(whole[1]).correlation(),decimal=10)
+  merged = regions[0].merge(regions[1]).correlation()
+  for label,corr in regional.items():
+    assert_almost_equal(corr,merged[label],decimal=10)
+
+  # Slab reads from nifti images give the same correlation as calculate_correlation
+  images = get_pair_images(voxdims=["8","8"])
+  images = [nibabel.load(image) for image in images]
+  pdmask = make_binary_deletion_mask(images)
+  pdmask = nibabel.Nifti1Image(pdmask,header=images[0].get_header(),affine=images[0].get_affine())
+  expected = calculate_correlation(images=images,mask=pdmask)
+  assert_almost_equal(expected,calculate_correlation_streamed(images,slab_size=3),decimal=5)
+
+'''Test that atlas correlation with region lookups matches per voxel labels'''
+def test_atlas_correlation_labels():
+
+  numpy.random.seed(9191986)
+  data1 = norm.rvs(size=1000)
+  data2 = data1 + norm.rvs(size=1000)
+  atlas_vector = numpy.random.randint(1,5,size=1000).astype(float)
+  labels = dict((x,'"region%s"' %x) for x in range(1,5))
+  colors = dict((x,'"#00000%s"' %x) for x in range(1,5))
+  voxel_labels = [labels[int(x)] for x in atlas_vector]
+  voxel_colors = [colors[int(x)] for x in atlas_vector]
+  regional = calculate_pairwise_correlation(data1,data2,atlas_vector=atlas_vector)
+
+  df = calculate_atlas_correlation(data1,data2,atlas_vector,labels,colors)
+  df_voxels = calculate_atlas_correlation(data1,data2,atlas_vector,
+                                          voxel_labels,voxel_colors)
+  assert_equal(df.ATLAS_LABELS.tolist(),voxel_labels)
+  assert_equal(df.ATLAS_COLORS.tolist(),voxel_colors)
+  assert_array_equal(df.ATLAS_CORR.values,df_voxels.ATLAS_CORR.values)
+  assert_array_equal(df.ATLAS_CORR.values,
+                     [regional[str(int(x))] for x in atlas_vector])
+
+  summary = calculate_atlas_correlation(data1,data2,atlas_vector,labels,
+                                        colors,summary=True)
+  assert_equal(summary.shape[0],4)
+  for label,corr in zip(summary.ATLAS_LABELS,summary.ATLAS_CORR):
+    assert_equal(regional[label.replace('"','').replace("region","")],corr)
+
+'''Test that resampled significance is reproducible, and detects associations'''
+def test_correlation_significance():
+
+  numpy.random.seed(9191986)
+  data1 = norm.rvs(size=2000)
+  data2 = data1 * 0.3 + norm.rvs(size=2000)
+  noise = norm.rvs(size=2000)
+  atlas_vector = numpy.random.randint(1,4,size=2000).astype(float)
+
+  result,null = calculate_correlation_significance(data1,data2,n_resamples=200,seed=1)
+  assert_almost_equal(result.correlation["brain"],pearsonr(data1,data2)[0],decimal=10)
+  assert_equal(null.shape,(200,1))
+  assert_almost_equal(result.pvalue["brain"],1/201.0)
+  result,null = calculate_correlation_significance(data1,noise,n_resamples=200,seed=1)
+  assert_true(result.pvalue["brain"] > 0.01)
+
+  # Results depend on the seed, not on the number of workers
+  kwargs = {"corr_type":"spearman","atlas_vector":atlas_vector,"n_resamples":100,"seed":5}
+  result,null = calculate_correlation_significance(data1,data2,batch_size=25,**kwargs)
+  same,same_null = calculate_correlation_significance(data1,data2,batch_size=25,n_jobs=2,**kwargs)
+  assert_array_equal(null,same_null)
+  labels,corrs = calculate_regional_correlation(data1,data2,atlas_vector,"spearman")
+  assert_equal(result.index.tolist(),["1","2","3"])
+  assert_almost_equal(result.correlation.values,corrs,decimal=10)
+
+  # Bootstrap samples are centered on the observed correlations
+  result,null = calculate_correlation_significance(data1,data2,method="bootstrap",
+                                                   atlas_vector=atlas_vector,
+                                                   n_resamples=200,seed=2)
+  assert_true(numpy.all(numpy.abs(null.mean(axis=0) - result.correlation.values) < 0.02))
+
+'''Test that a threshold sweep matches thresholding images at each level'''
+def test_threshold_sweep():
+
+  numpy.random.seed(9191986)
+  data1 = numpy.round(norm.rvs(size=4000) * 2,2)
+  data2 = numpy.round(data1 * 0.5 + norm.rvs(size=4000),2)
+  data1[0:100] = numpy.nan
+  image1 = nibabel.Nifti1Image(data1.reshape(10,20,20),affine=numpy.eye(4))
+  image2 = nibabel.Nifti1Image(data2.reshape(10,20,20),affine=numpy.eye(4))
+
+  for direction,thresholds in [("posneg",[0,0.5,1.5,3.0,10]),
+                               ("pos",[0,1.0,2.0]),
+                               ("neg",[0,-1.0,1.0])]:
+    sweep = calculate_threshold_sweep(data1,data2,thresholds,direction)
+    assert_equal(sweep.shape[0],len(thresholds))
+    for thresh,corr,voxels in zip(sweep.threshold,sweep.correlation,sweep.voxels):
+      vector1 = apply_threshold(image1,thresh,direction).get_data().flatten()
+      vector2 = apply_threshold(image2,thresh,direction).get_data().flatten()
+      pdmask = make_binary_deletion_vector([vector1,vector2]) != 0
+      assert_equal(voxels,pdmask.sum())
+      if voxels < 2:
+        assert_true(numpy.isnan(corr))
+      else:
+        assert_almost_equal(corr,pearsonr(vector1[pdmask],vector2[pdmask])[0],decimal=10)
+
+  # Default thresholds are those of generate_thresholds
+  assert_equal(calculate_threshold_sweep(data1,data2).shape[0],400)
+
+'''Test that registered metrics match scipy over the overlap of each pair'''
+def test_metric_registry():
+
+  numpy.random.seed(9191986)
+  query = norm.rvs(size=1000) * 2
+  images = numpy.vstack([query * 0.5 + norm.rvs(size=1000) * 2 for x in range(4)])
+  images[:,0:50] = 0
+  query[900:] = numpy.nan
+
+  scores = calculate_corpus_metrics(query,images,image_ids=["a","b","c","d"])
+  assert_equal(scores.index.tolist(),["a","b","c","d"])
+  for i,image_id in enumerate(scores.index):
+    overlap = (images[i] != 0) & ~numpy.isnan(query)
+    x,y = images[i][overlap],query[overlap]
+    assert_almost_equal(scores.pearson[image_id],pearsonr(x,y)[0],decimal=10)
+    assert_almost_equal(scores.spearman[image_id],spearmanr(x,y)[0],decimal=10)
+    assert_almost_equal(scores.cosine[image_id],x.dot(y)/numpy.sqrt(x.dot(x)*y.dot(y)),decimal=10)
+    assert_almost_equal(scores.euclidean[image_id],numpy.sqrt(((x-y)**2).sum()),decimal=8)
+    a,b = numpy.abs(x) >= 1.96,numpy.abs(y) >= 1.96
+    assert_almost_equal(scores.dice[image_id],2.0*(a&b).sum()/(a.sum()+b.sum()),decimal=10)
+    assert_almost_equal(scores.jaccard[image_id],(a&b).sum()/float((a|b).sum()),decimal=10)
+
+  # Sums in blocks of images, and float32 images kept float32
+  data = MetricData(query,images.astype(numpy.float32),block_size=3)
+  assert_equal(data.images.dtype,numpy.float32)
+  blocked = calculate_data_metrics(data)
+  for name in scores.columns:
+    assert_almost_equal(blocked[name],scores[name].values,decimal=4)
+
+  # Third party metrics, and metrics through calculate_pairwise_correlation
+  register_metric("overlap",lambda data,**options: data.get_moments()[0])
+  single = calculate_metrics(images[0],query,metrics=["overlap","dice"],threshold=1.0)
+  assert_equal(single["overlap"],((images[0] != 0) & ~numpy.isnan(query)).sum())
+  assert_equal(calculate_pairwise_correlation(images[0],query,corr_type="overlap"),single["overlap"])
+  del metric_registry["overlap"]
+
+'''Test that sparse thresholded maps give dense overlaps and correlations'''
+def test_thresholded_maps():
+
+  numpy.random.seed(9191986)
+  maps = norm.rvs(size=(6,2000)).astype(numpy.float32)
+  maps[0,0:10] = numpy.nan
+  thresholded = ThresholdedMaps.from_vectors(maps,threshold=1.5,block_size=4)
+  passed = (numpy.abs(numpy.nan_to_num(maps)) >= 1.5)
+  assert_equal(thresholded.nnz,passed.sum())
+  assert_true(thresholded.density < 0.2)
+  assert_array_equal(thresholded.to_vector(2),numpy.where(passed[2],maps[2],0))
+
+  counts = thresholded.overlap_counts()
+  dice = thresholded.dice()
+  jaccard = thresholded.jaccard()
+  corrs = thresholded.correlation()
+  dense = thresholded.correlation(pairwise_deletion=False)
+  for i in range(6):
+    for j in range(6):
+      both = passed[i] & passed[j]
+      assert_equal(counts[i,j],both.sum())
+      assert_almost_equal(dice[i,j],2.0*both.sum()/(passed[i].sum()+passed[j].sum()))
+      assert_almost_equal(jaccard[i,j],both.sum()/float((passed[i]|passed[j]).sum()))
+      assert_almost_equal(corrs[i,j],pearsonr(maps[i][both],maps[j][both])[0],decimal=5)
+      assert_almost_equal(dense[i,j],pearsonr(thresholded.to_vector(i),
+                                              thresholded.to_vector(j))[0],decimal=5)
+
+  # Zeros never pass, even at a threshold of 0
+  zeros = numpy.where(numpy.arange(2000) < 1000,0,maps)
+  thresholded = ThresholdedMaps.from_vectors(zeros,threshold=0,direction="neg")
+  assert_equal(thresholded.nnz,(zeros < 0).sum())
+  assert_equal(thresholded.overlap_counts()[1,2],((zeros[1] < 0) & (zeros[2] < 0)).sum())
+
+  # Maps from images, back to nifti as apply_threshold
+  mr_directory = get_data_directory()
+  brain_mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  image_files = get_pair_images(voxdims=["8","8"])
+  thresholded = ThresholdedMaps.from_images(image_files,brain_mask,threshold=1.0,
+                                            direction="pos",image_ids=["a","b"])
+  for image_id,nii in thresholded.iter_nifti():
+    expected = apply_threshold(nibabel.load(image_files[thresholded.get_index(image_id)]),1.0,"pos")
+    in_mask = brain_mask.get_data() != 0
+    assert_almost_equal(nii.get_data()[in_mask],expected.get_data()[in_mask],decimal=5)
+  assert_almost_equal(ThresholdedMaps.from_vectors(maps[0:2],threshold=1.5).dice(
+                      ThresholdedMaps.from_vectors(maps[2:],threshold=1.5)),dice[0:2,2:])
@@ -10,12 +10,21 @@ from builtins import range
 from past.utils import old_div
 from pybraincompare.mr.datasets import get_pair_images, get_data_directory
 from pybraincompare.compare.mrutils import make_binary_deletion_mask, make_binary_deletion_vector
+from pybraincompare.compare.mrutils import get_atlas_vector, clear_atlas_cache, atlas_cache, resample_images_ref
+from pybraincompare.compare.mrutils import Mask, do_mask, make_nii, get_images_df
+from pybraincompare.compare.mrutils import apply_threshold, set_precision, get_image_data
+from pybraincompare.compare.mrutils import make_in_out_mask
+from pybraincompare.report.image import get_plot_image
+from pybraincompare.compare.store import VoxelStore, get_image_key
+from pybraincompare.compare import mrutils
 from pybraincompare.mr.datasets import get_data_directory
 from numpy.testing import assert_array_equal, assert_almost_equal, assert_equal
-from nose.tools import assert_true, assert_false
+from nose.tools import assert_true, assert_false, assert_raises
 from nilearn.image import resample_img
 import nibabel
+import tempfile
 import random
+import shutil
 import pandas
 import numpy
 import os
@@ -148,3 +157,197 @@ def test_binary_deletion_vector():
     if overlap == 1:
       assert_equal(numpy.unique(pdmask)[0],1)
 
+
+'''Test that cached atlas vectors match a fresh resample, and the cache is bounded'''
+def test_atlas_cache():
+
+  mr_directory = get_data_directory()
+  atlas_file = "%s/MNI-maxprob-thr25-2mm.nii" %(mr_directory)
+  brain_mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  clear_atlas_cache()
+
+  resampled,_ = resample_images_ref(images=atlas_file,
+                                    reference=brain_mask,
+                                    interpolation="nearest")
+  expected = numpy.squeeze(resampled[0].get_data())[brain_mask.get_data() != 0]
+
+  vector = get_atlas_vector(atlas_file,reference=brain_mask,mask=brain_mask)
+  assert_array_equal(vector,expected)
+  assert_equal(len(atlas_cache),2)
+
+  # A second call returns the cached (read only) vector
+  assert_true(get_atlas_vector(atlas_file,brain_mask,brain_mask) is vector)
+  assert_false(vector.flags.writeable)
+
+  # A new mask on the same grid reuses the resampled volume
+  half_mask = numpy.zeros(brain_mask.shape)
+  half_mask[0:brain_mask.shape[0]//2] = brain_mask.get_data()[0:brain_mask.shape[0]//2]
+  half_mask = nibabel.Nifti1Image(half_mask,affine=brain_mask.get_affine())
+  half_vector = get_atlas_vector(atlas_file,brain_mask,half_mask)
+  assert_equal(len(atlas_cache),3)
+  assert_equal(len(half_vector),int((half_mask.get_data() != 0).sum()))
+
+  # Invalidation, and the size bound
+  clear_atlas_cache(atlas_file)
+  assert_equal(len(atlas_cache),0)
+  cache_size = mrutils.atlas_cache_size
+  mrutils.atlas_cache_size = 2
+  get_atlas_vector(atlas_file,brain_mask,brain_mask)
+  get_atlas_vector(atlas_file,brain_mask,half_mask)
+  assert_equal(len(atlas_cache),2)
+  mrutils.atlas_cache_size = cache_size
+  clear_atlas_cache()
+
+'''Test that a compiled Mask gives the same values as masking with nilearn'''
+def test_compiled_mask():
+
+  mr_directory = get_data_directory()
+  brain_mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  image_files = get_pair_images(voxdims=["8","8"])
+  images = [nibabel.load(image) for image in image_files]
+  mask = Mask(brain_mask)
+  assert_equal(len(mask),int((brain_mask.get_data() != 0).sum()))
+
+  masked = do_mask(images,brain_mask)
+  assert_array_equal(do_mask(images,mask),masked)
+  assert_array_equal(mask.mask(images[0]),masked[0])
+  assert_array_equal(get_images_df(image_files,mask).values,get_images_df(image_files,brain_mask).values)
+
+  # One image is a single column, with a Mask, a mask image, or a store
+  store_dir = tempfile.mkdtemp()
+  try:
+    for image in [image_files[0],images[0]]:
+      expected = get_images_df(image,brain_mask)
+      assert_equal(expected.shape,(len(mask),1))
+      assert_array_equal(get_images_df(image,mask).values,expected.values)
+      assert_array_equal(get_images_df(image,mask,store=store_dir).values,expected.values)
+  finally:
+    shutil.rmtree(store_dir)
+  assert_array_equal(make_nii(masked[0],mask).get_data(),make_nii(masked[0],brain_mask).get_data())
+  assert_array_equal(mask.unmask(masked)[1],make_nii(masked[1],brain_mask).get_data())
+
+  # Any memory layout of the data gives the same values
+  data = numpy.ascontiguousarray(images[0].get_data())
+  assert_array_equal(mask.take(data),mask.take(numpy.asfortranarray(data)))
+  assert_array_equal(mask.take(data),mask.take(data[::-1][::-1]))
+
+  # Deletion masks limited to the mask
+  pdmask = make_binary_deletion_mask(images) * (brain_mask.get_data() != 0)
+  assert_array_equal(make_binary_deletion_mask(images,mask=mask),pdmask)
+
+'''Test that a voxel store gives the same images as get_images_df'''
+def test_voxel_store():
+
+  mr_directory = get_data_directory()
+  brain_mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  image_files = get_pair_images(voxdims=["8","8"])
+  expected = get_images_df(image_files,brain_mask).values
+  store_dir = tempfile.mkdtemp()
+  try:
+    store = VoxelStore(store_dir,mask=brain_mask,chunk_size=3)
+    assert_array_equal(get_images_df(image_files,brain_mask,store=store).values,expected)
+    assert_equal(store.ids,[get_image_key(x) for x in image_files])
+
+    # Images already in the store are not added again
+    get_images_df(image_files[::-1],brain_mask,store=store)
+    assert_equal(len(store),2)
+
+    # Rows across chunks, and contiguous rows as a view of the memory map
+    store.append(numpy.vstack([expected,expected]),image_ids=["a","b","c","d"])
+    assert_array_equal(store.get_rows([0,3,5]),expected[[0,1,1]])
+    rows = store.get_rows(slice(0,2))
+    assert_true(isinstance(rows.base,numpy.memmap) or isinstance(rows,numpy.memmap))
+    assert_false(rows.flags.writeable)
+
+    # The store is persistent, and checks the mask
+    store = VoxelStore(store_dir)
+    assert_equal(len(store),6)
+    assert_array_equal(store.get_images_df(["d","a"]).values,expected[[1,0]])
+    assert_array_equal(get_images_df(image_files[1],brain_mask,store=store_dir)[0],expected[1])
+    other_mask = nibabel.Nifti1Image((brain_mask.get_data() != 0)[::-1].astype(int),
+                                     affine=brain_mask.get_affine())
+    assert_raises(ValueError,VoxelStore,store_dir,other_mask)
+    assert_raises(ValueError,store.append,[expected[0]],["a"])
+    assert_raises(ValueError,get_images_df,image_files,other_mask,store=store)
+
+    # A file changed in place is masked again
+    changed_file = os.path.join(store_dir,"changed.nii.gz")
+    nibabel.save(nibabel.load(image_files[0]),changed_file)
+    assert_array_equal(get_images_df(changed_file,brain_mask,store=store)[0],expected[0])
+    nibabel.save(nibabel.load(image_files[1]),changed_file)
+    os.utime(changed_file,(0,1))
+    assert_array_equal(get_images_df(changed_file,brain_mask,store=store)[0],expected[1])
+
+    # An image asked for twice is added once, and returned twice
+    copied_file = os.path.join(store_dir,"copied.nii.gz")
+    nibabel.save(nibabel.load(image_files[1]),copied_file)
+    number_rows = len(store)
+    assert_array_equal(get_images_df([copied_file,copied_file],brain_mask,store=store).values,
+                       expected[[1,1]])
+    assert_equal(len(store),number_rows + 1)
+
+    # The store cleans values (or not) for every caller the same way
+    assert_raises(ValueError,get_images_df,image_files,brain_mask,
+                  ensure_finite=False,store=store)
+  finally:
+    shutil.rmtree(store_dir)
+
+'''Test that float32 and native precision give the float64 results'''
+def test_precision():
+
+  mr_directory = get_data_directory()
+  brain_mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  images = [nibabel.load(image) for image in get_pair_images(voxdims=["8","8"])]
+  masked = do_mask(images,brain_mask,dtype="float64")
+  pdmask = make_binary_deletion_mask(images)
+  thresholded = apply_threshold(images[0],1.96).get_data()
+
+  try:
+    for precision in ["float32","native"]:
+      set_precision(precision)
+      images = [nibabel.load(image) for image in get_pair_images(voxdims=["8","8"])]
+      assert_equal(make_binary_deletion_mask(images).dtype,numpy.float32)
+      assert_array_equal(make_binary_deletion_mask(images),pdmask)
+      assert_almost_equal(apply_threshold(images[0],1.96).get_data(),thresholded,decimal=5)
+      assert_false(images[0].in_memory)
+      masked32 = do_mask(images,brain_mask)
+      assert_equal(masked32.dtype,numpy.float32)
+      assert_array_equal(do_mask(images,Mask(brain_mask)),masked32)
+      assert_almost_equal(masked32,masked,decimal=5)
+  finally:
+    set_precision(None)
+
+  # Native keeps integer data as it is on disk
+  labels = nibabel.Nifti1Image((brain_mask.get_data() != 0).astype(numpy.int16),
+                               affine=brain_mask.get_affine())
+  assert_equal(get_image_data(labels,"native").dtype,numpy.int16)
+  assert_equal(get_image_data(labels,"float32").dtype,numpy.float32)
+  assert_equal(do_mask(labels,brain_mask,dtype="native").dtype,numpy.int16)
+  assert_raises(ValueError,set_precision,"float16")
+
+'''Test that in and out of mask images are made in memory, written only if asked'''
+def test_in_out_mask():
+
+  mr_directory = get_data_directory()
+  brain_mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  image = nibabel.load(get_pair_images(voxdims=["8","8"])[0])
+  data = image.get_data()
+  in_mask = brain_mask.get_data() != 0
+  mr_folder = tempfile.mkdtemp()
+  try:
+    mr_in_mask,mr_out_mask = make_in_out_mask(brain_mask,mr_folder,data[in_mask],data[~in_mask],
+                                              img_dir=mr_folder,save_png=False,save_nii=False)
+    assert_equal(os.listdir(mr_folder),[])
+    assert_array_equal(mr_in_mask.get_data()[in_mask],data[in_mask])
+    assert_array_equal(mr_out_mask.get_data()[~in_mask],data[~in_mask])
+    assert_true((mr_in_mask.get_data()[~in_mask] == 0).all())
+
+    # The saved image keeps the values, not the data type of the mask
+    make_in_out_mask(brain_mask,mr_folder,data[in_mask],data[~in_mask],
+                     img_dir=mr_folder,save_png=False)
+    assert_equal(os.listdir(mr_folder),["masked.nii"])
+    saved = nibabel.load("%s/masked.nii" %(mr_folder))
+    assert_almost_equal(saved.get_data()[in_mask],data[in_mask])
+  finally:
+    shutil.rmtree(mr_folder)
+  assert_true(get_plot_image(mr_in_mask) is mr_in_mask)
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+"""
+Test scoring a query image against a corpus of images
+"""
+from builtins import range
+from pybraincompare.compare.corpus import ImageCorpus
+from pybraincompare.compare.ann import ANNIndex, benchmark_ann
+from pybraincompare.compare.index import CorpusIndex
+from pybraincompare.compare.overlap import PackedValidity
+from pybraincompare.compare.search import (
+    create_glassbrain_portfolio,
+    create_glassbrain_portfolio_json,
+    create_portfolio_data,
+    rank_top_scores,
+    similarity_search,
+    SearchColumns
+)
+from pybraincompare.template.templates import add_string
+from pybraincompare.template.futils import unwrap_list_unique
+from pybraincompare.compare.mrutils import make_binary_deletion_vector
+from pybraincompare.mr.datasets import get_data_directory
+from numpy.testing import assert_array_equal, assert_almost_equal, assert_equal
+from nose.tools import assert_true, assert_false, assert_raises
+from scipy.stats import norm, pearsonr, spearmanr
+import threading
+import tempfile
+import nibabel
+import numpy
+import io
+import os
+
+
+def get_corpus_vectors(number_images=12,number_values=3000):
+  '''Random vectors with shared signal, zeros and nans (missing values)'''
+  numpy.random.seed(9191986)
+  signal = norm.rvs(size=number_values)
+  vectors = numpy.array([signal * numpy.random.uniform(-1,1) + norm.rvs(size=number_values)
+                         for x in range(number_images)])
+  for x in range(number_images):
+    missing = numpy.random.choice(number_values,size=number_values//(x+2),replace=False)
+    vectors[x,missing[0::2]] = 0
+    vectors[x,missing[1::2]] = numpy.nan
+  return vectors
+
+'''Test that corpus scores match pairwise deletion + pearsonr for each pair'''
+def test_corpus_scores():
+
+  vectors = get_corpus_vectors()
+  mr_directory = get_data_directory()
+  mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  corpus = ImageCorpus(vectors,mask=mask,block_size=5)
+  query = vectors[3]
+  scores,counts = corpus.score(query,return_counts=True)
+
+  for x in range(vectors.shape[0]):
+    pdmask = make_binary_deletion_vector([query,vectors[x]]) != 0
+    expected = pearsonr(query[pdmask],vectors[x][pdmask])[0]
+    assert_equal(counts[x],pdmask.sum())
+    assert_almost_equal(expected,scores[x],decimal=4)
+  assert_almost_equal(scores[3],1.0,decimal=4)
+
+  # Appended one at a time, the buffer doubles, and scores are the same
+  grown = ImageCorpus(vectors[0:1],mask=mask,block_size=5)
+  for x in range(1,vectors.shape[0]):
+    grown.append(vectors[x:x+1])
+  assert_equal(grown.buffer.shape[0],16)
+  assert_equal(grown.image_ids,corpus.image_ids)
+  assert_array_equal(grown.validity.bits,corpus.validity.bits)
+  assert_almost_equal(grown.score(query),scores,decimal=5)
+
+'''Test that spearman corpus scores (cached ranks) match scipy spearmanr'''
+def test_corpus_spearman_scores():
+
+  vectors = get_corpus_vectors()
+  # Two images without missing values, compared without re-ranking
+  vectors[0][numpy.isnan(vectors[0]) | (vectors[0] == 0)] = 1.5
+  vectors[1][numpy.isnan(vectors[1]) | (vectors[1] == 0)] = -0.5
+  mr_directory = get_data_directory()
+  mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  corpus = ImageCorpus(vectors,mask=mask,block_size=5)
+
+  for query_index in [0,3]:
+    query = vectors[query_index]
+    scores = corpus.score(query,corr_type="spearman",query_id="query")
+    for x in range(vectors.shape[0]):
+      pdmask = make_binary_deletion_vector([query,vectors[x]]) != 0
+      expected = spearmanr(query[pdmask],vectors[x][pdmask])[0]
+      assert_almost_equal(expected,scores[x],decimal=4)
+
+  # A second corpus (same mask and ids), with values equal to the image mean
+  others = get_corpus_vectors()[::-1].copy()
+  others[0] = numpy.tile([1,2,3,2],len(others[0]) // 4)
+  others[1] = -others[1]
+  corpus = ImageCorpus(others,mask=mask,block_size=5)
+  scores = corpus.score(vectors[3],corr_type="spearman")
+  for x in range(others.shape[0]):
+    pdmask = make_binary_deletion_vector([vectors[3],others[x]]) != 0
+    expected = spearmanr(vectors[3][pdmask],others[x][pdmask])[0]
+    assert_almost_equal(expected,scores[x],decimal=4)
+
+'''Test that bit-packed overlap counts match the pairwise deletion vectors'''
+def test_corpus_overlap_counts():
+
+  vectors = get_corpus_vectors(number_images=9,number_values=3001)
+  mr_directory = get_data_directory()
+  mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  corpus = ImageCorpus(vectors,mask=mask,block_size=4)
+  valid = (vectors != 0) & ~numpy.isnan(vectors)
+  assert_equal(corpus.validity.nbytes,9 * 376)
+  assert_array_equal(corpus.validity.counts(),valid.sum(axis=1))
+
+  counts = corpus.overlap_counts()
+  for x in range(9):
+    for y in range(9):
+      pdmask = make_binary_deletion_vector([vectors[x],vectors[y]]) != 0
+      assert_equal(counts[x,y],pdmask.sum())
+  assert_array_equal(corpus.validity.intersection(2,5),valid[2] & valid[5])
+  assert_array_equal(corpus.validity.pair_counts([(2,5),(0,8)]),[counts[2,5],counts[0,8]])
+  assert_array_equal(corpus.overlap_counts(vectors[4]),counts[4])
+  assert_array_equal(PackedValidity.from_valid(valid).overlap_counts(block_size=64),counts)
+
+'''Test that portfolios are the same written to a sink, and shipped as json'''
+def test_portfolio():
+
+  number = 500
+  tags = [["tag %s" %(i % 7),"other"] for i in range(number)]
+  unique_tags = unwrap_list_unique(tags)
+  placeholders = dict((tag,tag.replace(" ","")) for tag in unique_tags)
+  options = {"image_paths":["/static/images/%s.png" %(i) for i in range(number)],
+             "all_tags":tags,
+             "unique_tags":unique_tags,
+             "placeholders":placeholders,
+             "values":numpy.round(numpy.linspace(1,0,number),2),
+             "button_urls":["/compare/1/%s" %(i) for i in range(number)],
+             "image_urls":["/images/%s" %(i) for i in range(number)]}
+  portfolio = create_glassbrain_portfolio(**options)
+  assert_equal(portfolio.count('class="portfolio-item '),number)
+  assert_equal(portfolio.count('onload="imgLoaded(this)"'),1)
+  sink = io.StringIO()
+  create_glassbrain_portfolio(sink=sink,**options)
+  assert_equal(sink.getvalue(),portfolio)
+
+  # The json payload keeps strings once, and is smaller than the html
+  data = create_portfolio_data(**options)
+  assert_equal(data["png"][0],"/static/images/")
+  assert_equal(data["png"][1][10],"10.png")
+  assert_equal(data["score"][0],1.0)
+  assert_equal([data["placeholders"][t] for t in data["tags"][3]],["tag3","other"])
+  portfolio_json = create_glassbrain_portfolio_json(**options)
+  assert_true(len(portfolio_json) < len(portfolio) / 3)
+  assert_true('id="portfolio-items"' in portfolio_json)
+
+  # All tags of a template are filled in one pass, tags in added code are not
+  template = ["<p>[A] and [B]</p>\n","no tags [C]\n"]
+  assert_equal(add_string({"A":"[B]","B":"b"},template),["<p>[B] and b</p>\n","no tags [C]\n"])
+  assert_equal(add_string({"B":"b"},add_string({"A":"[B]"},template)),
+               ["<p>b and b</p>\n","no tags [C]\n"])
+
+'''Test that top scores are the first of a full sort, without the query'''
+def test_rank_top_scores():
+
+  numpy.random.seed(9191986)
+  scores = numpy.round(norm.rvs(size=50000),2)
+  scores[0:1000] = numpy.nan
+  for absolute_value in [True,False]:
+    key = numpy.abs(scores) if absolute_value else scores
+    order = numpy.argsort(-numpy.where(numpy.isnan(key),-numpy.inf,key),kind="stable")
+    top = rank_top_scores(scores,max_results=100,absolute_value=absolute_value,exclude=[order[3]])
+    assert_array_equal(top,numpy.delete(order,3)[0:100])
+  assert_array_equal(rank_top_scores(scores[0:5],10),[0,1,2,3,4])
+  assert_equal(len(rank_top_scores(scores,0)),0)
+
+  # Results are gathered from columns held once, the same as from a data frame
+  number = 200
+  image_ids = ["image%s" %(i) for i in range(number)]
+  png_paths = ["%s.png" %(x) for x in image_ids]
+  tags = [["tag %s" %(i % 3)] for i in range(number)]
+  image_scores = norm.rvs(size=number)
+  options = {"query_png":png_paths[0],"query_id":image_ids[0],"button_url":"/compare",
+             "image_url":"/images","max_results":20,"absolute_value":True}
+  columns = SearchColumns(png_paths,tags,image_ids)
+  html = similarity_search(image_scores,None,None,image_ids=None,columns=columns,**options)
+  assert_equal("".join(html),"".join(similarity_search(image_scores,tags,png_paths,
+                                                       image_ids=image_ids,**options)))
+  expected = numpy.argsort(-numpy.abs(image_scores),kind="stable")
+  expected = [x for x in expected if x != 0][0:20]
+  items = "".join(html).split('class="portfolio-item ')[1:]
+  assert_equal(len(items),20)
+  for item,i in zip(items,expected):
+    assert_true('data-layzr="%s"' %(png_paths[i]) in item)
+
+'''Test that approximate search finds the exact top images, and is saved'''
+def test_ann_index():
+
+  numpy.random.seed(9191986)
+  patterns = norm.rvs(size=(10,2000))
+  labels = numpy.arange(300) % 10
+  signs = numpy.where(numpy.arange(300) % 7 == 0,-1,1)
+  vectors = 2 * patterns[labels] * signs[:,numpy.newaxis] + norm.rvs(size=(300,2000))
+  vectors[:,0:200][numpy.random.uniform(size=(300,200)) < 0.3] = numpy.nan
+  mr_directory = get_data_directory()
+  mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  corpus = ImageCorpus(vectors,mask=mask,block_size=64)
+  exact = corpus.score(vectors[5])
+
+  for reduction in ["projection","pca"]:
+    index = ANNIndex(corpus,n_components=32,reduction=reduction,nprobe=4,n_candidates=60)
+    assert_equal(sorted(index.members),list(range(300)))
+    positions,scores = index.search(vectors[5],max_results=20,exclude=[5])
+    expected = rank_top_scores(exact,20,exclude=[5])
+    assert_true(len(numpy.intersect1d(positions,expected)) >= 18)
+    assert_false(5 in positions)
+    assert_almost_equal(scores,exact[positions],decimal=5)
+
+    # Every list probed and every image a candidate is the exact search
+    positions,scores = index.search(vectors[5],max_results=300,nprobe=index.n_lists,
+                                    n_candidates=300,absolute_value=False)
+    assert_array_equal(positions,rank_top_scores(exact,300,absolute_value=False))
+
+    tmpdir = tempfile.mkdtemp()
+    filename = index.save(os.path.join(tmpdir,"index.npz"))
+    loaded = ANNIndex.load(filename,corpus)
+    assert_array_equal(loaded.search(vectors[8])[0],index.search(vectors[8])[0])
+
+  results = benchmark_ann(index,[vectors[x] for x in range(5)],nprobes=[1,index.n_lists])
+  assert_equal(list(results["method"]),["exact","ann","ann"])
+  assert_equal(results["recall"].iloc[2],1.0)
+
+  # At least one list is probed
+  assert_array_equal(index.search(vectors[5],nprobe=0)[0],index.search(vectors[5],nprobe=1)[0])
+
+  # An index is not used for a corpus that has grown since it was built
+  corpus.append(vectors[0:2])
+  assert_raises(ValueError,index.search,vectors[5])
+  assert_raises(ValueError,index.score,vectors[5])
+  assert_equal(len(index.build()),302)
+
+'''Test that an index kept up to date scores as a corpus built from scratch'''
+def test_corpus_index():
+
+  mr_directory = get_data_directory()
+  mask = nibabel.load("%s/MNI152_T1_8mm_brain_mask.nii.gz" %(mr_directory))
+  vectors = get_corpus_vectors(number_images=12,number_values=int((mask.get_fdata() != 0).sum()))
+  index_dir = os.path.join(tempfile.mkdtemp(),"index")
+  index = CorpusIndex(index_dir,mask=mask,chunk_size=4,compact_ratio=None)
+  ids = ["image%s" %(i) for i in range(12)]
+  assert_equal(index.add(vectors[0:8],ids[0:8]),ids[0:8])
+  assert_equal(index.add(vectors[0:2],ids[0:2]),[])
+
+  # Queries on a snapshot do not change while the index does
+  snapshot = index.snapshot()
+  before = snapshot.score(vectors[3])
+  index.add(vectors[8:],ids[8:])
+  index.remove(["image1","image5"])
+  vectors[2] = vectors[11] * -2
+  assert_equal(index.update(vectors[2:3],["image2"]),["image2"])
+  assert_array_equal(snapshot.score(vectors[3]),before)
+  assert_equal(index.dead_rows,3)
+
+  def check(index):
+    expected = [x for x in ids if x not in ["image1","image5"]]
+    assert_equal(sorted(index.ids),sorted(expected))
+    corpus = ImageCorpus(vectors[[ids.index(x) for x in index.ids]],mask=mask,
+                         image_ids=index.ids)
+    image_ids,scores = index.score(vectors[3])
+    assert_equal(image_ids,corpus.image_ids)
+    assert_almost_equal(scores,corpus.score(vectors[3]),decimal=5)
+    found,top_scores = index.search(vectors[3],max_results=3,exclude=["image3"])
+    assert_equal(found,[corpus.image_ids[i] for i in rank_top_scores(corpus.score(vectors[3]),3,
+                                                                        exclude=[index.ids.index("image3")])])
+  check(index)
+
+  # Reopened from disk, and after compaction
+  check(CorpusIndex(index_dir))
+  index.compact()
+  assert_equal(index.dead_rows,0)
+  assert_equal(index.generation,1)
+  check(index)
+  check(CorpusIndex(index_dir))
+  assert_array_equal(snapshot.score(vectors[3]),before)
+
+  # Re-indexing a directory only reads files that changed
+  image_dir = tempfile.mkdtemp()
+  index = CorpusIndex(os.path.join(image_dir,"index"),mask=mask)
+  mask_data = mask.get_fdata() != 0
+  for i in range(3):
+    data = numpy.zeros(mask.shape)
+    data[mask_data] = vectors[i]
+    nibabel.save(nibabel.Nifti1Image(data,mask.affine),os.path.join(image_dir,"map%s.nii.gz" %(i)))
+  summary = index.index_directory(image_dir)
+  assert_equal(summary["added"],["map0.nii.gz","map1.nii.gz","map2.nii.gz"])
+  data[mask_data] = vectors[5]
+  nibabel.save(nibabel.Nifti1Image(data,mask.affine),os.path.join(image_dir,"map2.nii.gz"))
+  os.remove(os.path.join(image_dir,"map0.nii.gz"))
+  summary = index.index_directory(image_dir)
+  assert_equal(summary,{"added":[],"updated":["map2.nii.gz"],"removed":["map0.nii.gz"],
+                        "unchanged":["map1.nii.gz"]})
+  assert_equal(len(index),2)
+
+  # Queries are answered while an image is masked and written to the store
+  mask_image = index.store.mask_image
+  sizes = []
+  def query_while_masking(image):
+    thread = threading.Thread(target=lambda: sizes.append(len(index.snapshot())))
+    thread.start()
+    thread.join(30)
+    return mask_image(image)
+  index.store.mask_image = query_while_masking
+  assert_equal(index.add(vectors[0:1],["vector0"]),["vector0"])
+  assert_equal(sizes,[2])
+  assert_equal(len(index.snapshot()),3)
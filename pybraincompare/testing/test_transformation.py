@@ -4,11 +4,20 @@
 Test transformation functions
 """
 from pybraincompare.mr.transformation import make_resampled_transformation_vector, make_resampled_transformation
-from pybraincompare.mr.datasets import get_pair_images, get_standard_mask
+from pybraincompare.mr.datasets import get_pair_images, get_standard_mask, get_data_directory
+from pybraincompare.mr.datasets import StandardSpace, get_standard_space
+from pybraincompare.compare.mrutils import resample_images_ref
+from pybraincompare.compare import mrutils
+from pybraincompare.compare.cache import ResampleCache
+from pybraincompare.compare.resampling import resample_images, operator_cache
+from nilearn.image import resample_img
+from concurrent.futures import ThreadPoolExecutor
 from numpy.testing import assert_array_equal, assert_almost_equal, assert_equal
-from nose.tools import assert_true, assert_false
+from nose.tools import assert_true, assert_false, assert_raises
 import nibabel
+import tempfile
 import random
+import shutil
 import pandas
 import numpy
 import os
@@ -35,3 +44,132 @@ def test_unmasked_transformation():
     nonzero_voxels = len(brain_4mm.get_data().flatten())
     image1_vector = make_resampled_transformation_vector(image1,resample_dim=[4,4,4],standard_mask=False)
     assert_equal(nonzero_voxels,len(image1_vector))
+
+def test_resample_cache():
+    images = get_pair_images(voxdims=["2","2"])
+    reference = get_standard_mask(8)
+    cache = ResampleCache(tempfile.mkdtemp())
+    expected,_ = resample_images_ref(images,reference,"continuous")
+    resampled,_ = resample_images_ref(images,reference,"continuous",cache=cache)
+    assert_equal(len(cache.entries()),2)
+
+    # A second resample of the same images is read from the cache
+    cached,_ = resample_images_ref(images,reference,"continuous",cache=cache)
+    assert_true(isinstance(cached[0].dataobj,numpy.memmap))
+    for image,other in zip(expected,cached):
+        assert_array_equal(image.get_data(),other.get_data())
+        assert_array_equal(image.get_affine(),other.get_affine())
+        assert_equal(image.header.get_data_dtype(),other.header.get_data_dtype())
+        assert_equal(image.header.get_qform(coded=True)[1],other.header.get_qform(coded=True)[1])
+        assert_equal(image.header.get_sform(coded=True)[1],other.header.get_sform(coded=True)[1])
+
+    # An entry comes back with the header it was put with
+    header = expected[0].header.copy()
+    header.set_xyzt_units("mm","sec")
+    header["descrip"] = b"resampled"
+    cache.put("header",nibabel.Nifti1Image(expected[0].get_data(),expected[0].affine,header))
+    assert_equal(cache.get("header").header["descrip"],b"resampled")
+    assert_equal(cache.get("header").header.get_xyzt_units(),("mm","sec"))
+    cache.remove(cache.get_paths("header")[0])
+
+    # Different interpolation is a different entry, and the size is bounded
+    resample_images_ref(images[0],reference,"nearest",cache=cache)
+    assert_equal(len(cache.entries()),3)
+    cache.evict(max_bytes=cache.entries()[-1][1])
+    assert_equal(len(cache.entries()),1)
+    cache.clear()
+    assert_equal(len(cache.entries()),0)
+
+def test_sparse_resampling():
+    image = nibabel.load(get_pair_images(voxdims=["2","2"])[0])
+    data = image.get_data()
+    images = [nibabel.Nifti1Image(data * (i + 1),affine=image.get_affine()) for i in range(3)]
+    reference = get_standard_mask(4)
+
+    # A rotated target grid is not separable, and uses a single operator
+    rotation = numpy.eye(4)
+    rotation[0:2,0:2] = [[numpy.cos(0.2),-numpy.sin(0.2)],[numpy.sin(0.2),numpy.cos(0.2)]]
+    operator_cache.clear()
+    for affine in [reference.get_affine(),rotation.dot(reference.get_affine())]:
+        for interpolation in ["continuous","linear","nearest"]:
+            expected = [resample_img(i,target_affine=affine,target_shape=reference.shape,
+                                     interpolation=interpolation) for i in images]
+            resampled = resample_images(images,affine,reference.shape,interpolation)
+            for image1,image2 in zip(expected,resampled):
+                assert_almost_equal(image1.get_data(),image2.get_data(),decimal=4)
+                assert_equal(image1.get_data_dtype(),image2.get_data_dtype())
+    assert_equal(len(operator_cache),6)
+
+    # Vectors in a target mask, and through resample_images_ref
+    mask = reference.get_data() != 0
+    vectors = resample_images(images,reference.get_affine(),reference.shape,target_mask=mask)
+    resampled,_ = resample_images_ref(images,reference,"continuous",sparse=True)
+    for vector,image1 in zip(vectors,resampled):
+        assert_array_equal(vector.astype(numpy.float32),image1.get_data()[mask])
+
+def test_parallel_resampling():
+    images = get_pair_images(voxdims=["2","2"]) + get_pair_images(voxdims=["8","8"])
+    reference = get_standard_mask(4)
+    expected,_ = resample_images_ref(images,reference,"continuous")
+    resampled,_ = resample_images_ref(images,reference,"continuous",n_jobs=2)
+    assert_equal(len(resampled),len(images))
+    for image1,image2 in zip(expected,resampled):
+        assert_array_equal(image1.get_data(),image2.get_data())
+        assert_array_equal(image1.get_affine(),image2.get_affine())
+
+    # Any executor, with images already on the reference grid passed through
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        resampled,_ = resample_images_ref(images + [reference],reference,"nearest",
+                                          executor=executor)
+    assert_true(resampled[-1] is reference)
+
+    # Sparse resampling does not run in workers
+    assert_raises(ValueError,resample_images_ref,images,reference,"continuous",
+                  sparse=True,n_jobs=2)
+
+def test_standard_space():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        # Derived resolutions are resampled once, and saved for later
+        space = StandardSpace(6,cache_dir=cache_dir)
+        assert_equal(sorted(os.listdir(cache_dir)),["MNI152_T1_6mm_brain.nii.gz",
+                                                    "MNI152_T1_6mm_brain_mask.nii.gz"])
+        saved = StandardSpace(6.0,cache_dir=cache_dir)
+        assert_array_equal(saved.mask.get_data(),space.mask.get_data())
+        assert_array_equal(saved.indices,numpy.flatnonzero(space.mask.get_data()))
+        assert_true(saved.mask_bin.sum() == len(saved.indices))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    # Resolved once per process, the bundled resolutions are not resampled
+    assert_true(get_standard_space(4) is get_standard_space(4.0))
+    assert_true(get_standard_space(4) is not get_standard_space(4,cache_dir=tempfile.gettempdir()))
+    assert_equal(get_standard_mask(4).get_filename(),
+                 os.path.join(get_data_directory(),"MNI152_T1_4mm_brain_mask.nii.gz"))
+
+    # Callers get copies, so changing one does not change the shared template
+    mask = get_standard_mask(4)
+    assert_true(mask is not get_standard_space(4).mask)
+    mask.get_data()[:] = 0
+    assert_true(get_standard_mask(4).get_data().sum() > 0)
+    assert_true(get_standard_space(4).mask.get_data().sum() > 0)
+
+    # Bundled templates when FSL is not installed, said once
+    fsldir = os.environ.pop("FSLDIR",None)
+    mrutils.bundled_standard_notices.discard("FSL")
+    try:
+        assert_true(os.path.exists(mrutils.get_standard_mask("FSL")))
+        assert_true(os.path.exists(mrutils.get_standard_brain("FSL")))
+        assert_equal(mrutils.bundled_standard_notices,set(["FSL"]))
+    finally:
+        if fsldir is not None:
+            os.environ["FSLDIR"] = fsldir
+
+    # There is no bundled FREESURFER standard
+    freesurfer_home = os.environ.pop("FREESURFER_HOME",None)
+    try:
+        assert_raises(ValueError,mrutils.get_standard_mask,"FREESURFER")
+        assert_raises(ValueError,mrutils.get_standard_brain,"FREESURFER")
+    finally:
+        if freesurfer_home is not None:
+            os.environ["FREESURFER_HOME"] = freesurfer_home
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+"""
+Test conversion of t stat maps to Z
+"""
+from pybraincompare.compare.maths import TtoZ_batch, t_to_z_data
+from pybraincompare.compare import maths
+from pybraincompare.mr.datasets import get_pair_images
+from pybraincompare.template.futils import make_tmp_folder
+from numpy.testing import assert_array_equal, assert_almost_equal, assert_equal
+from nose.tools import assert_true, assert_false
+from scipy.stats import norm, t
+import nibabel
+import numpy
+
+'''Test that Z values match the t cdf -> normal ppf conversion'''
+def test_t_to_z_values():
+
+  t_values = numpy.array([-8,-3.2,-1,-0.1,0,0.1,1,3.2,8],dtype=numpy.float32)
+  expected = numpy.zeros(len(t_values))
+  nonzero = t_values != 0
+  expected[nonzero] = norm.ppf(t.cdf(t_values[nonzero],df=20))
+  z_values = t_to_z_data(t_values.copy(),dof=20)
+  assert_equal(z_values.dtype,numpy.float32)
+  assert_almost_equal(expected,z_values,decimal=5)
+
+  # Extreme values do not saturate, and keep their order and sign
+  extreme = numpy.array([-1e30,-100,100,1e30])
+  for ndtri_exp in [maths.ndtri_exp,None]:
+    original = maths.ndtri_exp
+    maths.ndtri_exp = ndtri_exp
+    z_values = t_to_z_data(extreme.copy(),dof=20)
+    maths.ndtri_exp = original
+    assert_true(numpy.isfinite(z_values).all())
+    assert_array_equal(numpy.sign(z_values),numpy.sign(extreme))
+    assert_true((numpy.diff(z_values) > 0).all())
+
+'''Test that batch conversion gives one Z map per t map, with its own dof'''
+def test_ttoz_batch():
+
+  images = get_pair_images(voxdims=["8","8"])
+  with make_tmp_folder() as temp_dir:
+    outputs = ["%s/z1.nii.gz" %temp_dir,"%s/z2.nii.gz" %temp_dir]
+    result = TtoZ_batch(images,outputs,dofs=[10,200],n_jobs=2)
+    assert_equal(result,outputs)
+    for image,output,dof in zip(images,outputs,[10,200]):
+      t_data = nibabel.load(image).get_data()
+      z_data = nibabel.load(output).get_data()
+      nonzero = t_data != 0
+      assert_almost_equal(norm.ppf(t.cdf(t_data[nonzero],df=dof)),
+                          z_data[nonzero],decimal=4)
@@ -26,6 +26,10 @@ setup(
     license="LICENSE.txt",
     description="meta analysis and comparison for neuroimaging in python",
 
+    entry_points = {'console_scripts': [
+        'pbc_ttoz=pybraincompare.compare.maths:main_ttoz'
+    ]},
+
     install_requires = ['six', 'pydicom', 'Cython','networkx', 'numpy',
                         'scipy', 'scikit-learn', 'nibabel', 'nilearn',
                         'pandas','matplotlib', 'scikit-image','future']